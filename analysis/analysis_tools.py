@@ -73,16 +73,7 @@ def get_city2groups(country_code):
     Member IDs will not be expanded. 
     """
     if country_code == 'GB':
-        geolookup = espon_fua.GeoLookup.get_singleton()
-        def f(group):
-            lat = group['lat']
-            lon = group['lon']
-            fua_city_obj = geolookup.lookup(lon, lat)
-            if fua_city_obj is None:
-                return '<unknown>'
-            else:
-                return fua_city_obj
-        ident_func = f
+        ident_func = None  # groups are assigned to FUAs in one batch, below
         #ident_func = lambda group: "%s:%s:%s" % (group['country'], '', group['city'])
     elif country_code == 'US':
         ident_func = lambda group: "%s:%s:%s" % (group['country'], group['country'], group['city'])
@@ -95,6 +86,7 @@ def get_city2groups(country_code):
     mdb = mongo_connect()
     city2groups = collections.defaultdict(lambda: [])
 
+    groups = []
     groups_iter = mdb[COLL_GROUPS].find({'country' : country_code})
     for group in groups_iter:
         # expand events with attendee_ids
@@ -102,9 +94,20 @@ def get_city2groups(country_code):
             eid = event['id']
             attendee_ids = get_attendee_ids(mdb, eid)
             event['attendee_ids'] = attendee_ids
+        groups.append(group)
+
+    if ident_func is None:
+        geolookup = espon_fua.GeoLookup.get_singleton()
+        region_indxs = geolookup.lookup_many([group['lon'] for group in groups],
+                                             [group['lat'] for group in groups])
+        cities = geolookup.cities
+        idents = ['<unknown>' if indx == espon_fua.NO_REGION else cities[indx]
+                  for indx in region_indxs]
+    else:
+        idents = [ident_func(group) for group in groups]
 
-        # store according to city
-        ident = ident_func(group)
+    # store according to city
+    for group, ident in zip(groups, idents):
         city2groups[ident].append(group)
 
     return dict(city2groups)
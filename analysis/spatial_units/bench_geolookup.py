@@ -0,0 +1,96 @@
+# Matt J Williams, 2015
+# http://mattjw.net
+# mattjw@mattjw.net
+
+
+"""
+Check and benchmark GeoLookup's region lookups.
+
+Random points are drawn, half uniformly over the extent of the regions and
+half scattered about region centroids (as group locations are). Each point
+is looked up with the grid (`RegionIndex.lookup`), the exact polygon test
+(`RegionIndex.lookup_exact`) and in bulk (`RegionIndex.lookup_many`); any
+disagreement is reported, followed by the lookups per second of each.
+
+Usage:
+    python bench_geolookup.py [--points 100000] [--seed 0] [--no-cache]
+"""
+
+
+import sys
+import time
+import random
+import argparse
+
+import espon_fua
+from region_index import NO_REGION, GRID_BOUNDARY
+
+
+def random_points(geolookup, num_points, rng):
+    """
+    List of `num_points` tuples (lon, lat); see module docstring.
+    """
+    min_x, min_y, max_x, max_y = geolookup.region_index.bounds
+    spread = 0.02 * max(max_x - min_x, max_y - min_y)
+    points = []
+    for i in xrange(num_points):
+        if i % 2:
+            points.append((rng.uniform(min_x, max_x), rng.uniform(min_y, max_y)))
+        else:
+            lon, lat = rng.choice(geolookup.centroids)
+            points.append((rng.gauss(lon, spread), rng.gauss(lat, spread)))
+    return points
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and benchmark GeoLookup")
+    parser.add_argument('--points', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-cache', action='store_true',
+                        help="load the regions from source, not the GeoLookup cache")
+    args = parser.parse_args()
+
+    cache_fpath = None if args.no_cache else espon_fua.FPATH_GEOLOOKUP_CACHE
+    geolookup, secs = timed(espon_fua.GeoLookup, cache_fpath)
+    index = geolookup.region_index
+    print "loaded %d regions (%d polygons) in %.2fs" % (index.num_regions, index.num_parts, secs)
+    if index.grid is not None:
+        grid = index.grid
+        print "grid: %d x %d cells, %.1f%% boundary" % (
+            grid.shape[0], grid.shape[1], 100.0 * (grid == GRID_BOUNDARY).sum() / grid.size)
+
+    points = random_points(geolookup, args.points, random.Random(args.seed))
+    lons = [lon for lon, _ in points]
+    lats = [lat for _, lat in points]
+
+    exact, exact_secs = timed(lambda: [index.lookup_exact(lon, lat) for lon, lat in points])
+    gridded, grid_secs = timed(lambda: [index.lookup(lon, lat) for lon, lat in points])
+    many, many_secs = timed(index.lookup_many, lons, lats)
+
+    mismatches = 0
+    for i, expected in enumerate(exact):
+        found_many = None if many[i] == NO_REGION else int(many[i])
+        if gridded[i] != expected or found_many != expected:
+            mismatches += 1
+            if mismatches <= 10:
+                print "mismatch at %r: exact %s, lookup %s, lookup_many %s" % (
+                    points[i], expected, gridded[i], found_many)
+    num_matched = sum(1 for region in exact if region is not None)
+    print "%d points, %d in a region, %d mismatches" % (len(points), num_matched, mismatches)
+
+    for name, secs in [('lookup_exact', exact_secs), ('lookup', grid_secs),
+                       ('lookup_many', many_secs)]:
+        print "%-13s %10.0f lookups/s" % (name, len(points) / secs)
+
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -25,6 +25,16 @@ Inputs:
 Outputs:
 Each GEOPOINT is annotated with attributes (REGION ATTRIBUTES) of the region it
 belongs to (REGION SHAPES).
+
+The GEOPOINTS file is streamed in chunks of rows, so it may be of any size:
+each chunk's locations are reprojected and looked up in a batch, and the
+chunk's rows written out with the attributes appended (empty if the point is
+in no region).
+
+Usage:
+    python espon_fua.py GEOPOINTS OUT [--lon-col lon] [--lat-col lat] [--crs epsg:4326]
+
+With no arguments, a few example lookups are run.
 """
 
 
@@ -33,13 +43,16 @@ import csv
 import math
 import argparse
 import os
+import hashlib
+import itertools
 from pprint import pprint
 
 
 from shapefile_tools import polygon_shaperecords
+from region_index import RegionIndex, NO_REGION
+from projection_tools import get_reprojector, WGS84
 import pysal
 from pysal.cg.locators import PolygonLocator
-import pyproj
 
 
 #
@@ -64,38 +77,69 @@ REGION_SHAPE_ID_FIELDNAME = 'id_fua'
 
 FUA_ID_PREFIX = 'UK'
 
+REGION_SHAPES_CRS = WGS84
+    # coordinate reference system of the REGION SHAPES geometries
+
+# GEOPOINTS file
+GEOPOINTS_LON_COL = 'lon'
+GEOPOINTS_LAT_COL = 'lat'
+    # the columns in the GEOPOINTS file holding each location
+GEOPOINTS_CRS = WGS84
+ANNOTATION_PREFIX = 'region_'
+    # prefix of the REGION ATTRIBUTES columns added to annotated GEOPOINTS
+ANNOTATE_CHUNK_ROWS = 10000
+    # GEOPOINTS rows looked up at a time
+
+# GeoLookup cache; see `GeoLookup`
+FPATH_GEOLOOKUP_CACHE = os.path.join(MODULE_DIR, "fua/geolookup.cache")
+GEOLOOKUP_CACHE_VERSION = 1
+SHAPEFILE_EXTENSIONS = ['.shp', '.shx', '.dbf']
+
 
 #
 #
 # Script
 #
 
+def region_record_filter(region_shape_id_fieldname):
+    """
+    Record filter, for `polygon_shaperecords`, retaining only regions whose
+    ID (field `region_shape_id_fieldname`) starts with `FUA_ID_PREFIX`.
+    """
+    def keep(record):
+        if region_shape_id_fieldname not in record:
+            raise ValueError("'%s' not in shape file %s" % (region_shape_id_fieldname, record.keys()))
+        # only retain FUA units that start with particular prefix (e.g., UK)
+        return record[region_shape_id_fieldname].startswith(FUA_ID_PREFIX)
+    return keep
+
+
+def load_region_list(fpath_region_shapes, region_shape_id_fieldname):
+    """
+    Load the geographic regions (REGION SHAPES), as `load_regions`, but as a
+    list of shape dictionaries in the order of the shapefile.
+    """
+    return list(polygon_shaperecords(fpath_region_shapes,
+                                     region_record_filter(region_shape_id_fieldname)))
+
+
 def load_regions(fpath_region_shapes, region_shape_id_fieldname):
     """
     Load the geographic regions (REGION SHAPES) from a suite of shapefiles with 
     file path prefix `fpath_region_shapes`. This also checks to ensure a field
     with name `region_shape_id_fieldname` exists in each shape dictionary.
+    Regions outside `FUA_ID_PREFIX` are skipped before their geometry is read.
     """
     regions = {}
     # maps a pysal polygon to the input shapedict,
     # inc. pyshp geometry and shapely geometry
 
-    for indx, shape_dict in enumerate(polygon_shaperecords(fpath_region_shapes)):
+    shape_dicts = polygon_shaperecords(fpath_region_shapes,
+                                       region_record_filter(region_shape_id_fieldname))
+    for shape_dict in shape_dicts:
         # 'geom_pyshp', 'geom_shapely', ...
         geom_shapely = shape_dict['geom_shapely']
         geom_pysal = pysal.cg.asShape(geom_shapely)
-
-        if region_shape_id_fieldname not in shape_dict:
-            raise ValueError("'%s' not in shape file %s" % (region_shape_id_fieldname, shape_dict.keys()))
-
-        if not shape_dict[region_shape_id_fieldname].startswith(FUA_ID_PREFIX):
-            # only retain FUA units that start with particular prefix (e.g., UK)
-            continue
-        #else:
-        #    pprint(shape_dict)
-        #    print shape_dict['geom_shapely']
-        #    exit()
-
         regions[geom_pysal] = shape_dict
     return regions
 
@@ -124,7 +168,42 @@ def load_region_attributes(fpath_region_attribs, region_attribs_id_col):
     return region_attribs
 
 
-def extract_geopoint_location(geopoint_row):
+def file_checksum(fpath, block_size=1 << 20):
+    """
+    SHA-1 hex digest of the contents of file `fpath`.
+    """
+    digest = hashlib.sha1()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def geolookup_cache_key():
+    """
+    Key of the GeoLookup cache: changes whenever the REGION SHAPES or REGION
+    ATTRIBUTES files, or the parameters used to read them, change.
+    """
+    parts = [GEOLOOKUP_CACHE_VERSION, FUA_ID_PREFIX, REGION_SHAPE_ID_FIELDNAME,
+             REGION_ATTRIBS_ID_COL]
+    for ext in SHAPEFILE_EXTENSIONS:
+        parts.append(file_checksum(FPATH_REGION_SHAPES + ext))
+    parts.append(file_checksum(FPATH_REGION_ATTRIBS))
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+
+def parse_coord(value):
+    """
+    Coordinate `value` as a float, or NaN if it is missing or malformed.
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+def extract_geopoint_location(geopoint_row, lon_col=GEOPOINTS_LON_COL,
+                              lat_col=GEOPOINTS_LAT_COL, crs=GEOPOINTS_CRS):
     """
     Extract location data from a geopoint row (a row in GEOPOINTS) and
     normalise its format (e.g., from lat-long) to the same format that is used
@@ -134,16 +213,25 @@ def extract_geopoint_location(geopoint_row):
     National Grid) format, and the geopoints might be described as long lat.
     This function would extract the geopoint's long-lat pair and
     transform them to BNG for comparison with the region geometries.
+
+    The location is read from columns `lon_col` and `lat_col`, in coordinate
+    system `crs`. See `extract_geopoint_locations` for many rows.
     """
-    wgs84 = pyproj.Proj(init='epsg:4326')  # wgs - geodetic coordinate system
-    bng = pyproj.Proj(init='epsg:27700')  # UK LSOA are in BNG (british nat grid)
+    lon = float(geopoint_row[lon_col])
+    lat = float(geopoint_row[lat_col])
+    return get_reprojector(crs, REGION_SHAPES_CRS).transform_point(lon, lat)
 
-    lon = float(geopoint_row[geopoints_lon_col])
-    lat = float(geopoint_row[geopoints_lat_col])
 
-    bng_east, bng_north = pyproj.transform(wgs84, bng, lon, lat)
-    loc = (bng_east, bng_north)
-    return loc
+def extract_geopoint_locations(geopoint_rows, lon_col=GEOPOINTS_LON_COL,
+                               lat_col=GEOPOINTS_LAT_COL, crs=GEOPOINTS_CRS):
+    """
+    As `extract_geopoint_location`, for a sequence of rows, transformed in
+    one batch. Returns tuple (xs, ys) of numpy arrays; NaN where a row's
+    location is missing or malformed.
+    """
+    lons = [parse_coord(row[lon_col]) for row in geopoint_rows]
+    lats = [parse_coord(row[lat_col]) for row in geopoint_rows]
+    return get_reprojector(crs, REGION_SHAPES_CRS).transform(lons, lats)
 
 
 def save_dict_seq(seq, fpath):
@@ -156,8 +244,8 @@ def save_dict_seq(seq, fpath):
         raise ValueError("Cannot save empty sequence")
 
     head, tail = os.path.split(fpath)
-    if head:
-        os.mkdirs(head)
+    if head and not os.path.isdir(head):
+        os.makedirs(head)
 
     with open(fpath, 'w') as f:
         fnames = seq[0].keys()
@@ -217,6 +305,8 @@ def loc_to_region_attribs(loc, regions, region_shape_id_fieldname,
 
 
 class FUACity(object):
+    __slots__ = ('name', 'fua_id', 'pop', 'lon', 'lat')
+
     def __init__(self, name, fua_id, pop, lon, lat):
         self.name = name
         self.fua_id = fua_id
@@ -243,23 +333,120 @@ class GeoLookup(object):
     """
     Look up the region that a point belongs to. `lookup` returns a FUACity
     describing the containing region, or None if no match found.
+
+    Regions are found through a `region_index.RegionIndex`. For many points,
+    `lookup_many` gives the index of each point's region (into `regions`),
+    and `region_city` the FUACity of a region index.
+
+    The FUACity of each region is built once, at load, and shared: lookups
+    return the same object for the same region.
+
+    Loading the regions from the shapefile is slow, so the index, the
+    regions' fields and centroids, and the region attributes are cached in
+    `cache_fpath` (None for no cache). The cache is keyed on the checksums of
+    the source files (see `geolookup_cache_key`) and rebuilt whenever they
+    change; the index geometry is memory-mapped from it.
     """
 
-    def __init__(self):
-        self.regions = load_regions(FPATH_REGION_SHAPES, REGION_SHAPE_ID_FIELDNAME)
-        self.region_locator = PolygonLocator(self.regions.iterkeys())
+    def __init__(self, cache_fpath=FPATH_GEOLOOKUP_CACHE):
+        key = geolookup_cache_key()
+        if cache_fpath is None or not self._load_cache(cache_fpath, key):
+            self._load_sources()
+            if cache_fpath is not None:
+                self._save_cache(cache_fpath, key)
+        self.cities = [self._make_city(indx) for indx in xrange(len(self.regions))]
+
+    def _load_sources(self):
+        self.regions = []  # shape records, without geometries
+        self.centroids = []  # (lon, lat) of each region
+        geoms = []
+        for shape_dict in load_region_list(FPATH_REGION_SHAPES, REGION_SHAPE_ID_FIELDNAME):
+            geom = shape_dict['geom_shapely']
+            geoms.append(geom)
+            self.centroids.append((geom.centroid.x, geom.centroid.y))
+            self.regions.append(collections.OrderedDict(
+                (k, v) for k, v in shape_dict.iteritems() if not k.startswith('geom_')))
+        self.region_index = RegionIndex(geoms)
         self.region_attribs = load_region_attributes(FPATH_REGION_ATTRIBS, REGION_ATTRIBS_ID_COL)
+        attribs = self.region_attribs.values()
+        self.attrib_fields = attribs[0].keys() if attribs else []
+
+    def _load_cache(self, cache_fpath, key):
+        """
+        Load from the cache, if it exists and has key `key`. Returns whether
+        it was loaded.
+        """
+        loaded = RegionIndex.load(cache_fpath)
+        if loaded is None:
+            return False
+        region_index, meta = loaded
+        if meta is None or meta.get('key') != key:
+            return False
+        self.region_index = region_index
+        self.regions = [collections.OrderedDict(zip(meta['region_fields'], row))
+                        for row in meta['region_rows']]
+        self.centroids = [tuple(c) for c in meta['centroids']]
+        attrib_fields = [k.encode('utf-8') for k in meta['attrib_fields']]
+        self.attrib_fields = attrib_fields
+        self.region_attribs = {}  # as read from the CSV file
+        for row in meta['attrib_rows']:
+            dct = collections.OrderedDict(zip(attrib_fields, [v.encode('utf-8') for v in row]))
+            self.region_attribs[dct[attrib_fields[REGION_ATTRIBS_ID_COL]]] = dct
+        return True
+
+    def _save_cache(self, cache_fpath, key):
+        # records as field names and rows of values, to keep field order
+        region_fields = self.regions[0].keys() if self.regions else []
+        meta = {'key': key, 'centroids': self.centroids,
+                'region_fields': region_fields,
+                'region_rows': [region.values() for region in self.regions],
+                'attrib_fields': self.attrib_fields,
+                'attrib_rows': [dct.values() for dct in self.region_attribs.itervalues()]}
+        try:
+            self.region_index.save(cache_fpath, meta)
+        except (IOError, OSError, TypeError) as e:
+            print "could not save GeoLookup cache to %s: %s" % (cache_fpath, e)
+
+    def region_geom(self, indx):
+        """
+        Shapely geometry of the region with index `indx`.
+        """
+        return self.region_index.region_geom(indx)
+
+    def region_attributes(self, indx):
+        """
+        REGION ATTRIBUTES (ordered dict) of the region with index `indx`.
+        """
+        return self.region_attribs[self.regions[indx][REGION_SHAPE_ID_FIELDNAME]]
+
+    def _make_city(self, indx):
+        attribs_dct = self.region_attributes(indx)
+        c_lon, c_lat = self.centroids[indx]
+        return FUACity(attribs_dct['name'], attribs_dct['unit_code'], attribs_dct['pop_t'],
+            lon=c_lon, lat=c_lat)
+
+    def region_city(self, indx):
+        """
+        FUACity for the region with index `indx`.
+        """
+        return self.cities[indx]
 
     def lookup(self, lon, lat):
-        loc = (lon, lat)
-        attribs_dct = loc_to_region_attribs(loc, self.regions, REGION_SHAPE_ID_FIELDNAME, self.region_locator, self.region_attribs)
-        if attribs_dct is None:
+        """
+        Throws error if multiple polygons match.
+        """
+        indx = self.region_index.lookup(lon, lat)
+        if indx is None:
             return None
-        c_lon = attribs_dct['geom_shapely'].centroid.x
-        c_lat = attribs_dct['geom_shapely'].centroid.y
-        city = FUACity(attribs_dct['name'], attribs_dct['unit_code'], attribs_dct['pop_t'],
-            lon=c_lon, lat=c_lat)
-        return city
+        return self.cities[indx]
+
+    def lookup_many(self, lons, lats):
+        """
+        Region index (into `regions`) for each point (`lons[i]`, `lats[i]`),
+        as a numpy array; `NO_REGION` where no region contains the point.
+        Throws error if multiple polygons match any point.
+        """
+        return self.region_index.lookup_many(lons, lats)
 
     __singleton = None
     @staticmethod
@@ -269,7 +456,50 @@ class GeoLookup(object):
         return GeoLookup.__singleton
 
 
-def main():
+def annotate_geopoints(fin, fout, geolookup, lon_col=GEOPOINTS_LON_COL,
+                       lat_col=GEOPOINTS_LAT_COL, crs=GEOPOINTS_CRS,
+                       chunk_rows=ANNOTATE_CHUNK_ROWS):
+    """
+    Annotate the GEOPOINTS CSV read from file `fin` with the REGION
+    ATTRIBUTES of each point's region, found by `geolookup`, writing CSV to
+    file `fout`. The attribute columns are named with `ANNOTATION_PREFIX`.
+    See module docstring.
+
+    Returns tuple (number of rows, number of rows in a region).
+    """
+    rdr = csv.DictReader(fin)
+    if rdr.fieldnames is None:
+        raise ValueError("GEOPOINTS file has no header")
+    for col in [lon_col, lat_col]:
+        if col not in rdr.fieldnames:
+            raise ValueError("'%s' not in GEOPOINTS columns %s" % (col, rdr.fieldnames))
+    annotation_cols = [ANNOTATION_PREFIX + field for field in geolookup.attrib_fields]
+    wrtr = csv.writer(fout)
+    wrtr.writerow(rdr.fieldnames + annotation_cols)
+
+    no_annotation = [''] * len(annotation_cols)
+    annotations = {}  # region index -> annotation values
+    num_rows = num_matched = 0
+    while True:
+        chunk = list(itertools.islice(rdr, chunk_rows))
+        if not chunk:
+            break
+        xs, ys = extract_geopoint_locations(chunk, lon_col, lat_col, crs)
+        region_indxs = geolookup.lookup_many(xs, ys)
+        for row, indx in zip(chunk, region_indxs):
+            if indx == NO_REGION:
+                annotation = no_annotation
+            else:
+                annotation = annotations.get(indx)
+                if annotation is None:
+                    annotation = annotations[indx] = geolookup.region_attributes(indx).values()
+                num_matched += 1
+            wrtr.writerow([row[field] for field in rdr.fieldnames] + annotation)
+        num_rows += len(chunk)
+    return num_rows, num_matched
+
+
+def demo():
 
     #
     # Processing
@@ -308,5 +538,33 @@ def main():
     city_obj = geolookup.lookup(lon, lat)
     print city_obj
 
+
+def main():
+    parser = argparse.ArgumentParser(description="Annotate GEOPOINTS with their regions' attributes")
+    parser.add_argument('geopoints', nargs='?', help="GEOPOINTS CSV file")
+    parser.add_argument('out', nargs='?', help="output CSV file")
+    parser.add_argument('--lon-col', default=GEOPOINTS_LON_COL)
+    parser.add_argument('--lat-col', default=GEOPOINTS_LAT_COL)
+    parser.add_argument('--crs', default=GEOPOINTS_CRS,
+                        help="coordinate system of the GEOPOINTS, as epsg:<code>")
+    parser.add_argument('--chunk-rows', type=int, default=ANNOTATE_CHUNK_ROWS)
+    args = parser.parse_args()
+
+    if args.geopoints is None:
+        demo()
+        return
+    if args.out is None:
+        parser.error("no output file given")
+
+    geolookup = GeoLookup.get_singleton()
+    head, tail = os.path.split(args.out)
+    if head and not os.path.isdir(head):
+        os.makedirs(head)
+    with open(args.geopoints, 'rU') as fin, open(args.out, 'wb') as fout:
+        num_rows, num_matched = annotate_geopoints(
+            fin, fout, geolookup, args.lon_col, args.lat_col, args.crs, args.chunk_rows)
+    print "annotated %d geopoints; %d in a region" % (num_rows, num_matched)
+
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
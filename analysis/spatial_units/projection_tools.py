@@ -0,0 +1,90 @@
+# Matt J Williams, 2015
+# http://mattjw.net
+# mattjw@mattjw.net
+
+
+"""
+Tools for reprojecting coordinates between coordinate reference systems, in
+bulk.
+
+Building a projection is slow relative to transforming a point, so
+`get_reprojector` builds one `Reprojector` per pair of systems and reuses
+it; `Reprojector.transform` then converts whole arrays of coordinates in a
+single call.
+
+Depends on pyproj and numpy. With pyproj 2.1 or later, a `pyproj.Transformer`
+is used; with older versions, a pair of `pyproj.Proj`.
+"""
+
+
+import threading
+
+import numpy
+import pyproj
+
+
+WGS84 = 'epsg:4326'  # geodetic longitude and latitude
+BNG = 'epsg:27700'  # British National Grid
+
+_reprojectors = {}
+_reprojectors_lock = threading.Lock()
+
+
+class Reprojector(object):
+    """
+    Converts coordinates from coordinate reference system `src` to `dst`
+    (each an 'epsg:<code>' string). Coordinates are in (x, y) order, i.e.,
+    longitude first for geodetic systems.
+    """
+
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        self.identity = (src.lower() == dst.lower())
+        if self.identity:
+            return
+        if hasattr(pyproj, 'Transformer'):
+            self._transformer = pyproj.Transformer.from_crs(src, dst, always_xy=True)
+        else:
+            self._transformer = None
+            self._src_proj = pyproj.Proj(init=src)
+            self._dst_proj = pyproj.Proj(init=dst)
+
+    def transform(self, xs, ys):
+        """
+        Convert coordinates `xs` and `ys` (sequences or arrays of equal
+        length). Returns tuple (xs, ys) of float arrays. Points that cannot
+        be converted come out as NaN or infinite.
+        """
+        xs = numpy.asarray(xs, dtype=numpy.float64)
+        ys = numpy.asarray(ys, dtype=numpy.float64)
+        if xs.shape != ys.shape:
+            raise ValueError("xs and ys differ in length")
+        if self.identity:
+            return xs.copy(), ys.copy()
+        if self._transformer is not None:
+            out_xs, out_ys = self._transformer.transform(xs, ys)
+        else:
+            out_xs, out_ys = pyproj.transform(self._src_proj, self._dst_proj, xs, ys)
+        return numpy.asarray(out_xs, dtype=numpy.float64), numpy.asarray(out_ys, dtype=numpy.float64)
+
+    def transform_point(self, x, y):
+        """
+        Convert a single point. Returns tuple (x, y).
+        """
+        out_xs, out_ys = self.transform([x], [y])
+        return float(out_xs[0]), float(out_ys[0])
+
+
+def get_reprojector(src, dst):
+    """
+    The shared `Reprojector` from `src` to `dst`, built on first use.
+    """
+    key = (src.lower(), dst.lower())
+    reprojector = _reprojectors.get(key)
+    if reprojector is None:
+        with _reprojectors_lock:
+            reprojector = _reprojectors.get(key)
+            if reprojector is None:
+                reprojector = _reprojectors[key] = Reprojector(src, dst)
+    return reprojector
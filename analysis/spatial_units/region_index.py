@@ -0,0 +1,408 @@
+# Matt J Williams, 2015
+# http://mattjw.net
+# mattjw@mattjw.net
+
+
+"""
+Spatial index for point-in-region lookups over many regions.
+
+Each region is a (multi-)polygon. The bounding boxes of the polygons are
+held in an STRtree, so a lookup only tests the few polygons whose boxes hold
+the point, and each polygon is prepared (see `shapely.prepared`), so that
+repeated containment tests are fast. Points outside the bounding box of all
+the regions are rejected without touching the tree.
+
+Most points fall well inside a region, so a raster over the extent of the
+regions answers most lookups without any polygon test: each grid cell holds
+the region that wholly contains it, `NO_REGION` if it is outside all regions,
+or `GRID_BOUNDARY` if a region boundary crosses it, in which case the exact
+test above is used. The grid is built by subdividing each polygon's bounding
+box quadtree-fashion, so the cost is proportional to the boundary cells.
+
+The geometry is held as flat coordinate arrays, and shapely polygons are only
+built for the polygons that lookups actually test. An index can be saved to
+a file and loaded again through memory maps (see `RegionIndex.save` and
+`RegionIndex.load`), which is much quicker than reading the regions' source
+data.
+
+Depends on shapely and numpy.
+"""
+
+
+import os
+import math
+import json
+import struct
+
+import numpy
+import shapely.geometry
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+
+NO_REGION = -1  # region index returned by `lookup_many` for no match
+GRID_BOUNDARY = -2  # grid cell state: needs the exact test
+
+DEFAULT_GRID_CELLS = 1 << 18  # approximate number of cells in the grid
+GRID_CELL_MARGIN = 1e-6
+    # cells are classified as if larger by this share of their size, so that
+    # rounding when finding a point's cell cannot place it wrongly
+
+CACHE_MAGIC = 'RGNIDX'
+CACHE_VERSION = 2
+CACHE_ALIGN = 16  # bytes; arrays in a saved index start on this boundary
+
+ARRAY_NAMES = ['coords', 'ring_offsets', 'part_rings', 'part_regions', 'part_bounds',
+               'grid', 'grid_bounds']
+
+
+def polygon_parts(geom):
+    """
+    The polygons making up polygon or multipolygon `geom`.
+    """
+    if geom.geom_type == 'Polygon':
+        return [geom]
+    return list(geom.geoms)
+
+
+def geoms_to_arrays(geoms):
+    """
+    Flatten `geoms` (polygons or multipolygons) into the arrays held by a
+    `RegionIndex`:
+
+    coords:         (num points, 2) float64 ring coordinates.
+    ring_offsets:   Start of each ring in `coords`, plus the end.
+    part_rings:     Start of each polygon's rings in `ring_offsets`, plus the
+                    end. A polygon's first ring is its exterior.
+    part_regions:   Region index of each polygon.
+    part_bounds:    (num polygons, 4) bounding boxes.
+    """
+    coords = []
+    ring_offsets = [0]
+    part_rings = [0]
+    part_regions = []
+    part_bounds = []
+    for region, geom in enumerate(geoms):
+        for part in polygon_parts(geom):
+            for ring in [part.exterior] + list(part.interiors):
+                ring_coords = list(ring.coords)
+                coords.extend(ring_coords)
+                ring_offsets.append(ring_offsets[-1] + len(ring_coords))
+            part_rings.append(len(ring_offsets) - 1)
+            part_regions.append(region)
+            part_bounds.append(part.bounds)
+    return {
+        'coords': numpy.array(coords, dtype=numpy.float64).reshape(-1, 2),
+        'ring_offsets': numpy.array(ring_offsets, dtype=numpy.int64),
+        'part_rings': numpy.array(part_rings, dtype=numpy.int64),
+        'part_regions': numpy.array(part_regions, dtype=numpy.int32),
+        'part_bounds': numpy.array(part_bounds, dtype=numpy.float64).reshape(-1, 4),
+    }
+
+
+def save_arrays(fpath, meta, arrays):
+    """
+    Save the numpy arrays `arrays` (dict) and the JSON-serialisable `meta`
+    to `fpath`, in a form `load_arrays` can memory-map. Written atomically.
+    """
+    layout = {}
+    offset = 0
+    for name in sorted(arrays):
+        arr = numpy.ascontiguousarray(arrays[name])
+        arrays[name] = arr
+        layout[name] = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': offset}
+        offset += arr.nbytes
+        offset += -offset % CACHE_ALIGN
+    header = json.dumps({'version': CACHE_VERSION, 'meta': meta, 'arrays': layout})
+    prefix_len = len(CACHE_MAGIC) + 8 + len(header)
+    data_start = prefix_len + (-prefix_len % CACHE_ALIGN)
+
+    tmp_fpath = fpath + '.tmp'
+    with open(tmp_fpath, 'wb') as f:
+        f.write(CACHE_MAGIC)
+        f.write(struct.pack('<q', len(header)))
+        f.write(header)
+        for name in sorted(arrays):
+            f.seek(data_start + layout[name]['offset'])
+            f.write(arrays[name].tostring())
+        f.truncate(data_start + offset)
+    os.rename(tmp_fpath, fpath)
+
+
+def load_arrays(fpath):
+    """
+    Load a file written by `save_arrays`. Returns tuple (meta, dict of
+    read-only memory-mapped arrays), or None if the file is missing, of
+    another version or damaged.
+    """
+    try:
+        f = open(fpath, 'rb')
+    except IOError:
+        return None
+    with f:
+        if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+            return None
+        try:
+            header_len, = struct.unpack('<q', f.read(8))
+            header = json.loads(f.read(header_len))
+        except (struct.error, ValueError):
+            return None
+        if header.get('version') != CACHE_VERSION:
+            return None
+        prefix_len = len(CACHE_MAGIC) + 8 + header_len
+        data_start = prefix_len + (-prefix_len % CACHE_ALIGN)
+        file_len = os.fstat(f.fileno()).st_size
+
+    arrays = {}
+    for name, spec in header['arrays'].iteritems():
+        dtype = numpy.dtype(str(spec['dtype']))
+        shape = tuple(spec['shape'])
+        nbytes = dtype.itemsize * int(numpy.prod(shape))
+        offset = data_start + spec['offset']
+        if offset + nbytes > file_len:
+            return None
+        if nbytes == 0:
+            arrays[name] = numpy.zeros(shape, dtype)
+        else:
+            arrays[name] = numpy.memmap(fpath, dtype=dtype, mode='r', offset=offset, shape=shape)
+    return header['meta'], arrays
+
+
+class RegionIndex(object):
+    """
+    Finds which of `geoms` (a list of polygons or multipolygons) contains a
+    point. Regions are identified by their index in `geoms`.
+
+    A point on a region's boundary is not contained by it.
+
+    `arrays` may be given instead of `geoms`, as from `geoms_to_arrays`; see
+    also `load`. A lookup grid of about `grid_cells` cells is built, unless
+    `arrays` already has one; 0 for none.
+    """
+
+    def __init__(self, geoms=None, arrays=None, num_regions=None,
+                 grid_cells=DEFAULT_GRID_CELLS):
+        if arrays is None:
+            geoms = list(geoms)
+            arrays = geoms_to_arrays(geoms)
+            num_regions = len(geoms)
+        elif num_regions is None:
+            part_regions = arrays['part_regions']
+            num_regions = int(part_regions.max()) + 1 if len(part_regions) else 0
+        self.num_regions = num_regions
+        self.arrays = arrays
+        self._coords = arrays['coords']
+        self._ring_offsets = arrays['ring_offsets']
+        self._part_rings = arrays['part_rings']
+        self._part_regions = arrays['part_regions']
+        part_bounds = arrays['part_bounds']
+        self.num_parts = len(self._part_regions)
+        self._prepared = [None] * self.num_parts  # built as needed
+
+        boxes = [shapely.geometry.box(*bounds) for bounds in part_bounds]
+        self._box_ids = dict((id(box), indx) for indx, box in enumerate(boxes))
+        self._boxes = boxes  # the tree refers to these
+        self._tree = STRtree(boxes) if boxes else None
+        if self.num_parts:
+            self.bounds = (float(part_bounds[:, 0].min()), float(part_bounds[:, 1].min()),
+                           float(part_bounds[:, 2].max()), float(part_bounds[:, 3].max()))
+        else:
+            self.bounds = None
+
+        if 'grid' not in arrays:
+            arrays['grid'], arrays['grid_bounds'] = self._build_grid(grid_cells)
+        self._set_grid(arrays['grid'], arrays['grid_bounds'])
+
+    def _set_grid(self, grid, grid_bounds):
+        self.grid = grid
+        if grid.size == 0:
+            self.grid = None
+            return
+        num_rows, num_cols = grid.shape
+        self._grid_x0, self._grid_y0 = float(grid_bounds[0]), float(grid_bounds[1])
+        self._grid_sx = num_cols / float(grid_bounds[2] - grid_bounds[0])
+        self._grid_sy = num_rows / float(grid_bounds[3] - grid_bounds[1])
+        self._grid_max_col = num_cols - 1
+        self._grid_max_row = num_rows - 1
+
+    def _build_grid(self, grid_cells):
+        """
+        Classify the cells of a grid of about `grid_cells` cells over
+        `bounds`. Returns tuple (grid, its bounds), empty if there is no grid.
+        """
+        empty = numpy.zeros((0, 0), dtype=numpy.int32), numpy.zeros(4)
+        if not grid_cells or self.bounds is None:
+            return empty
+        min_x, min_y, max_x, max_y = self.bounds
+        width, height = max_x - min_x, max_y - min_y
+        if width <= 0 or height <= 0:
+            return empty
+        num_cols = max(1, int(round(math.sqrt(grid_cells * width / height))))
+        num_rows = max(1, int(round(grid_cells / float(num_cols))))
+        cell_w, cell_h = width / num_cols, height / num_rows
+        margin_x, margin_y = GRID_CELL_MARGIN * cell_w, GRID_CELL_MARGIN * cell_h
+
+        grid = numpy.empty((num_rows, num_cols), dtype=numpy.int32)
+        grid.fill(NO_REGION)
+        part_bounds = self.arrays['part_bounds']
+        for part in xrange(self.num_parts):
+            region = int(self._part_regions[part])
+            prepared = self._prepared_part(part)
+            p_min_x, p_min_y, p_max_x, p_max_y = part_bounds[part]
+            col_lo = min(num_cols - 1, int((p_min_x - min_x) / cell_w))
+            col_hi = min(num_cols - 1, int((p_max_x - min_x) / cell_w))
+            row_lo = min(num_rows - 1, int((p_min_y - min_y) / cell_h))
+            row_hi = min(num_rows - 1, int((p_max_y - min_y) / cell_h))
+
+            # blocks of cells (first row, last row, first col, last col)
+            blocks = [(row_lo, row_hi, col_lo, col_hi)]
+            while blocks:
+                r0, r1, c0, c1 = blocks.pop()
+                block_box = shapely.geometry.box(
+                    min_x + c0 * cell_w - margin_x, min_y + r0 * cell_h - margin_y,
+                    min_x + (c1 + 1) * cell_w + margin_x, min_y + (r1 + 1) * cell_h + margin_y)
+                if not prepared.intersects(block_box):
+                    continue
+                if prepared.contains_properly(block_box):
+                    cells = grid[r0:r1 + 1, c0:c1 + 1]
+                    cells[(cells != NO_REGION) & (cells != region)] = GRID_BOUNDARY
+                    cells[cells == NO_REGION] = region
+                elif r0 == r1 and c0 == c1:
+                    grid[r0, c0] = GRID_BOUNDARY
+                elif r1 - r0 >= c1 - c0:
+                    mid = (r0 + r1) // 2
+                    blocks.append((r0, mid, c0, c1))
+                    blocks.append((mid + 1, r1, c0, c1))
+                else:
+                    mid = (c0 + c1) // 2
+                    blocks.append((r0, r1, c0, mid))
+                    blocks.append((r0, r1, mid + 1, c1))
+        return grid, numpy.array(self.bounds, dtype=numpy.float64)
+
+    def part_polygon(self, part):
+        """
+        The shapely polygon of part (polygon) index `part`.
+        """
+        ring_offsets = self._ring_offsets
+        rings = []
+        for ring in xrange(self._part_rings[part], self._part_rings[part + 1]):
+            rings.append(numpy.asarray(self._coords[ring_offsets[ring]:ring_offsets[ring + 1]]))
+        return shapely.geometry.Polygon(rings[0], rings[1:])
+
+    def region_geom(self, region):
+        """
+        The shapely multipolygon of region index `region`.
+        """
+        parts = numpy.flatnonzero(numpy.asarray(self._part_regions) == region)
+        return shapely.geometry.MultiPolygon([self.part_polygon(part) for part in parts])
+
+    def _prepared_part(self, part):
+        prepared = self._prepared[part]
+        if prepared is None:
+            prepared = self._prepared[part] = prep(self.part_polygon(part))
+        return prepared
+
+    def _candidate_parts(self, point):
+        hits = self._tree.query(point)
+        if len(hits) and isinstance(hits[0], shapely.geometry.base.BaseGeometry):
+            return [self._box_ids[id(geom)] for geom in hits]
+        return [int(indx) for indx in hits]
+
+    def lookup(self, lon, lat):
+        """
+        Index of the region containing point (`lon`, `lat`), or None if no
+        region contains it. Raises RuntimeError if several regions do.
+        """
+        if self.bounds is None:
+            return None
+        min_x, min_y, max_x, max_y = self.bounds
+        if not (min_x <= lon <= max_x and min_y <= lat <= max_y):
+            return None
+        if self.grid is not None:
+            row = min(int((lat - self._grid_y0) * self._grid_sy), self._grid_max_row)
+            col = min(int((lon - self._grid_x0) * self._grid_sx), self._grid_max_col)
+            state = self.grid.item(row, col)
+            if state >= 0:
+                return state
+            if state == NO_REGION:
+                return None
+        return self._lookup_exact(lon, lat)
+
+    def lookup_exact(self, lon, lat):
+        """
+        As `lookup`, but always testing the polygons, without the grid.
+        """
+        if self.bounds is None:
+            return None
+        min_x, min_y, max_x, max_y = self.bounds
+        if not (min_x <= lon <= max_x and min_y <= lat <= max_y):
+            return None
+        return self._lookup_exact(lon, lat)
+
+    def _lookup_exact(self, lon, lat):
+        point = shapely.geometry.Point(lon, lat)
+        match = None
+        for part in self._candidate_parts(point):
+            if not self._prepared_part(part).contains(point):
+                continue
+            region = int(self._part_regions[part])
+            if match is not None and match != region:
+                raise RuntimeError("multiple polygons for %s" % ((lon, lat),))
+            match = region
+        return match
+
+    def lookup_many(self, lons, lats):
+        """
+        Region index for each point (`lons[i]`, `lats[i]`), as an integer
+        array; `NO_REGION` where no region contains the point. Raises
+        RuntimeError, as `lookup`, if several regions contain a point.
+        """
+        lons = numpy.asarray(lons, dtype=float)
+        lats = numpy.asarray(lats, dtype=float)
+        if lons.shape != lats.shape:
+            raise ValueError("lons and lats differ in length")
+        out = numpy.empty(lons.shape, dtype=numpy.int32)
+        out.fill(NO_REGION)
+        if self.bounds is None:
+            return out
+
+        min_x, min_y, max_x, max_y = self.bounds
+        inside = ((lons >= min_x) & (lons <= max_x) &
+                  (lats >= min_y) & (lats <= max_y))
+        if self.grid is not None:
+            # answer from the grid where it can; boundary cells below
+            indxs = numpy.flatnonzero(inside)
+            rows = ((lats[indxs] - self._grid_y0) * self._grid_sy).astype(numpy.intp)
+            cols = ((lons[indxs] - self._grid_x0) * self._grid_sx).astype(numpy.intp)
+            numpy.minimum(rows, self._grid_max_row, out=rows)
+            numpy.minimum(cols, self._grid_max_col, out=cols)
+            states = self.grid[rows, cols]
+            out[indxs] = numpy.where(states == GRID_BOUNDARY, NO_REGION, states)
+            inside = numpy.zeros(lons.shape, dtype=bool)
+            inside[indxs[states == GRID_BOUNDARY]] = True
+        for i in numpy.flatnonzero(inside):
+            region = self._lookup_exact(lons[i], lats[i])
+            if region is not None:
+                out[i] = region
+        return out
+
+    def save(self, fpath, meta=None):
+        """
+        Save the index, along with JSON-serialisable `meta`, to `fpath`.
+        """
+        arrays = dict((name, self.arrays[name]) for name in ARRAY_NAMES)
+        save_arrays(fpath, {'num_regions': self.num_regions, 'meta': meta}, arrays)
+
+    @classmethod
+    def load(cls, fpath):
+        """
+        Load an index saved by `save`, with its geometry memory-mapped.
+        Returns tuple (index, meta), or None if there is no usable file.
+        """
+        loaded = load_arrays(fpath)
+        if loaded is None:
+            return None
+        meta, arrays = loaded
+        if any(name not in arrays for name in ARRAY_NAMES):
+            return None
+        return cls(arrays=arrays, num_regions=meta['num_regions']), meta['meta']
@@ -12,88 +12,179 @@ Depends on two libraries:
 """
 
 
+import struct
+from array import array
 from collections import OrderedDict
 
 import shapefile
 import shapely.geometry
 
 
-def polygon_shaperecords(shape_base_fname):
+GEOM_FIELDS = ('geom_pyshp', 'geom_shapely')
+
+SHX_HEADER_SIZE = 100  # bytes; each .shx record follows: offset and length
+SHP_BBOX = struct.Struct('<i4d')  # shape type and bounding box, after the record header
+SHP_RECORD_HEADER_SIZE = 8
+
+
+def shape_to_shapely(shp):
+    """
+    Convert pyshp polygon shape `shp` to a shapely MultiPolygon.
+    """
+    if not shp.shapeType == 5:
+        # 5 => shapefile's "Polygon" type, which may have multiple 'parts':
+        #     fields = MBR, Number of parts, Number of points, Parts, Points
+        # i.e., a shapefil Polygon may actually include multiple polygons
+        # shp.parts: this is a list of indexes, indicating the start of
+        # a new shape
+        raise ValueError("Expected shape type 5 (polygon) but found %s" % shp.shapeType)
+
+    num_parts = len(shp.parts)
+        # shp.parts gives the indxexes into the flat list of
+        # shp.points. these indicate the array slices which
+        # correspond to polygons
+    num_points = len(shp.points)
+    polys = []
+    for i in xrange(num_parts):
+        start_indx = shp.parts[i]
+        if (i+1) < num_parts:
+            end_indx = shp.parts[i+1]
+        else:
+            end_indx = num_points
+        poly_pts = shp.points[start_indx:end_indx]
+        poly = shapely.geometry.Polygon(poly_pts)
+        polys.append(poly)
+    mpoly = shapely.geometry.MultiPolygon(polygons=polys)  # assume no holes in poly
+
+    assert sum(len(poly.exterior.coords) for poly in polys) == num_points  # check the points for individual polys sums to total points
+    return mpoly
+
+
+class ShapeBoxReader(object):
+    """
+    Reads the bounding box of a shape in a shapefile, by its index, straight
+    from the .shp file (found through the .shx index) without reading the
+    shape's points.
+    """
+
+    def __init__(self, shape_base_fname):
+        with open(shape_base_fname + '.shx', 'rb') as f:
+            f.seek(SHX_HEADER_SIZE)
+            index = array('i')
+            index.fromstring(f.read())
+        if struct.pack('=i', 1) != struct.pack('>i', 1):
+            index.byteswap()  # .shx is big-endian
+        self._offsets = index[::2]  # in 16-bit words
+        self._shp = open(shape_base_fname + '.shp', 'rb')
+
+    def bbox(self, indx):
+        """
+        Bounding box (min x, min y, max x, max y) of shape `indx`, or None
+        for a null shape.
+        """
+        self._shp.seek(self._offsets[indx] * 2 + SHP_RECORD_HEADER_SIZE)
+        data = self._shp.read(SHP_BBOX.size)
+        if len(data) < SHP_BBOX.size:
+            return None
+        fields = SHP_BBOX.unpack(data)
+        if fields[0] == 0:
+            return None  # null shape
+        return fields[1:]
+
+    def close(self):
+        self._shp.close()
+
+
+def bboxes_intersect(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+class LazyShapeDict(OrderedDict):
+    """
+    A shape dictionary (see `polygon_shaperecords`) whose geometry fields are
+    read from the shapefile when first accessed.
+    """
+
+    def __init__(self, reader, indx):
+        OrderedDict.__init__(self)
+        self._reader = reader
+        self._indx = indx
+
+    def __missing__(self, key):
+        if key not in GEOM_FIELDS:
+            raise KeyError(key)
+        shp = self._reader.shape(self._indx)
+        self['geom_pyshp'] = shp
+        self['geom_shapely'] = shape_to_shapely(shp)
+        return self[key]
+
+
+def polygon_shaperecords(shape_base_fname, record_filter=None, bbox=None, lazy=False):
         """
         A generator for (multi-)polygon shapes from a suite of shapefile data,
         associated with their shape records.
 
         Parameters...
         `shape_base_fname`: Path prefix for the shapefiles.
+        `record_filter`:    Optional. A function taking a shape's record (an
+                            OrderedDict of its fields); only shapes for
+                            which it returns True are read. Applied to the
+                            .dbf attributes before any geometry is read.
+        `bbox`:             Optional. Tuple (min x, min y, max x, max y);
+                            only shapes whose bounding box intersects it
+                            are read. Checked from the .shp bounding box
+                            only (needs the .shx file).
+        `lazy`:             If True, the geometry fields of each dictionary
+                            are only read and converted when first
+                            accessed (they are absent from its keys until
+                            then).
 
         Output...
         This returns a generator. The generator yields dictionaries. Each
         dictionary corresponds to a shape, which includes the shape's
         geometry (assumed to be a polygon or multiplygon) (stored in the .shp
-        file), plus the shape's attributes from the shape record (held in the 
+        file), plus the shape's attributes from the shape record (held in the
         .dbf file).
         A dictionary contains the following two fields for geometry...
             'geom_pyshp'    the geometry directly from pyshp
             'geom_shapely'  a shapely MultiPolygon, which has been
-                            obtained by converting from the pyshp 
+                            obtained by converting from the pyshp
                             representation.
         ..plus the fields of the shaperecord.
         """
         sf = shapefile.Reader(shape_base_fname)
-        fields = sf.fields[1:]
-
-        gIter = sf.iterShapes()
-        rIter = sf.iterRecords()
-
-        while True:
-            try:
-                shp = gIter.next()
-                rec = rIter.next()
-
-                dct = OrderedDict()  # for combined data
-
-                #
-                # pyshp geometry
-                dct['geom_pyshp'] = shp
-
-                #
-                # convert to shapely object
-                if not shp.shapeType == 5:
-                    # 5 => shapefile's "Polygon" type, which may have multiple 'parts':
-                    #     fields = MBR, Number of parts, Number of points, Parts, Points
-                    # i.e., a shapefil Polygon may actually include multiple polygons
-                    # shp.parts: this is a list of indexes, indicating the start of
-                    # a new shape
-                    raise ValueError("Expected shape type 5 (polygon) but found %s" % shp.shapeType)
-
-                num_parts = len(shp.parts)  
-                    # shp.parts gives the indxexes into the flat list of 
-                    # shp.points. these indicate the array slices which 
-                    # correspond to polygons
-                num_points = len(shp.points)
-                polys = []
-                for i in xrange(num_parts):
-                    start_indx = shp.parts[i]
-                    if (i+1) < num_parts:
-                        end_indx = shp.parts[i+1]
-                    else:
-                        end_indx = num_points
-                    poly_pts = shp.points[start_indx:end_indx]
-                    poly = shapely.geometry.Polygon(poly_pts)
-                    polys.append(poly)
-                mpoly = shapely.geometry.MultiPolygon(polygons=polys)  # assume no holes in poly
-                
-                assert sum(len(poly.exterior.coords) for poly in polys) == num_points  # check the points for individual polys sums to total points
-
-                dct['geom_shapely'] = mpoly
+        fieldnames = [fieldtup[0] for fieldtup in sf.fields[1:]]
+        box_reader = ShapeBoxReader(shape_base_fname) if bbox is not None else None
+
+        try:
+            for indx, rec in enumerate(sf.iterRecords()):
+                record = OrderedDict(zip(fieldnames, rec))
+                if record_filter is not None and not record_filter(record):
+                    continue
+                if box_reader is not None:
+                    shape_bbox = box_reader.bbox(indx)
+                    if shape_bbox is None or not bboxes_intersect(shape_bbox, bbox):
+                        continue
+
+                if lazy:
+                    dct = LazyShapeDict(sf, indx)
+                else:
+                    dct = OrderedDict()  # for combined data
+
+                    #
+                    # pyshp geometry
+                    shp = sf.shape(indx)
+                    dct['geom_pyshp'] = shp
+
+                    #
+                    # convert to shapely object
+                    dct['geom_shapely'] = shape_to_shapely(shp)
 
                 #
                 # Finally, the records...
-                for indx, fieldtup in enumerate(fields):
-                    field = fieldtup[0]
-                    dct[field] = rec[indx]
+                dct.update(record)
 
                 yield dct
-            except StopIteration:
-                break
-
+        finally:
+            if box_reader is not None:
+                box_reader.close()
@@ -0,0 +1,174 @@
+"""
+Unit tests for region_index. Run with:
+    python -m unittest discover -p 'test_*.py'
+"""
+
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import shapely.geometry
+from shapely.geometry import Polygon, MultiPolygon, Point
+
+from region_index import RegionIndex, NO_REGION, GRID_BOUNDARY
+
+
+def sample_regions():
+    """
+    Three regions: a square with a hole, a two-part multipolygon and a
+    triangle sitting in the first region's hole.
+    """
+    square = Polygon([(0, 0), (4, 0), (4, 4), (0, 4)],
+                     [[(1, 1), (3, 1), (3, 3), (1, 3)]])
+    islands = MultiPolygon([Polygon([(5, 0), (7, 0), (7, 2), (5, 2)]),
+                            Polygon([(5, 3), (6, 3), (5.5, 4)])])
+    triangle = Polygon([(1.5, 1.5), (2.5, 1.5), (2, 2.5)])
+    return [square, islands, triangle]
+
+
+def expected_region(geoms, lon, lat):
+    point = Point(lon, lat)
+    for region, geom in enumerate(geoms):
+        if geom.contains(point):
+            return region
+    return None
+
+
+def random_points(num_points, seed=0):
+    rng = random.Random(seed)
+    return [(rng.uniform(-1, 8), rng.uniform(-1, 5)) for _ in xrange(num_points)]
+
+
+class RegionIndexLookupTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.geoms = sample_regions()
+        cls.index = RegionIndex(cls.geoms)
+
+    def test_lookup_matches_shapely(self):
+        for lon, lat in random_points(3000):
+            expected = expected_region(self.geoms, lon, lat)
+            self.assertEqual(self.index.lookup(lon, lat), expected, (lon, lat))
+            self.assertEqual(self.index.lookup_exact(lon, lat), expected, (lon, lat))
+
+    def test_lookup_many_matches_lookup(self):
+        points = random_points(3000, seed=1)
+        lons = [lon for lon, _ in points]
+        lats = [lat for _, lat in points]
+        found = self.index.lookup_many(lons, lats)
+        self.assertEqual(len(found), len(points))
+        for (lon, lat), region in zip(points, found):
+            expected = self.index.lookup_exact(lon, lat)
+            self.assertEqual(region, NO_REGION if expected is None else expected)
+
+    def test_hole_and_parts(self):
+        self.assertEqual(self.index.lookup(0.5, 0.5), 0)
+        self.assertEqual(self.index.lookup(1.2, 2.8), None)  # in the hole
+        self.assertEqual(self.index.lookup(2, 1.8), 2)  # in the hole's triangle
+        self.assertEqual(self.index.lookup(6, 1), 1)
+        self.assertEqual(self.index.lookup(5.5, 3.5), 1)
+        self.assertEqual(self.index.lookup(4.5, 1), None)
+
+    def test_outside_bounds(self):
+        self.assertIsNone(self.index.lookup(-10, 2))
+        self.assertIsNone(self.index.lookup_exact(2, 50))
+        self.assertEqual(list(self.index.lookup_many([-10, 100], [2, 2])), [NO_REGION] * 2)
+
+    def test_boundary_not_contained(self):
+        self.assertIsNone(self.index.lookup(4, 2))
+        self.assertIsNone(self.index.lookup(0, 0))
+
+    def test_overlapping_regions(self):
+        geoms = [shapely.geometry.box(0, 0, 2, 2), shapely.geometry.box(1, 1, 3, 3)]
+        index = RegionIndex(geoms, grid_cells=0)
+        self.assertEqual(index.lookup(0.5, 0.5), 0)
+        with self.assertRaises(RuntimeError):
+            index.lookup(1.5, 1.5)
+
+    def test_no_regions(self):
+        index = RegionIndex([])
+        self.assertIsNone(index.lookup(0, 0))
+        self.assertEqual(list(index.lookup_many([0], [0])), [NO_REGION])
+
+    def test_length_mismatch(self):
+        with self.assertRaises(ValueError):
+            self.index.lookup_many([0, 1], [0])
+
+
+class RegionIndexGridTest(unittest.TestCase):
+
+    def test_grid_cells(self):
+        geoms = sample_regions()
+        index = RegionIndex(geoms, grid_cells=4096)
+        grid = index.grid
+        self.assertTrue((grid == GRID_BOUNDARY).any())
+        self.assertTrue((grid == NO_REGION).any())
+        self.assertTrue((grid >= 0).any())
+        # a cell given a region lies wholly inside it
+        min_x, min_y, max_x, max_y = index.arrays['grid_bounds']
+        num_rows, num_cols = grid.shape
+        cell_w = (max_x - min_x) / float(num_cols)
+        cell_h = (max_y - min_y) / float(num_rows)
+        for row in xrange(num_rows):
+            for col in xrange(num_cols):
+                state = grid[row, col]
+                cell = shapely.geometry.box(min_x + col * cell_w, min_y + row * cell_h,
+                                            min_x + (col + 1) * cell_w, min_y + (row + 1) * cell_h)
+                if state >= 0:
+                    self.assertTrue(geoms[state].contains(cell), (row, col))
+                elif state == NO_REGION:
+                    # may touch a region's boundary, but not its interior
+                    self.assertFalse(any(geom.relate_pattern(cell, 'T********') for geom in geoms),
+                                     (row, col))
+
+    def test_without_grid(self):
+        geoms = sample_regions()
+        gridded = RegionIndex(geoms, grid_cells=256)
+        plain = RegionIndex(geoms, grid_cells=0)
+        self.assertIsNone(plain.grid)
+        points = random_points(2000, seed=2)
+        for lon, lat in points:
+            self.assertEqual(plain.lookup(lon, lat), gridded.lookup(lon, lat))
+        lons = [lon for lon, _ in points]
+        lats = [lat for _, lat in points]
+        self.assertTrue((plain.lookup_many(lons, lats) == gridded.lookup_many(lons, lats)).all())
+
+
+class RegionIndexSaveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.fpath = os.path.join(self.dirpath, 'index.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def test_round_trip(self):
+        index = RegionIndex(sample_regions(), grid_cells=1024)
+        index.save(self.fpath, {'checksum': 'abc'})
+        loaded, meta = RegionIndex.load(self.fpath)
+        self.assertEqual(meta, {'checksum': 'abc'})
+        self.assertEqual(loaded.num_regions, 3)
+        self.assertEqual(loaded.bounds, index.bounds)
+        self.assertTrue((loaded.grid == index.grid).all())
+        self.assertTrue(loaded.region_geom(1).equals(index.region_geom(1)))
+        for lon, lat in random_points(500):
+            self.assertEqual(loaded.lookup(lon, lat), index.lookup(lon, lat))
+
+    def test_missing_or_damaged(self):
+        self.assertIsNone(RegionIndex.load(self.fpath))
+        RegionIndex(sample_regions()).save(self.fpath)
+        with open(self.fpath, 'r+b') as f:
+            f.truncate(os.path.getsize(self.fpath) // 2)
+        self.assertIsNone(RegionIndex.load(self.fpath))
+        with open(self.fpath, 'wb') as f:
+            f.write('not an index')
+        self.assertIsNone(RegionIndex.load(self.fpath))
+
+
+if __name__ == '__main__':
+    unittest.main()
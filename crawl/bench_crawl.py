@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+# Author:   Matt J Williams
+#           http://www.mattjw.net
+#           mattjw@mattjw.net
+# Date:     2015
+# License:  MIT License
+#           http://opensource.org/licenses/MIT
+
+
+"""
+Benchmark crawl throughput against a local Meetup API simulator (see
+`meetup_simulator.py`), so that changes to the crawler can be measured
+without the live API.
+
+Runs the pipeline -- `crawl_groups.py`, `collect_city_groups.py` and
+`crawl_group_activity.py` -- in a scratch directory, on the simulator's
+cities, and reports each stage's wall time and the requests per second
+served. The activity crawl needs a local mongod; a scratch database is used
+and dropped afterwards. Output from the stages is written to `crawl.log` in
+the scratch directory.
+
+Usage:
+    python bench_crawl.py [--latency 0.05] [--rate-limit 30] [--workers 8] ...
+"""
+
+
+__author__ = "Matt J Williams"
+__author_email__ = "mattjw@mattjw.net"
+__license__ = "MIT"
+__copyright__ = "Copyright (c) 2015 Matt J Williams"
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import pymongo
+
+import crawl_tools
+import crawl_groups
+import collect_city_groups
+import crawl_group_activity
+import meetup_simulator
+
+
+BENCH_DBNAME = 'meetupdotcom_bench'
+BENCH_API_KEY = 'bench'
+
+
+def prepare_workdir(workdir, server, corpus, args):
+    """
+    Lay out the config file and input data that the crawl scripts expect
+    in their working directory.
+    """
+    for dname in ['dat', 'dat/groups_crawl', 'dat/city_meetup_groups']:
+        os.makedirs(os.path.join(workdir, dname))
+
+    config = {'meetup_api_key': BENCH_API_KEY,
+              'meetup_api_url': server.base_url,
+              'mongo_host': args.host, 'mongo_port': args.port,
+              'mongo_dbname': BENCH_DBNAME,
+              'num_workers': args.workers,
+              'metrics_dir': 'dat/metrics'}
+    with open(os.path.join(workdir, crawl_tools.CONFIG_FPATH), 'w') as f:
+        json.dump(config, f, indent=2)
+
+    # crawl_groups.py skips gb and ie
+    countries2cities = {'us': corpus.geonames_cities(), 'gb': [], 'ie': []}
+    with open(os.path.join(workdir, 'dat/geonames_top_cities_filtered.json'), 'w') as f:
+        json.dump(countries2cities, f)
+
+
+def run_stage(func, simulator, log):
+    """
+    Run the crawl stage `func`, with its output sent to file `log`.
+
+    Returns tuple (wall time, requests served).
+    """
+    num_requests = simulator.num_requests()
+    stdout = sys.stdout
+    sys.stdout = log
+    t_start = time.time()
+    try:
+        func()
+    finally:
+        elapsed = time.time() - t_start
+        sys.stdout = stdout
+    return elapsed, simulator.num_requests() - num_requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Crawl throughput benchmark")
+    parser.add_argument('--host', default='localhost', help="mongod host")
+    parser.add_argument('--port', type=int, default=27017, help="mongod port")
+    parser.add_argument('--workers', type=int, default=crawl_tools.DEFAULT_NUM_WORKERS,
+                        help="crawl threads (see crawl_tools.ConcurrentAltMeetup)")
+    parser.add_argument('--keep', action='store_true',
+                        help="keep the scratch directory and database")
+    meetup_simulator.add_simulator_arguments(parser)
+    args = parser.parse_args()
+
+    simulator = meetup_simulator.simulator_from_args(args)
+    corpus = simulator.corpus
+    server = meetup_simulator.start_server(simulator, port=0)
+    print "simulator: %s | %d groups | %d users | %d events | latency %.3fs | %d requests per %gs" % (
+        server.base_url, len(corpus.groups), len(corpus.users), len(corpus.events),
+        args.latency, args.rate_limit, args.rate_window)
+
+    mclient = pymongo.mongo_client.MongoClient(args.host, args.port)
+    mclient.drop_database(BENCH_DBNAME)
+
+    workdir = tempfile.mkdtemp(prefix='bench_crawl_')
+    prepare_workdir(workdir, server, corpus, args)
+
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    sys.argv = [sys.argv[0]]  # the stages parse their own arguments
+    stages = [('crawl_groups', crawl_groups.main),
+              ('collect_city_groups', collect_city_groups.main),
+              ('crawl_group_activity', crawl_group_activity.main)]
+
+    print
+    print "%-22s %10s %10s %10s" % ('stage', 'wall (s)', 'requests', 'req/s')
+    total_elapsed = 0.0
+    total_requests = 0
+    try:
+        with open('crawl.log', 'w') as log:
+            for name, func in stages:
+                elapsed, num_requests = run_stage(func, simulator, log)
+                total_elapsed += elapsed
+                total_requests += num_requests
+                print "%-22s %10.2f %10d %10.1f" % (name, elapsed, num_requests,
+                                                    num_requests / max(elapsed, 1e-9))
+        print "%-22s %10.2f %10d %10.1f" % ('total', total_elapsed, total_requests,
+                                            total_requests / max(total_elapsed, 1e-9))
+        print
+        print "requests:", sorted(simulator.stats()['requests'].items())
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+        if args.keep:
+            print "scratch directory:", workdir
+        else:
+            shutil.rmtree(workdir)
+            mclient.drop_database(BENCH_DBNAME)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+#
+# Author:   Matt J Williams
+#           http://www.mattjw.net
+#           mattjw@mattjw.net
+# Date:     2015
+# License:  MIT License
+#           http://opensource.org/licenses/MIT
+
+
+"""
+Benchmark Mongo write throughput for the crawl's storage patterns, against a
+local mongod. Compares the original per-document check-then-insert with the
+batched writes in `storage_tools`.
+
+Synthetic member documents are written in pages of 200 (one API page), with
+a share of the documents already stored, as happens when members belong to
+several groups. A scratch database is used and dropped afterwards.
+
+Usage:
+    python bench_storage.py [--host localhost] [--port 27017] [--num-docs 20000]
+"""
+
+
+__author__ = "Matt J Williams"
+__author_email__ = "mattjw@mattjw.net"
+__license__ = "MIT"
+__copyright__ = "Copyright (c) 2015 Matt J Williams"
+
+
+import argparse
+import random
+import time
+
+import pymongo
+
+import storage_tools
+
+
+BENCH_DBNAME = 'meetupdotcom_bench'
+PAGE_SIZE = 200
+
+
+def synthetic_users(num_docs, dup_fraction, seed=0):
+    """
+    Generate `num_docs` member documents; roughly `dup_fraction` of them
+    repeat an earlier ID.
+    """
+    rng = random.Random(seed)
+    docs = []
+    next_id = 1
+    for _ in xrange(num_docs):
+        if docs and rng.random() < dup_fraction:
+            uid = rng.randint(1, next_id - 1)
+        else:
+            uid = next_id
+            next_id += 1
+        user = {'id': uid, 'name': 'member %d' % uid, 'city': 'Cardiff',
+                'country': 'gb', 'lat': 51.48, 'lon': -3.18,
+                'joined': 1400000000000 + uid, 'status': 'active'}
+        docs.append(storage_tools.as_document(user, uid))
+    return docs
+
+
+def pages(docs):
+    for i in xrange(0, len(docs), PAGE_SIZE):
+        yield docs[i:i + PAGE_SIZE]
+
+
+def write_check_then_insert(coll, docs):
+    """
+    The original pattern: `find_one` then `insert_one`, per document.
+    """
+    for page in pages(docs):
+        for doc in page:
+            if coll.find_one({'_id': doc['_id']}) is None:
+                coll.insert_one(doc)
+
+
+def write_insert_new(coll, docs):
+    for page in pages(docs):
+        storage_tools.insert_new(coll, page)
+
+
+def write_upsert_many(coll, docs):
+    for page in pages(docs):
+        storage_tools.upsert_many(coll, page)
+
+
+STRATEGIES = [
+    ('check-then-insert', write_check_then_insert),
+    ('insert_new (batched)', write_insert_new),
+    ('upsert_many (batched)', write_upsert_many),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mongo write throughput benchmark")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=27017)
+    parser.add_argument('--num-docs', type=int, default=20000)
+    parser.add_argument('--dup-fraction', type=float, default=0.3)
+    args = parser.parse_args()
+
+    mclient = pymongo.mongo_client.MongoClient(args.host, args.port,
+        maxPoolSize=storage_tools.MONGO_POOL_SIZE)
+    docs = synthetic_users(args.num_docs, args.dup_fraction)
+    num_unique = len(frozenset(doc['_id'] for doc in docs))
+
+    print "%d documents (%d unique), pages of %d" % (len(docs), num_unique, PAGE_SIZE)
+    print
+    try:
+        for name, write in STRATEGIES:
+            mclient.drop_database(BENCH_DBNAME)
+            coll = mclient[BENCH_DBNAME][storage_tools.COLL_USERS]
+
+            t_start = time.time()
+            write(coll, [dict(doc) for doc in docs])
+            elapsed = time.time() - t_start
+
+            assert coll.count() == num_unique
+            print "%-24s  %8.2f s  %10.0f docs/s" % (name, elapsed, len(docs) / elapsed)
+    finally:
+        mclient.drop_database(BENCH_DBNAME)
+
+
+if __name__ == "__main__":
+    main()
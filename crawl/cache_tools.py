@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+#
+# Author:   Matt J Williams
+#           http://www.mattjw.net
+#           mattjw@mattjw.net
+# Date:     2015
+# License:  MIT License
+#           http://opensource.org/licenses/MIT
+
+
+"""
+On-disk cache of Meetup API responses.
+
+Each response is stored as a JSON file named by the SHA-1 of its normalised
+URL: the query string is sorted and stripped of credentials (`key`, `sig`,
+`sig_id`), so re-runs with another API key still hit the cache. The URLs
+in a stored response's 'meta' are stripped of credentials too.
+"""
+
+
+__author__ = "Matt J Williams"
+__author_email__ = "mattjw@mattjw.net"
+__license__ = "MIT"
+__copyright__ = "Copyright (c) 2015 Matt J Williams"
+
+
+import os
+import json
+import time
+import hashlib
+import threading
+import urllib
+import urlparse
+
+
+DAY = 24 * 60 * 60
+
+CREDENTIAL_PARAMS = frozenset(['key', 'sig', 'sig_id'])
+
+DEFAULT_TTLS = {
+    # seconds; None => never expires
+    'cities': 30 * DAY,
+    'groups': 7 * DAY,
+    'members': 7 * DAY,
+    'events': 30 * DAY,  # crawled for past windows; rarely changes
+    'rsvps': 30 * DAY,
+}
+DEFAULT_TTL = 1 * DAY  # for any endpoint not in DEFAULT_TTLS
+
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+
+class CacheMissError(LookupError):
+    """
+    Raised in replay-only mode when a response is not in the cache.
+    """
+
+
+def strip_credentials(url, sort_params=False):
+    """
+    `url` with its credential parameters (`CREDENTIAL_PARAMS`) removed, and
+    the remaining GET parameters sorted if `sort_params`.
+    """
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')  # e.g., 'meta.next' from decoded JSON
+    parts = urlparse.urlsplit(url)
+    params = urlparse.parse_qsl(parts.query, keep_blank_values=True)
+    params = [(k, v) for k, v in params if k not in CREDENTIAL_PARAMS]
+    if sort_params:
+        params.sort()
+    query = urllib.urlencode(params)
+    return urlparse.urlunsplit((parts.scheme, parts.netloc, parts.path, query, ''))
+
+
+def normalise_url(url):
+    """
+    Normalise `url` to its cache key form. Credentials are removed and GET
+    parameters are sorted.
+    """
+    return strip_credentials(url, sort_params=True)
+
+
+def strip_response_credentials(response):
+    """
+    Copy of `response` (decoded JSON) with credentials removed from the URLs
+    in its 'meta' ('next', 'prev' and 'url'), which the API returns with the
+    caller's key in them.
+    """
+    meta = response.get('meta')
+    if not isinstance(meta, dict):
+        return response
+    meta = dict(meta)
+    for field in ['next', 'prev', 'url']:
+        if meta.get(field):
+            meta[field] = strip_credentials(meta[field])
+    response = dict(response)
+    response['meta'] = meta
+    return response
+
+
+def url_endpoint(url):
+    """
+    The API endpoint of `url`, e.g. 'members' for '.../2/members?...'.
+    """
+    path = urlparse.urlsplit(url).path
+    return path.rstrip('/').split('/')[-1]
+
+
+class ResponseCache(object):
+    """
+    Content-addressed cache of API responses in directory `cache_dir`.
+
+    `ttls`: dict mapping endpoint name to time-to-live in seconds (None for
+        no expiry). Defaults to `DEFAULT_TTLS`.
+    `max_bytes`: size cap for the cache directory. Least recently used
+        entries are evicted once it is exceeded.
+    `replay_only`: if True, responses are only ever served from the cache,
+        regardless of age; a miss raises `CacheMissError` rather than falling
+        through to the network.
+
+    Thread-safe.
+    """
+
+    def __init__(self, cache_dir, ttls=None, max_bytes=DEFAULT_MAX_BYTES,
+                 replay_only=False):
+        self.cache_dir = cache_dir
+        self.ttls = dict(DEFAULT_TTLS if ttls is None else ttls)
+        self.max_bytes = max_bytes
+        self.replay_only = replay_only
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._entries = {}  # path -> [size in bytes, last used (epoch secs)]
+        self._total_bytes = 0
+        self._scan()
+
+    def _scan(self):
+        """
+        Index the entries already on disk.
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        for dirpath, _, fnames in os.walk(self.cache_dir):
+            for fname in fnames:
+                if not fname.endswith('.json'):
+                    continue
+                fpath = os.path.join(dirpath, fname)
+                st = os.stat(fpath)
+                self._entries[fpath] = [st.st_size, st.st_mtime]
+                self._total_bytes += st.st_size
+
+    def _path(self, url):
+        digest = hashlib.sha1(normalise_url(url)).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + '.json')
+
+    def _ttl(self, url):
+        return self.ttls.get(url_endpoint(url), DEFAULT_TTL)
+
+    def get(self, url):
+        """
+        Return the cached response for `url`, or None if it is absent or has
+        expired. In replay-only mode, a miss raises `CacheMissError`.
+        """
+        fpath = self._path(url)
+        try:
+            with open(fpath) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            entry = None  # absent, or evicted meanwhile
+
+        if entry is not None and not self.replay_only:
+            ttl = self._ttl(url)
+            if ttl is not None and time.time() - entry['fetched'] > ttl:
+                entry = None
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                now = time.time()
+                if fpath in self._entries:
+                    self._entries[fpath][1] = now
+                try:
+                    os.utime(fpath, (now, now))  # persist recency for LRU
+                    if fpath not in self._entries:
+                        # written by another process
+                        size = os.path.getsize(fpath)
+                        self._entries[fpath] = [size, now]
+                        self._total_bytes += size
+                except OSError:
+                    pass  # evicted by another process
+
+        if entry is None:
+            if self.replay_only:
+                raise CacheMissError(normalise_url(url))
+            return None
+        return entry['response']
+
+    def put(self, url, response):
+        """
+        Store `response` (decoded JSON) for `url`, evicting old entries if
+        the cache is over its size cap. No-op in replay-only mode.
+        """
+        if self.replay_only:
+            return
+        fpath = self._path(url)
+        entry = {'url': normalise_url(url), 'fetched': time.time(),
+                 'response': strip_response_credentials(response)}
+        data = json.dumps(entry)
+
+        fdir = os.path.dirname(fpath)
+        if not os.path.isdir(fdir):
+            try:
+                os.makedirs(fdir)
+            except OSError:
+                pass  # created by another thread
+
+        # write-then-rename, so readers never see a partial entry
+        tmp_fpath = '%s.%s.tmp' % (fpath, threading.current_thread().ident)
+        with open(tmp_fpath, 'w') as f:
+            f.write(data)
+        os.rename(tmp_fpath, fpath)
+
+        with self._lock:
+            if fpath in self._entries:
+                self._total_bytes -= self._entries[fpath][0]
+            self._entries[fpath] = [len(data), time.time()]
+            self._total_bytes += len(data)
+            self._evict()
+
+    def _evict(self):
+        """
+        Drop least recently used entries until within `max_bytes`. Caller
+        holds the lock.
+        """
+        if self._total_bytes <= self.max_bytes:
+            return
+        by_recency = sorted(self._entries.iteritems(), key=lambda item: item[1][1])
+        for fpath, (size, _) in by_recency:
+            if self._total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(fpath)
+            except OSError:
+                pass
+            del self._entries[fpath]
+            self._total_bytes -= size
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self._entries), 'bytes': self._total_bytes}
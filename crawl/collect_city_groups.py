@@ -11,6 +11,15 @@
 """
 Collect groups generated by `crawl_groups.py`. Groups are collected according to
 their contituent meetups city.
+
+The crawl files are read incrementally, one crawl record at a time, and each
+group is written out as soon as it is first seen. A group found by several
+queries, in any city or country, is kept only once. Memory use is thus
+bounded by the largest crawl record plus the index of group IDs seen.
+
+Output is one newline-delimited JSON file per country, each line a record
+{"city": <meetups city>, "group": <group>}. A meetups city is identified as
+the string: 'country:state:city'. See `load_city_groups`.
 """
 
 
@@ -20,101 +29,181 @@ __license__ = "MIT"
 __copyright__ = "Copyright (c) 2015 Matt J Williams"
 
 
-from pprint import pprint
+import os
 import json
 from collections import OrderedDict, defaultdict
-import os
 
-import crawl_tools
+from idset_tools import IntIdSet
 
 
+CRAWL_DIR = './dat/groups_crawl'
 OUT_DIR = './dat/city_meetup_groups'
+OUT_EXT = '.ndjson'
+LEGACY_OUT_EXT = '.json'  # output from before it was newline-delimited
+READ_CHUNK_SIZE = 1 << 16  # bytes
 
 
-def load_group_crawls():
+def iter_json_array(f, chunk_size=READ_CHUNK_SIZE):
     """
-    Load output from `crawl_groups.py`.
+    Generator over the items of the JSON array in file `f`, parsed
+    incrementally rather than loading the whole file. Items must be JSON
+    objects, arrays or strings (so that a truncated item fails to parse).
     """
-    fdir = './dat/groups_crawl'
-    country2citycrawls = {}
-    for fname in os.listdir(fdir):
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    started = False
+    while True:
+        # skip whitespace and separators
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buf):
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError("expected a JSON array")
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+            else:
+                yield item
+                pos = end
+                continue
+        elif eof:
+            raise ValueError("unexpected end of JSON array")
+
+        # need more data; grow the read as items grow
+        data = f.read(max(chunk_size, len(buf) - pos))
+        buf = buf[pos:] + data
+        pos = 0
+        eof = not data
+
+
+def iter_group_crawls(fdir=CRAWL_DIR):
+    """
+    Generator over the output of `crawl_groups.py`: tuples (country code,
+    crawl record), streamed one record at a time.
+    """
+    for fname in sorted(os.listdir(fdir)):
         if not fname.endswith('json'):
             continue
 
         fpath = os.path.join(fdir, fname)
         country = fname.split('.')[0]
         with open(fpath) as f:
-            country2citycrawls[country] = json.load(f)
-    return country2citycrawls
+            for city_crawl in iter_json_array(f):
+                yield country, city_crawl
 
 
-def discard_duplicates(seq, key_func):
+def city_ident(group):
     """
-    Discard any duplicates in`seq`. `key_func` is a function that assigns
-    an item in `seq` to a key. Order is retained.
+    The meetups city of `group`: 'country:state:city'.
     """
-    d = OrderedDict()
-    for item in seq:
-        key = key_func(item)
-        if key not in d:
-            d[key] = item
-    return d.values()
+    return '%s:%s:%s' % (group['country'], group.get('state', ''), group['city'])
 
 
-def collect_crawls(country_code, crawls):
+class CityGroupWriter(object):
+    """
+    Writes collected groups, one newline-delimited record each, to a file
+    per country in `out_dir`. Files are written under a temporary name and
+    moved into place by `close`.
     """
-    Collect groups into their corresponding (meetup) cities. Removes duplicate
-    groups in the same meetup city. Discards any cities that do not belong to
-    `country_code`.
 
-    `crawls`: The group crawls for one country. List of dicts. Each dict
-    represents a crawl of groups in one geonames location (see
-    `crawl_groups.py`).
+    def __init__(self, out_dir=OUT_DIR):
+        self.out_dir = out_dir
+        self.city_counts = defaultdict(lambda: defaultdict(int))  # country -> city -> groups
+        self._files = {}  # country -> open file
+
+    def fpath(self, country_code):
+        return os.path.join(self.out_dir, country_code + OUT_EXT)
 
-    Returns:
-    Dict that maps from a (meetups) city to a list of groups in that city.
-    A meetups city is identified as the string: 'country:state:city'
+    def write(self, country_code, city, group):
+        f = self._files.get(country_code)
+        if f is None:
+            f = self._files[country_code] = open(self.fpath(country_code) + '.tmp', 'w')
+        f.write(json.dumps({'city': city, 'group': group}))
+        f.write('\n')
+        self.city_counts[country_code][city] += 1
+
+    def close(self):
+        for country_code, f in self._files.iteritems():
+            f.close()
+            os.rename(f.name, self.fpath(country_code))
+        self._files = {}
+
+
+def collect_crawls(crawls, writer):
+    """
+    Collect groups into their corresponding (meetup) cities, writing each
+    group to `writer` (a `CityGroupWriter`) the first time it is seen.
+    Groups in cities that do not belong to the country crawled are
+    discarded.
+
+    `crawls`: Sequence of tuples (country code, crawl record), as from
+    `iter_group_crawls`. Each crawl record holds the groups found by one
+    query (see `crawl_groups.py`) in 'results'.
+
+    Returns tuple (number of groups written, number of duplicates skipped).
     """
-    # bucketise by meetup city ident
-    city2groups = defaultdict(lambda: [])
-    for city_crawl in crawls:
-        groups_seq = city_crawl['results']
-        for group in groups_seq:
-            mu_city = group['city']
-            mu_state = group.get('state', '')
-            mu_country = group['country']
-            if mu_country.lower() != country_code.lower():
+    seen = IntIdSet()
+    num_written = 0
+    num_dups = 0
+    for country_code, city_crawl in crawls:
+        for group in city_crawl['results']:
+            if group['country'].lower() != country_code.lower():
                 continue
-            city_ident = '%s:%s:%s' % (mu_country, mu_state, mu_city)
-            city2groups[city_ident].append(group)
-
-    # discard duplicates
-    for city_ident in city2groups:
-        seq = city2groups[city_ident]
-        seq = discard_duplicates(seq, lambda item: item['id'])
-        city2groups[city_ident] = seq
-    
-    # sort each city by number of groups
+            if group['id'] in seen:
+                num_dups += 1
+                continue
+            seen.add(group['id'])
+            writer.write(country_code, city_ident(group), group)
+            num_written += 1
+    return num_written, num_dups
+
+
+def load_city_groups(fpath):
+    """
+    Load a country's collected groups from `fpath`. Returns dict that maps
+    from a (meetups) city to a list of groups in that city, with cities
+    ordered by number of groups.
+
+    Files from before output was newline-delimited (a single JSON dict)
+    are also accepted.
+    """
+    with open(fpath) as f:
+        if fpath.endswith(LEGACY_OUT_EXT):
+            return json.load(f, object_pairs_hook=OrderedDict)
+        city2groups = defaultdict(list)
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                city2groups[record['city']].append(record['group'])
     items = city2groups.items()
     items.sort(key=lambda item: len(item[1]))
-    city2groups = OrderedDict(items)
-    return city2groups
+    return OrderedDict(items)
 
 
 def main():
-    country2citycrawls = load_group_crawls()
-    for country_code, citycrawls in country2citycrawls.iteritems():
-        city2groups = collect_crawls(country_code, citycrawls)
-
-        for ident, groups in city2groups.iteritems():
-            print "%-20s %d" % (ident, len(groups))
-
-        fpath = os.path.join(OUT_DIR, "%s.json" % country_code)
-        with open(fpath, 'w') as f:
-            json.dump(city2groups, f)
-            print
-            print "saved to", fpath
-            print
+    writer = CityGroupWriter()
+    try:
+        num_written, num_dups = collect_crawls(iter_group_crawls(), writer)
+    finally:
+        writer.close()
+
+    for country_code, city2count in sorted(writer.city_counts.iteritems()):
+        for ident, count in sorted(city2count.iteritems(), key=lambda item: item[1]):
+            print "%-20s %d" % (ident, count)
+        print
+        print "saved to", writer.fpath(country_code)
+        print
+    print "%d groups | %d duplicates discarded" % (num_written, num_dups)
 
 
 if __name__ == "__main__":
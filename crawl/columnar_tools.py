@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+#
+# Author:   Matt J Williams
+#           http://www.mattjw.net
+#           mattjw@mattjw.net
+# Date:     2015
+# License:  MIT License
+#           http://opensource.org/licenses/MIT
+
+
+"""
+Columnar on-disk tables, so that a reader can load only the columns it
+needs, without parsing the rest.
+
+A table is a directory holding one file per column, plus `_schema.json`
+(column names and types, and the number of rows). Column types:
+
+    int64, int32:   Packed native-endian integers. Missing values are stored
+                    as `INT64_NULL` / `INT32_NULL`.
+    float64:        Packed native-endian doubles. Missing values are NaN.
+    string:         Dictionary-encoded: an int32 code per row (`NULL_CODE`
+                    if missing) in `<name>.bin`, and the distinct strings in
+                    `<name>.dict` (int64 offsets into a utf-8 blob).
+
+The schema is written last, so a table without one is incomplete.
+
+Columns are read through memory maps. If numpy is installed, numeric
+columns are returned as numpy arrays backed directly by the map; otherwise
+they are copied into `array.array`s.
+"""
+
+
+__author__ = "Matt J Williams"
+__author_email__ = "mattjw@mattjw.net"
+__license__ = "MIT"
+__copyright__ = "Copyright (c) 2015 Matt J Williams"
+
+
+import os
+import sys
+import json
+import mmap
+from array import array
+try:
+    import numpy
+except ImportError:
+    numpy = None  # columns are read as array.array instead
+
+
+FORMAT_VERSION = 1
+SCHEMA_FNAME = '_schema.json'
+
+INT64 = 'int64'
+INT32 = 'int32'
+FLOAT64 = 'float64'
+STRING = 'string'
+
+INT64_NULL = -(1 << 63)
+INT32_NULL = -(1 << 31)
+NULL_CODE = -1  # code of a missing string
+
+DEFAULT_FLUSH_ROWS = 1 << 16  # rows buffered per column before writing
+
+
+def _int64_typecode():
+    for typecode in ['l', 'q']:
+        try:
+            if array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+    raise RuntimeError("no 8-byte integer array type")
+
+
+TYPECODES = {INT64: _int64_typecode(), INT32: 'i', FLOAT64: 'd', STRING: 'i'}
+NUMPY_DTYPES = {INT64: 'int64', INT32: 'int32', FLOAT64: 'float64', STRING: 'int32'}
+NULLS = {INT64: INT64_NULL, INT32: INT32_NULL, FLOAT64: float('nan'), STRING: NULL_CODE}
+
+
+def _write_strings(fpath, strings):
+    """
+    Write `strings` (unicode) as an int64 count, int64 offsets and a utf-8
+    blob.
+    """
+    typecode = TYPECODES[INT64]
+    blobs = [s.encode('utf-8') for s in strings]
+    offsets = array(typecode, [0])
+    total = 0
+    for blob in blobs:
+        total += len(blob)
+        offsets.append(total)
+    with open(fpath, 'wb') as f:
+        array(typecode, [len(blobs)]).tofile(f)
+        offsets.tofile(f)
+        f.write(''.join(blobs))
+
+
+def _read_strings(fpath):
+    typecode = TYPECODES[INT64]
+    with open(fpath, 'rb') as f:
+        count = array(typecode)
+        count.fromfile(f, 1)
+        offsets = array(typecode)
+        offsets.fromfile(f, count[0] + 1)
+        blob = f.read()
+    return [blob[offsets[i]:offsets[i + 1]].decode('utf-8') for i in xrange(count[0])]
+
+
+class TableWriter(object):
+    """
+    Writes a table to directory `dirpath`, row by row. `columns` is a list of
+    tuples (name, type). Use as a context manager, or call `close` to finish
+    the table.
+    """
+
+    def __init__(self, dirpath, columns, flush_rows=DEFAULT_FLUSH_ROWS):
+        self.dirpath = dirpath
+        self.columns = list(columns)
+        self.flush_rows = flush_rows
+        self.num_rows = 0
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        schema_fpath = os.path.join(dirpath, SCHEMA_FNAME)
+        if os.path.exists(schema_fpath):
+            os.remove(schema_fpath)
+
+        self._files = {}
+        self._bufs = {}
+        self._dicts = {}  # string column -> {string: code}
+        for name, kind in self.columns:
+            if kind not in TYPECODES:
+                raise ValueError("unknown column type %s" % kind)
+            self._files[name] = open(os.path.join(dirpath, name + '.bin'), 'wb')
+            self._bufs[name] = array(TYPECODES[kind])
+            if kind == STRING:
+                self._dicts[name] = {}
+
+    def append(self, row):
+        """
+        Add a row: a dict mapping column name to value. Absent columns and
+        None values are stored as missing. Values are converted to their
+        column's type (e.g., a number in a string column is stored as its
+        text).
+        """
+        for name, kind in self.columns:
+            value = row.get(name)
+            if value is None:
+                value = NULLS[kind]
+            elif kind == STRING:
+                if isinstance(value, str):
+                    value = value.decode('utf-8')
+                elif not isinstance(value, unicode):
+                    value = unicode(value)
+                codes = self._dicts[name]
+                code = codes.get(value)
+                if code is None:
+                    code = codes[value] = len(codes)
+                value = code
+            elif kind == FLOAT64:
+                value = float(value)
+            else:
+                value = int(value)
+            self._bufs[name].append(value)
+        self.num_rows += 1
+        if self.num_rows % self.flush_rows == 0:
+            self.flush()
+
+    def flush(self):
+        for name, buf in self._bufs.iteritems():
+            buf.tofile(self._files[name])
+            del buf[:]
+
+    def close(self):
+        self.flush()
+        for f in self._files.itervalues():
+            f.close()
+        for name, codes in self._dicts.iteritems():
+            strings = [None] * len(codes)
+            for value, code in codes.iteritems():
+                strings[code] = value
+            _write_strings(os.path.join(self.dirpath, name + '.dict'), strings)
+        schema = {'version': FORMAT_VERSION, 'num_rows': self.num_rows,
+                  'byteorder': sys.byteorder,
+                  'columns': [{'name': name, 'type': kind} for name, kind in self.columns]}
+        with open(os.path.join(self.dirpath, SCHEMA_FNAME), 'w') as f:
+            json.dump(schema, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            for f in self._files.itervalues():
+                f.close()
+        return False
+
+
+class StringColumn(object):
+    """
+    A dictionary-encoded string column: `codes` (one per row) and `values`
+    (the distinct strings). Indexing decodes a row's string.
+    """
+
+    def __init__(self, codes, values):
+        self.codes = codes
+        self.values = values
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        code = self.codes[i]
+        return None if code == NULL_CODE else self.values[code]
+
+    def __iter__(self):
+        values = self.values
+        for code in self.codes:
+            yield None if code == NULL_CODE else values[code]
+
+    def code_of(self, value):
+        """
+        Code of string `value`, or None if it does not occur. Rows may then
+        be matched by comparing codes, without decoding.
+        """
+        try:
+            return self.values.index(value)
+        except ValueError:
+            return None
+
+
+class TableReader(object):
+    """
+    Reads a table written by `TableWriter` from directory `dirpath`. Only
+    the columns asked for are read.
+    """
+
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+        schema_fpath = os.path.join(dirpath, SCHEMA_FNAME)
+        if not os.path.exists(schema_fpath):
+            raise IOError("no complete table at %s" % dirpath)
+        with open(schema_fpath) as f:
+            schema = json.load(f)
+        if schema['version'] != FORMAT_VERSION:
+            raise ValueError("unsupported table version %s" % schema['version'])
+        if schema['byteorder'] != sys.byteorder:
+            raise ValueError("table written with %s-endian byte order" % schema['byteorder'])
+        self.num_rows = schema['num_rows']
+        self.types = dict((col['name'], col['type']) for col in schema['columns'])
+        self.column_names = [col['name'] for col in schema['columns']]
+        self._maps = []
+
+    def __len__(self):
+        return self.num_rows
+
+    def _read_numeric(self, name, kind):
+        fpath = os.path.join(self.dirpath, name + '.bin')
+        typecode = TYPECODES[kind]
+        if self.num_rows == 0:
+            return numpy.zeros(0, NUMPY_DTYPES[kind]) if numpy is not None else array(typecode)
+        with open(fpath, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if numpy is not None:
+            self._maps.append(mm)
+            return numpy.frombuffer(mm, dtype=NUMPY_DTYPES[kind], count=self.num_rows)
+        try:
+            out = array(typecode)
+            out.fromstring(mm[:self.num_rows * out.itemsize])
+            return out
+        finally:
+            mm.close()
+
+    def column(self, name):
+        """
+        Column `name`: an array for numeric columns, or a `StringColumn`.
+        """
+        if name not in self.types:
+            raise KeyError("no column %s in %s" % (name, self.dirpath))
+        kind = self.types[name]
+        data = self._read_numeric(name, kind)
+        if kind == STRING:
+            return StringColumn(data, _read_strings(os.path.join(self.dirpath, name + '.dict')))
+        return data
+
+    def columns(self, names):
+        """
+        Dict mapping each of column names `names` to its column.
+        """
+        return dict((name, self.column(name)) for name in names)
+
+    def iter_rows(self, names=None):
+        """
+        Generator over rows as dicts of the columns `names` (default: all),
+        with missing values as None.
+        """
+        if names is None:
+            names = self.column_names
+        cols = [(name, self.column(name), self.types[name]) for name in names]
+        for i in xrange(self.num_rows):
+            row = {}
+            for name, col, kind in cols:
+                value = col[i]
+                if kind == FLOAT64:
+                    value = None if value != value else float(value)
+                elif kind in (INT64, INT32):
+                    value = None if value == NULLS[kind] else int(value)
+                row[name] = value
+            yield row
+
+    def close(self):
+        """
+        Release memory maps held by numpy columns. Columns already returned
+        must not be used afterwards.
+        """
+        for mm in self._maps:
+            mm.close()
+        self._maps = []
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+#
+# Author:   Matt J Williams
+#           http://www.mattjw.net
+#           mattjw@mattjw.net
+# Date:     2015
+# License:  MIT License
+#           http://opensource.org/licenses/MIT
+
+
+"""
+Planning of proximity queries. The proximity crawl searches for groups within
+a radius of each gazetteer city; nearby cities' circles overlap heavily, so
+many queries return the same groups. `CoveragePlanner` instead computes a
+small set of query circles (possibly of a larger radius) whose union covers
+every city's circle, by greedy set cover, and can re-plan any one of those
+circles with smaller circles if it turns out to hold too many groups.
+
+Coverage is checked on sample points: each city's circle is divided into
+pieces (the cells of a grid of spacing `spacing` that meet the circle). A
+piece is covered by a query circle that contains the whole cell, or that
+contains the city's whole circle. So the plan covers at least the area of
+the cities' circles.
+"""
+
+
+__author__ = "Matt J Williams"
+__author_email__ = "mattjw@mattjw.net"
+__license__ = "MIT"
+__copyright__ = "Copyright (c) 2015 Matt J Williams"
+
+
+import math
+import heapq
+from collections import namedtuple, defaultdict
+
+
+EARTH_RADIUS = 3959.0  # miles
+MILES_PER_DEG_LAT = math.pi * EARTH_RADIUS / 180.0
+MAX_QUERY_RADIUS = 100.0  # miles; the largest radius the API accepts
+
+CELL_MARGIN = 0.75
+    # distance from a cell's sample point to its furthest corner, as a share
+    # of the grid spacing; above 1/sqrt(2) to allow for the grid's distortion
+
+
+def distance_miles(lat1, lon1, lat2, lon2):
+    """
+    Great-circle (haversine) distance between two points.
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def miles_per_deg_lon(lat):
+    return MILES_PER_DEG_LAT * max(math.cos(math.radians(lat)), 1e-6)
+
+
+Circle = namedtuple('Circle', ['lat', 'lon', 'radius'])
+
+
+class PointIndex(object):
+    """
+    Points (lat, lon) bucketed on a grid of `bucket_deg` degrees, for radius
+    queries.
+    """
+
+    def __init__(self, points, bucket_deg=0.5):
+        self.points = list(points)
+        self.bucket_deg = bucket_deg
+        self._buckets = defaultdict(list)
+        for indx, (lat, lon) in enumerate(self.points):
+            self._buckets[self._bucket(lat, lon)].append(indx)
+
+    def _bucket(self, lat, lon):
+        return int(math.floor(lat / self.bucket_deg)), int(math.floor(lon / self.bucket_deg))
+
+    def within(self, lat, lon, radius):
+        """
+        Indices of the points within `radius` miles of (`lat`, `lon`).
+        """
+        if radius < 0:
+            return []
+        dlat = radius / MILES_PER_DEG_LAT
+        max_lat = min(89.9, abs(lat) + dlat)
+        dlon = min(180.0, radius / miles_per_deg_lon(max_lat))
+        lat_lo, lon_lo = self._bucket(lat - dlat, lon - dlon)
+        lat_hi, lon_hi = self._bucket(lat + dlat, lon + dlon)
+        out = []
+        points = self.points
+        for i in xrange(lat_lo, lat_hi + 1):
+            for j in xrange(lon_lo, lon_hi + 1):
+                for indx in self._buckets.get((i, j), ()):
+                    plat, plon = points[indx]
+                    if distance_miles(lat, lon, plat, plon) <= radius:
+                        out.append(indx)
+        return out
+
+
+def grid_point(lat, lon, spacing):
+    """
+    The sample point of the grid cell, of `spacing` miles, that holds
+    (`lat`, `lon`). Rows are a fixed number of degrees of latitude apart;
+    within a row, cells are `spacing` miles apart at the row's latitude.
+    """
+    dlat = spacing / MILES_PER_DEG_LAT
+    row = math.floor(lat / dlat)
+    row_lat = (row + 0.5) * dlat
+    dlon = spacing / miles_per_deg_lon(row_lat)
+    col = math.floor(lon / dlon)
+    return row_lat, (col + 0.5) * dlon
+
+
+def grid_points_near(lat, lon, radius, spacing):
+    """
+    Sample points of the grid cells of `spacing` miles that meet the circle
+    of `radius` miles about (`lat`, `lon`).
+    """
+    dlat = spacing / MILES_PER_DEG_LAT
+    reach = radius + CELL_MARGIN * spacing
+    row_lo = int(math.floor((lat - reach / MILES_PER_DEG_LAT) / dlat))
+    row_hi = int(math.floor((lat + reach / MILES_PER_DEG_LAT) / dlat))
+    out = []
+    for row in xrange(row_lo, row_hi + 1):
+        row_lat = (row + 0.5) * dlat
+        dlon = spacing / miles_per_deg_lon(row_lat)
+        span = reach / miles_per_deg_lon(max(abs(row_lat), abs(lat)))
+        col_lo = int(math.floor((lon - span) / dlon))
+        col_hi = int(math.floor((lon + span) / dlon))
+        for col in xrange(col_lo, col_hi + 1):
+            plon = (col + 0.5) * dlon
+            if distance_miles(lat, lon, row_lat, plon) <= reach:
+                out.append((row_lat, plon))
+    return out
+
+
+class CoveragePlanner(object):
+    """
+    Plans query circles covering the circles of `radius` miles about each of
+    `points` (list of (lat, lon)). See module docstring. `spacing` is that
+    of the sample grid (default: a third of `radius`).
+    """
+
+    def __init__(self, points, radius, spacing=None):
+        self.points = list(points)
+        self.radius = float(radius)
+        self.spacing = spacing if spacing is not None else self.radius / 3.0
+        self.margin = CELL_MARGIN * self.spacing
+        self._point_index = PointIndex(self.points)
+
+        # pieces: (sample point, index of the point whose circle it is in)
+        self.piece_points = []
+        self.piece_owners = []
+        self._point_pieces = []  # point index -> its piece indices
+        for indx, (lat, lon) in enumerate(self.points):
+            pieces = []
+            for sample in grid_points_near(lat, lon, self.radius, self.spacing):
+                pieces.append(len(self.piece_points))
+                self.piece_points.append(sample)
+                self.piece_owners.append(indx)
+            self._point_pieces.append(pieces)
+        self._piece_index = PointIndex(self.piece_points)
+
+    def all_pieces(self):
+        return range(len(self.piece_points))
+
+    def covers(self, lat, lon):
+        """
+        True if (`lat`, `lon`) is within `radius` of any of the points.
+        """
+        return bool(self._point_index.within(lat, lon, self.radius))
+
+    def _covered_by(self, circle, pieces):
+        """
+        Those of `pieces` (a set) that `circle` covers.
+        """
+        out = set(self._piece_index.within(circle.lat, circle.lon, circle.radius - self.margin))
+        for indx in self._point_index.within(circle.lat, circle.lon, circle.radius - self.radius):
+            out.update(self._point_pieces[indx])
+        out &= pieces
+        return out
+
+    def _candidates(self, query_radius, pieces):
+        """
+        Candidate query circles for `pieces`: one about each point whose
+        pieces are included, and one at each sample point of a grid a
+        quarter of `query_radius` apart.
+        """
+        owners = frozenset(self.piece_owners[p] for p in pieces)
+        centres = set(self.points[indx] for indx in owners)
+        if query_radius > self.radius:
+            coarse = max(self.spacing, query_radius / 4.0)
+            for p in pieces:
+                lat, lon = self.piece_points[p]
+                centres.add(grid_point(lat, lon, coarse))
+        return [Circle(lat, lon, query_radius) for lat, lon in sorted(centres)]
+
+    def plan(self, query_radius=MAX_QUERY_RADIUS, pieces=None):
+        """
+        Query circles of radius `query_radius` covering `pieces` (default:
+        all), chosen greedily: each circle covers the most pieces not yet
+        covered. Unless that takes fewer circles than one per point of
+        `radius` (the unplanned crawl), the latter is used instead: its
+        smaller circles are less likely to need splitting (see `split`).
+        Returns list of tuples (circle, set of the pieces it was chosen for).
+        """
+        if pieces is None:
+            pieces = self.all_pieces()
+        pieces = set(pieces)
+        query_radius = max(self.radius, float(query_radius))
+
+        candidates = self._candidates(query_radius, pieces)
+        covered = [self._covered_by(circle, pieces) for circle in candidates]
+        heap = [(-len(cov), indx) for indx, cov in enumerate(covered) if cov]
+        heapq.heapify(heap)
+
+        uncovered = set(pieces)
+        plan = []
+        while uncovered and heap:
+            neg_gain, indx = heapq.heappop(heap)
+            gain = covered[indx] & uncovered
+            if not gain:
+                continue
+            if heap and len(gain) < -heap[0][0]:
+                # stale; re-queue with its current gain
+                heapq.heappush(heap, (-len(gain), indx))
+                continue
+            plan.append((candidates[indx], gain))
+            uncovered -= gain
+
+        owners = sorted(frozenset(self.piece_owners[p] for p in pieces))
+        if uncovered or len(plan) >= len(owners):
+            plan = []
+            for indx in owners:
+                lat, lon = self.points[indx]
+                plan.append((Circle(lat, lon, self.radius), pieces & set(self._point_pieces[indx])))
+        return plan
+
+    def split(self, circle, pieces):
+        """
+        Re-plan query `circle`, chosen for `pieces`, with circles of half its
+        radius (but no less than `radius`). Returns a plan, as `plan`, or
+        None if `circle` cannot be split.
+        """
+        if circle.radius <= self.radius:
+            return None
+        return self.plan(max(self.radius, circle.radius / 2.0), pieces)
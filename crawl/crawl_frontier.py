@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+#
+# Author:   Matt J Williams
+#           http://www.mattjw.net
+#           mattjw@mattjw.net
+# Date:     2015
+# License:  MIT License
+#           http://opensource.org/licenses/MIT
+
+
+"""
+Distributed version of `crawl_group_activity.py`. The crawl is broken into
+jobs held in a persistent frontier in MongoDB (see `frontier_tools`), which
+any number of worker processes can drain together, each with its own API
+rate budget.
+
+Jobs:
+    expand_group:   Expand one group (members and events), as in stage 1 of
+                    `crawl_group_activity.py`. Adds rsvp_batch jobs for the
+                    group's events.
+    rsvp_batch:     Crawl the attendance for a batch of events. Adds
+                    fetch_members jobs for unseen attendees.
+    fetch_members:  Crawl a batch of users.
+
+Usage:
+    python crawl_frontier.py seed       # add a job per group not yet crawled
+    python crawl_frontier.py work       # drain the frontier; run many of these
+    python crawl_frontier.py status
+"""
+
+
+__author__ = "Matt J Williams"
+__author_email__ = "mattjw@mattjw.net"
+__license__ = "MIT"
+__copyright__ = "Copyright (c) 2015 Matt J Williams"
+
+
+import argparse
+import hashlib
+import time
+
+import crawl_tools
+import frontier_tools
+import storage_tools
+import crawl_group_activity as activity
+from storage_tools import COLL_ATTENDANCE
+
+
+JOB_EXPAND_GROUP = 'expand_group'
+JOB_RSVP_BATCH = 'rsvp_batch'
+JOB_FETCH_MEMBERS = 'fetch_members'
+
+POLL_SECS = 30  # wait between polls while other workers hold leases
+
+
+class FrontierMemberQueue(object):
+    """
+    Stand-in for `crawl_group_activity.MemberFetchQueue` that adds
+    fetch_members jobs to the frontier, rather than crawling users directly.
+    """
+
+    def __init__(self, frontier, mdb, batch_size=activity.MEMBER_BATCH_SIZE):
+        self.frontier = frontier
+        self.mdb = mdb
+        self.batch_size = batch_size
+        self._queued = []
+        self._queued_set = set()
+
+    def add(self, user_id):
+        if user_id in self._queued_set or activity.has_user(self.mdb, user_id):
+            return
+        self._queued.append(user_id)
+        self._queued_set.add(user_id)
+
+    def flush(self):
+        jobs = []
+        for i in xrange(0, len(self._queued), self.batch_size):
+            user_ids = sorted(self._queued[i:i + self.batch_size])
+            key = hashlib.sha1(','.join(str(uid) for uid in user_ids)).hexdigest()
+            jobs.append((JOB_FETCH_MEMBERS, key, {'user_ids': user_ids}))
+        self.frontier.add_jobs(jobs)
+        self._queued = []
+        self._queued_set = set()
+
+
+def rsvp_batch_jobs(mdb, events):
+    """
+    Plan rsvp_batch jobs for `events` (see
+    `crawl_group_activity.plan_rsvp_batches`). Events without RSVPs are
+    stored straight away with no attendees.
+    """
+    event2count = {}
+    for event in events:
+        if not activity.has_event_attendees(mdb, event['id']):
+            event2count[event['id']] = event.get('yes_rsvp_count')
+    batches, empty_event_ids = activity.plan_rsvp_batches(event2count)
+
+    docs = []
+    for event_id in empty_event_ids:
+        out = {'event_id': event_id, 'attendee_ids': []}
+        docs.append(activity.event_attendees_document(out))
+    storage_tools.insert_new(mdb[COLL_ATTENDANCE], docs)
+
+    jobs = []
+    for event_ids in batches:
+        key = hashlib.sha1(','.join(sorted(event_ids))).hexdigest()
+        jobs.append((JOB_RSVP_BATCH, key, {'event_ids': event_ids}))
+    return jobs
+
+
+def get_handlers(alt_api, mdb, frontier):
+    """
+    Map of job kind to job handler.
+    """
+    def expand_group(payload):
+        group = payload['group']
+        if activity.has_group(mdb, group['id']):
+            return
+        activity.expand_meetup_group(alt_api, mdb, group,
+                                     payload['events_from'], payload['events_to'])
+        # add follow-on jobs before the group, which marks it as done
+        frontier.add_jobs(rsvp_batch_jobs(mdb, group['events_in_window']))
+        activity.add_group(mdb, group)
+
+    def rsvp_batch(payload):
+        member_queue = FrontierMemberQueue(frontier, mdb)
+        activity.crawl_event_attendance_batch(alt_api, mdb, payload['event_ids'],
+                                              member_queue=member_queue)
+
+    def fetch_members(payload):
+        member_queue = activity.MemberFetchQueue(alt_api, mdb)
+        for user_id in payload['user_ids']:
+            member_queue.add(user_id)
+        member_queue.flush()
+
+    return {JOB_EXPAND_GROUP: expand_group,
+            JOB_RSVP_BATCH: rsvp_batch,
+            JOB_FETCH_MEMBERS: fetch_members}
+
+
+def seed(frontier, mdb):
+    """
+    Add an expand_group job for each group not yet crawled.
+    """
+    countries2citygroups = activity.load_countries()
+    jobs = []
+    for country, city2groups in countries2citygroups.iteritems():
+        for city_ident, groups in city2groups.iteritems():
+            for group in groups:
+                if activity.has_group(mdb, group['id']):
+                    continue
+                payload = {'group': group, 'events_from': activity.EVENTS_FROM,
+                           'events_to': activity.EVENTS_TO}
+                jobs.append((JOB_EXPAND_GROUP, group['id'], payload))
+    num_added = frontier.add_jobs(jobs)
+    print "added %d jobs (%d groups not yet crawled)" % (num_added, len(jobs))
+
+
+def work(frontier, mdb, num_threads):
+    """
+    Drain the frontier with `num_threads` threads, until no jobs are left
+    pending or leased by any worker.
+    """
+    alt_api = crawl_tools.get_concurrent_alt_meetup_api(num_workers=num_threads)
+    handlers = get_handlers(alt_api, mdb, frontier)
+    exporter = crawl_tools.start_metrics_export()
+
+    try:
+        drain = lambda _: frontier.drain(handlers)
+        while True:
+            for num_done, num_failed in alt_api.imap_unordered(drain, range(num_threads)):
+                print "thread finished | %d jobs done | %d failed" % (num_done, num_failed)
+
+            counts = frontier.counts()
+            num_open = sum(n for (kind, state), n in counts.iteritems()
+                           if state in (frontier_tools.PENDING, frontier_tools.LEASED))
+            if num_open == 0:
+                break
+            print "%d jobs pending or leased elsewhere; waiting" % num_open
+            time.sleep(POLL_SECS)
+
+        alt_api.close()
+    finally:
+        exporter.stop()
+    print "http:", alt_api.transport.stats()
+
+
+def status(frontier):
+    for (kind, state), n in sorted(frontier.counts().iteritems()):
+        print "%-16s %-8s %8d" % (kind, state, n)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Distributed group activity crawl")
+    parser.add_argument('command', choices=['seed', 'work', 'status'])
+    parser.add_argument('--threads', type=int, default=crawl_tools.DEFAULT_NUM_WORKERS,
+                        help="worker threads in this process (work only)")
+    args = parser.parse_args()
+
+    mdb = activity.mongo_connect()
+    frontier = frontier_tools.Frontier(mdb)
+
+    if args.command == 'seed':
+        seed(frontier, mdb)
+    elif args.command == 'work':
+        work(frontier, mdb, args.threads)
+    elif args.command == 'status':
+        status(frontier)
+
+
+if __name__ == "__main__":
+    main()
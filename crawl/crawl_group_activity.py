@@ -35,17 +35,35 @@ from pprint import pprint
 import json
 from collections import OrderedDict, defaultdict
 import os
+import hashlib
+import argparse
+import math
+import bisect
+import urllib
 from datetime import datetime
 
-import pymongo
-
 import crawl_tools
+import storage_tools
+import collect_city_groups
+import telemetry_tools
+from storage_tools import COLL_USERS, COLL_GROUPS, COLL_ATTENDANCE
+
+
+EVENTS_FROM = datetime(2012, 6, 1)
+EVENTS_TO = datetime(2015, 6, 1)
+
+MEMBER_BATCH_SIZE = 50  # member IDs per `members` request
 
+RSVP_BATCH_MAX_EVENTS = 50  # event IDs per `rsvps` request
+RSVP_BATCH_MAX_ID_CHARS = 1500  # url-encoded event IDs per `rsvps` request
+    # keeps the request URL well within the common 2000 character limit
+GROUP_LISTING_BATCH_SIZE = 200  # group IDs per `groups` request on refresh
+FINGERPRINT_EXCLUDED_FIELDS = frozenset([
+    # fields added by the crawl, rather than from the `groups` endpoint
+    '_id', 'member_ids', 'events_in_window', 'watermark', 'fingerprint'])
 
-MONGO_DBNAME = "meetupdotcom"
-COLL_USERS = "users"
-COLL_GROUPS = "groups"
-COLL_ATTENDANCE = 'event_attendance'
+UNKNOWN_RSVP_COUNT = 20
+    # number of RSVPs assumed for an event without a `yes_rsvp_count`
 
 #
 # Misc
@@ -63,76 +81,101 @@ def is_int(v):
 # From mongo
 
 def has_user(mdb, user_id):
-    ret = mdb[COLL_USERS].find_one({'_id': user_id})
-    return ret is not None
+    return storage_tools.has_id(mdb[COLL_USERS], user_id)
 
 
 def has_group(mdb, group_id):
-    ret = mdb[COLL_GROUPS].find_one({'_id': group_id})
-    return ret is not None
+    return storage_tools.has_id(mdb[COLL_GROUPS], group_id)
 
 
 def mongo_connect():
-    config = crawl_tools.get_config()
-
-    mclient = pymongo.mongo_client.MongoClient(config['mongo_host'], config['mongo_port'])
-    #mclient[MONGO_DBNAME].authenticate(MONGO_USER, MONGO_PW)
-    mdb = mclient[MONGO_DBNAME]
-    return mdb
+    return storage_tools.mongo_connect()
 
 
 def add_group(mdb, group):
+    """
+    Add group to mongodb, if not already added.
+    """
     gid = group['id']
     assert is_int(gid)
-    if not has_group(mdb, gid):
-        out = OrderedDict(group)
-        out['_id'] = gid
-        _id = mdb[COLL_GROUPS].insert_one(out)
+    out = storage_tools.as_document(group, gid)
+    out['fingerprint'] = group_fingerprint(group)
+    storage_tools.insert_new(mdb[COLL_GROUPS], [out])
 
-        #print "inserted new group:", gid #~
 
-
-def add_user(mdb, user):
+def user_document(user):
     """
-    Add user to mongodb, if not already crawled.
-    `user`: The JSON response for a given user, from
+    Storage document for `user`, the JSON response for a given user, from
         http://www.meetup.com/meetup_api/docs/2/members/
     """
     uid = user['id']
     assert is_int(uid)
-    if not has_user(mdb, uid):
-        out = OrderedDict(user)
-        out['_id'] = uid
-        _id = mdb[COLL_USERS].insert_one(out)
-
-        #print "inserted new user:", uid #~
+    return storage_tools.as_document(user, uid)
 
 
-def crawl_add_user(alt_api, mdb, user_id):
+def deleted_user(user_id):
     """
-    If user_id is not in mdb, obtain their data (from Meetup API) and add
-    it.
-
-    If user has deleted their account, insert dummy user with same ID.
+    Dummy user to store for `user_id` if the user has deleted their account.
     """
-    if has_user(mdb, user_id):
-        # no need to crawl
-        return
+    print "[warning | user %s not found]" % [user_id]
+    return {'id': user_id, 'info': 'user no longer exists'}
 
-    results = alt_api.members(member_id=user_id)  # ideally, a list of one
 
-    if len(results) == 0:
-        # user not found
-        user = {'id': user_id, 'info': 'user no longer exists'}
-        print "[warning | user %s not found]" % [user_id]
-    elif len(results) == 1:
-        user = results[0]
-    else:
-        raise StandardError("Too many users returned")
+class MemberFetchQueue(object):
+    """
+    Coalesces the crawling of unseen users. User IDs are queued with `add`
+    and their data is obtained from the Meetup API `batch_size` users per
+    request, rather than one request per user. Users already stored, or
+    already queued, are ignored.
+
+    A dummy user (see `deleted_user`) is stored for any user in a batch who
+    has deleted their account.
 
-    add_user(mdb, user)
+    Call `flush` to crawl any users still queued. Not thread-safe; use one
+    queue per thread.
+    """
 
-    print "crawled and inserted user:", user_id
+    def __init__(self, alt_api, mdb, batch_size=MEMBER_BATCH_SIZE):
+        self.alt_api = alt_api
+        self.mdb = mdb
+        self.batch_size = batch_size
+        self.num_requests = 0
+        self.num_users = 0
+        self._queued = []
+        self._queued_set = set()
+
+    def add(self, user_id):
+        if user_id in self._queued_set or has_user(self.mdb, user_id):
+            return
+        self._queued.append(user_id)
+        self._queued_set.add(user_id)
+        if len(self._queued) >= self.batch_size:
+            self._crawl_batch()
+
+    def flush(self):
+        while self._queued:
+            self._crawl_batch()
+
+    def _crawl_batch(self):
+        user_ids = self._queued[:self.batch_size]
+        self._queued = self._queued[self.batch_size:]
+        self._queued_set.difference_update(user_ids)
+
+        member_ids_str = ','.join(str(user_id) for user_id in user_ids)
+        results = self.alt_api.members(member_id=member_ids_str)
+        self.num_requests += 1
+
+        id2user = dict((user['id'], user) for user in results)
+        docs = []
+        for user_id in user_ids:
+            user = id2user.get(user_id)
+            if user is None:
+                user = deleted_user(user_id)
+            docs.append(user_document(user))
+        storage_tools.insert_new(self.mdb[COLL_USERS], docs)
+        self.num_users += len(user_ids)
+
+        print "crawled and inserted %d users" % len(user_ids)
 
 
 #
@@ -140,17 +183,20 @@ def crawl_add_user(alt_api, mdb, user_id):
 
 def load_countries():
     """
-    Load meetup data for each country.
+    Load meetup data for each country, as collected by
+    `collect_city_groups.py`. Where a country has both, its newline-delimited
+    file is used rather than one of the older format.
     """
-    fdir = './dat/city_meetup_groups'
+    fdir = collect_city_groups.OUT_DIR
+    fnames = sorted(os.listdir(fdir))
     country2citygroups = {}
-    for fname in os.listdir(fdir):
-        if not fname.endswith('json'):
-            continue
-        fpath = os.path.join(fdir, fname)
-        country = fname.split('.')[0]
-        with open(fpath) as f:
-            country2citygroups[country] = json.load(f)
+    for ext in [collect_city_groups.OUT_EXT, collect_city_groups.LEGACY_OUT_EXT]:
+        for fname in fnames:
+            country, fext = os.path.splitext(fname)
+            if fext != ext or country in country2citygroups:
+                continue
+            fpath = os.path.join(fdir, fname)
+            country2citygroups[country] = collect_city_groups.load_city_groups(fpath)
     return country2citygroups
 
 
@@ -159,18 +205,20 @@ def load_countries():
 
 def get_group_members(alt_api, group_id):
     """
-    Get list of all members for groupid.
+    Get all members for groupid. Returns a generator; members are streamed
+    page by page.
     
     Attributes for each member as returned by /members/:
         http://www.meetup.com/meetup_api/docs/2/members/
     """
-    members = alt_api.members(group_id=group_id)
+    members = alt_api.iter_members(group_id=group_id)
     return members
 
 
 def get_events(alt_api, group_id, dt_frm, dt_to, status='past'):
     """
     Retrieve all events for group `group_id` between dates `from` and `to`.
+    Returns a generator; events are streamed page by page.
 
     `dt_frm`, `dt_to`: Datetime objects.
     `status`: past, upcoming, proposed, cancelled, draft
@@ -179,7 +227,7 @@ def get_events(alt_api, group_id, dt_frm, dt_to, status='past'):
         http://www.meetup.com/meetup_api/docs/2/events/
     """
     time = "%d,%d" % (datetime_to_epoch_ms(dt_frm), datetime_to_epoch_ms(dt_to))
-    events = alt_api.events(group_id=group_id, status=status, time=time)
+    events = alt_api.iter_events(group_id=group_id, status=status, time=time)
     return events
 
 
@@ -206,20 +254,184 @@ def expand_meetup_group(alt_api, mdb, group, events_from, events_to):
     gid = group['id']
     assert is_int(gid)
 
-    members = get_group_members(alt_api, gid)
-    
-    for user in members:
-        add_user(mdb, user)
+    member_ids = []
+    last_joined = None  # None sorts below any time
+    page_size = crawl_tools.DEFAULT_PAGINATION_COUNT
+    with storage_tools.BatchInserter(mdb[COLL_USERS], page_size) as inserter:
+        for user in get_group_members(alt_api, gid):
+            # users are stored a page at a time, as pages arrive
+            inserter.add(user_document(user))
+            member_ids.append(user['id'])
+            last_joined = max(last_joined, user.get('joined'))
 
-    if len(members) != group['members']:
-        print "[warning | missed some members", len(members), group['members'], group['name'], "]"
-    group['member_ids'] = [user['id'] for user in members]
+    if len(member_ids) != group['members']:
+        print "[warning | missed some members", len(member_ids), group['members'], group['name'], "]"
+    group['member_ids'] = member_ids
 
     #
     # events
-    events = get_events(alt_api, gid, events_from, events_to)
+    events = list(get_events(alt_api, gid, events_from, events_to))
     group['events_in_window'] = events
 
+    group['watermark'] = {
+        'last_event_time': max([event['time'] for event in events] or [None]),
+        'last_member_joined': last_joined,
+        'refreshed': events_to,
+    }
+
+
+#
+# Incremental refresh
+
+def get_group_watermark(group):
+    """
+    The watermark of stored group document `group`: the time of its latest
+    event, and the `joined` time of its latest member. Groups crawled before
+    watermarks were recorded have the former derived from their stored
+    events; their member watermark is unknown (None) until the next refresh.
+    """
+    if 'watermark' in group:
+        return group['watermark']
+    events = group['events_in_window']
+    return {
+        'last_event_time': max([event['time'] for event in events] or [None]),
+        'last_member_joined': None,
+        'refreshed': None,
+    }
+
+
+def group_fingerprint(group):
+    """
+    Fingerprint of a group's `groups` endpoint data: its `updated` time and
+    a hash of its content. Anything added by the crawl is ignored, so a
+    stored group document has the same fingerprint as the listing it came
+    from.
+    """
+    fields = dict((k, v) for k, v in group.iteritems()
+                  if k not in FINGERPRINT_EXCLUDED_FIELDS)
+    content = json.dumps(fields, sort_keys=True, default=str)
+    return {'updated': group.get('updated'),
+            'hash': hashlib.sha1(content).hexdigest()}
+
+
+def list_groups(alt_api, group_ids):
+    """
+    Retrieve the current `groups` endpoint data for `group_ids`, many groups
+    per request. Groups no longer listed (e.g., removed) are absent. The
+    response cache is bypassed, so that changes are seen.
+
+    Returns tuple (dict mapping group ID to group, number of requests).
+    """
+    alt_api = alt_api.uncached()
+    batches = [group_ids[i:i + GROUP_LISTING_BATCH_SIZE]
+               for i in xrange(0, len(group_ids), GROUP_LISTING_BATCH_SIZE)]
+    def list_batch(batch):
+        group_ids_str = ','.join(str(gid) for gid in batch)
+        return alt_api.groups(group_id=group_ids_str)
+
+    id2group = {}
+    for groups in alt_api.imap_unordered(list_batch, batches):
+        for group in groups:
+            id2group[group['id']] = group
+    return id2group, len(batches)
+
+
+def find_changed_groups(alt_api, mdb):
+    """
+    Compare the current listing of each stored group with its stored
+    fingerprint (see `group_fingerprint`).
+
+    Returns tuple (changed, num_unchanged, num_missing, num_requests).
+    `changed` is a list of the current listings of the groups that changed.
+    """
+    stored = mdb[COLL_GROUPS].find({}, {'member_ids': 0, 'events_in_window': 0})
+    id2fingerprint = {}
+    for group in stored:
+        fingerprint = group.get('fingerprint')
+        if fingerprint is None:
+            # crawled before fingerprints were recorded
+            fingerprint = group_fingerprint(group)
+        id2fingerprint[group['_id']] = fingerprint
+
+    id2listed, num_requests = list_groups(alt_api, sorted(id2fingerprint))
+
+    changed = []
+    num_unchanged = 0
+    for gid, fingerprint in id2fingerprint.iteritems():
+        listed = id2listed.get(gid)
+        if listed is None:
+            continue
+        if group_fingerprint(listed) == fingerprint:
+            num_unchanged += 1
+        else:
+            changed.append(listed)
+    num_missing = len(id2fingerprint) - len(id2listed)
+    return changed, num_unchanged, num_missing, num_requests
+
+
+def refresh_meetup_group(alt_api, mdb, group, refresh_to):
+    """
+    Incrementally update stored group document `group`, fetching only what
+    is newer than its watermark (see `get_group_watermark`):
+
+    * events from just after the latest stored event, up to `refresh_to`;
+    * members, newest first, until reaching members older than the latest
+      stored member (if no member watermark is known, all members are
+      fetched).
+
+    New events and member IDs are appended to the stored group, new users
+    are stored, and the watermark is advanced. RSVPs for the new events are
+    crawled later, as for any event without attendance. The response cache
+    is bypassed, as cached pages would hide what is new.
+
+    Returns tuple (number of new events, number of new members).
+    """
+    alt_api = alt_api.uncached()
+    gid = group['id']
+    watermark = get_group_watermark(group)
+
+    #
+    # events
+    if watermark['last_event_time'] is not None:
+        events_from_ms = watermark['last_event_time'] + 1
+    else:
+        events_from_ms = datetime_to_epoch_ms(EVENTS_FROM)
+    time = "%d,%d" % (events_from_ms, datetime_to_epoch_ms(refresh_to))
+    known_event_ids = frozenset(event['id'] for event in group['events_in_window'])
+    new_events = [event for event in alt_api.iter_events(group_id=gid, status='past', time=time)
+                  if event['id'] not in known_event_ids]
+
+    #
+    # members, newest first; stop once past the watermark
+    last_joined = watermark['last_member_joined']
+    known_member_ids = frozenset(group['member_ids'])
+    params = {'group_id': gid, 'order': 'joined', 'desc': 'true'}
+    new_members = []
+    seen_joined = last_joined  # latest `joined` of the members streamed
+    for user in alt_api.query_iter_results('members', params, prefetch=False):
+        if last_joined is not None and user.get('joined', 0) <= last_joined:
+            break
+        seen_joined = max(seen_joined, user.get('joined'))
+        if user['id'] not in known_member_ids:
+            new_members.append(user)
+    storage_tools.insert_new(mdb[COLL_USERS], [user_document(user) for user in new_members])
+    new_member_ids = [user['id'] for user in new_members]
+
+    #
+    # append to the stored group
+    new_watermark = {
+        'last_event_time': max([event['time'] for event in new_events] +
+                               [watermark['last_event_time']]),
+        'last_member_joined': seen_joined,
+        'refreshed': refresh_to,
+    }
+    mdb[COLL_GROUPS].update_one({'_id': gid}, {
+        '$push': {'events_in_window': {'$each': new_events}},
+        '$addToSet': {'member_ids': {'$each': new_member_ids}},
+        '$set': {'watermark': new_watermark},
+    })
+    return len(new_events), len(new_member_ids)
+
 
 #
 # Crawling event attendance
@@ -229,25 +441,132 @@ def has_event_attendees(mdb, event_id):
     Returns True if we already have a list of attendees for the event
     `event_id`.
     """
-    ret = mdb[COLL_ATTENDANCE].find_one({'_id': event_id})
-    return ret is not None
+    return storage_tools.has_id(mdb[COLL_ATTENDANCE], event_id)
 
 
-def add_event_attendees(mdb, event_attendees):
+def event_attendees_document(event_attendees):
     """
-    Add event attendance info to mongodb, if not already added.
-    event_attendees:
-        A dict of form {event_id:..., attendee_ids: [...]}
+    Storage document for event attendance info `event_attendees`, a dict of
+    form {event_id:..., attendee_ids: [...]}
     """
-    event_id = event_attendees['event_id']
+    assert 'attendee_ids' in event_attendees
+    return storage_tools.as_document(event_attendees, event_attendees['event_id'])
 
-    if not has_event_attendees(mdb, event_id):
-        out = OrderedDict(event_attendees)
-        out['_id'] = event_id
 
-        assert 'attendee_ids' in event_attendees
+def crawl_event_attendance_batch(alt_api, mdb, event_ids, member_queue=None):
+    """
+    Collect and store the attendance (RSVP) information for the events in
+    `event_ids`, via a single (paginated) `rsvps` query. Any unseen attendees
+    are passed to `member_queue` (by default, a `MemberFetchQueue`, which
+    crawls them into the user collection), which is flushed before the
+    attendance is stored.
+    """
+    if member_queue is None:
+        member_queue = MemberFetchQueue(alt_api, mdb)
+
+    # retrieve attendance info
+    event2attendees = defaultdict(lambda: set())
+    for eid in event_ids:
+        # we'll preemptively force in the (empty) list of attendees here,
+        # because some times there are events with no attendees
+        event2attendees[eid] = set()
+
+    event_ids_str = ','.join(event_ids)
+    results = alt_api.iter_rsvps(event_id=event_ids_str, rsvp='yes')
+    for result in results:
+        if result['rsvp_id'] == -1:
+            # host who has not RSVP'd
+            print "no RSVP"
+            continue
+
+        event_id = result['event']['id']
+        user_id = result['member']['member_id']
+
+        member_queue.add(user_id)  # no-op if already stored
+
+        event2attendees[event_id].add(user_id)
+
+    # attendees must be stored before the attendance, which marks the events
+    # as done
+    member_queue.flush()
+
+    # save attendance info, in one bulk write
+    docs = []
+    for event_id, attendee_ids in event2attendees.iteritems():
+        attendee_ids = list(attendee_ids)
+        out = {'event_id': event_id, 'attendee_ids': attendee_ids}
+        docs.append(event_attendees_document(out))
+    storage_tools.insert_new(mdb[COLL_ATTENDANCE], docs)
+
+    return event_ids
+
+
+def plan_rsvp_batches(event2count, page_size=crawl_tools.DEFAULT_PAGINATION_COUNT,
+                      max_events=RSVP_BATCH_MAX_EVENTS,
+                      max_id_chars=RSVP_BATCH_MAX_ID_CHARS):
+    """
+    Plan the `rsvps` queries for a set of events.
+
+    `event2count`: Maps event ID to the number of RSVPs expected for the
+        event (i.e., its `yes_rsvp_count`), or None if not known.
+
+    Events expected to have no RSVPs need not be queried. The remaining
+    events are packed into batches (best fit, largest event first) so that
+    the RSVPs of each batch fill close to a whole number of result pages;
+    only the last page of a batch may be part-empty. A batch never has more
+    than `max_events` events, nor more than `max_id_chars` characters of
+    (url-encoded, comma-separated) event IDs.
 
-        _id = mdb[COLL_ATTENDANCE].insert_one(out)
+    Returns tuple (batches, empty_event_ids). `batches` is a list of lists
+    of event IDs.
+    """
+    sep_chars = len(urllib.quote(','))
+
+    empty_event_ids = []
+    items = []
+    for event_id, count in event2count.iteritems():
+        if count is None:
+            count = UNKNOWN_RSVP_COUNT
+        if count <= 0:
+            empty_event_ids.append(event_id)
+        else:
+            items.append((count, event_id))
+    if not items:
+        return [], empty_event_ids
+    items.sort()
+    counts = [count for count, _ in items]
+    event_ids = [event_id for _, event_id in items]
+
+    # spread the RSVPs over the fewest batches that `max_events` allows,
+    # rounding each batch up to whole pages
+    min_batches = (len(items) + max_events - 1) // max_events
+    pages_per_batch = sum(counts) / float(page_size * min_batches)
+    capacity = page_size * max(1, int(math.ceil(pages_per_batch)))
+
+    batches = []
+    while counts:
+        # largest remaining event opens the batch
+        count = counts.pop()
+        event_id = event_ids.pop()
+        num_pages = (count + page_size - 1) // page_size
+        room = max(capacity, num_pages * page_size) - count
+        batch = [event_id]
+        num_chars = len(urllib.quote(event_id))
+
+        # then the largest events that still fit
+        while counts and len(batch) < max_events:
+            indx = bisect.bisect_right(counts, room) - 1
+            if indx < 0:
+                break
+            fit_chars = sep_chars + len(urllib.quote(event_ids[indx]))
+            if num_chars + fit_chars > max_id_chars:
+                break
+            room -= counts.pop(indx)
+            batch.append(event_ids.pop(indx))
+            num_chars += fit_chars
+        batches.append(batch)
+
+    return batches, empty_event_ids
 
 
 def crawl_event_attendance(alt_api, mdb):
@@ -261,99 +580,109 @@ def crawl_event_attendance(alt_api, mdb):
     If an event attendee has not been seen before, we additionally collect
     their data and store it in the user collection.
 
+    Events are queried in batches planned from their RSVP counts (see
+    `plan_rsvp_batches`). Events with no RSVPs are stored with an empty list
+    of attendees, without being queried.
+
     Note: event IDs are alphanumeric.
     """
     #
     # Obtain to do list...
-    all_event_ids = []
+    event2count = {}
     for group in mdb[COLL_GROUPS].find():
         for event in group['events_in_window']:
-            all_event_ids.append(event['id'])
+            event2count[event['id']] = event.get('yes_rsvp_count')
 
-    seen_event_ids = [attendance_doc['event_id'] for attendance_doc in mdb[COLL_ATTENDANCE].find()]
-
-    unseen_event_ids = frozenset(all_event_ids) - frozenset(seen_event_ids)
-    unseen_event_ids = list(unseen_event_ids)
+    seen_event_ids = [attendance_doc['_id'] for attendance_doc in mdb[COLL_ATTENDANCE].find({}, {'_id': 1})]
+    for event_id in seen_event_ids:
+        event2count.pop(event_id, None)
 
     #
-    # Now crawl attendance info for each event in `unseen_event_ids`
-    # We'll progress in chunks of 50 events
-    while len(unseen_event_ids) > 0:
-        # fill buffer
-        next_ids = []
-        while len(next_ids) < 50 and len(unseen_event_ids) > 0:
-            next_ids.append(unseen_event_ids.pop())
-
-        print "checking %s events | %s events remaining" % (len(next_ids), len(unseen_event_ids))
-        #print "querying", next_ids #~
-
-        # retrieve attendance info
-        event2attendees = defaultdict(lambda: set())
-        for eid in next_ids:
-            # we'll preemptively force in the (empty) list of attendees here,
-            # because some times there are events with no attendees
-            event2attendees[eid] = set()
-
-        event_ids_str = ','.join(next_ids)
-        results = alt_api.rsvps(event_id=event_ids_str, rsvp='yes')
-        for result in results:
-            if result['rsvp_id'] == -1:
-                # host who has not RSVP'd
-                print "no RSVP"
-                continue
-
-            event_id = result['event']['id']
-            user_id = result['member']['member_id']
-
-            if not has_user(mdb, user_id):
-                crawl_add_user(alt_api, mdb, user_id)
-
-            event2attendees[event_id].add(user_id)
+    # Plan the crawl, and store events which have no attendees
+    batches, empty_event_ids = plan_rsvp_batches(event2count)
 
-        # save attendance info
-        for event_id, attendee_ids in event2attendees.iteritems():
-            attendee_ids = list(attendee_ids)
-            out = {'event_id': event_id, 'attendee_ids': attendee_ids}
+    docs = []
+    for event_id in empty_event_ids:
+        out = {'event_id': event_id, 'attendee_ids': []}
+        docs.append(event_attendees_document(out))
+    storage_tools.insert_new(mdb[COLL_ATTENDANCE], docs)
 
-            #print "saved attendance doc", out
-            add_event_attendees(mdb, out)
+    print "%d events | %d without RSVPs | %d rsvps queries planned" % (
+        len(event2count), len(empty_event_ids), len(batches))
 
-
-def main():
     #
-    #
-    # Prep
-    #
-
-    # Params
-    events_from = datetime(2012, 6, 1)
-    events_to = datetime(2015, 6, 1)
+    # Now crawl attendance info for the remaining events, several batches at
+    # a time
+    num_remaining = sum(len(batch) for batch in batches)
+    crawl_batch = lambda next_ids: crawl_event_attendance_batch(alt_api, mdb, next_ids)
+    for next_ids in alt_api.imap_unordered(crawl_batch, batches):
+        num_remaining -= len(next_ids)
+        print "checked %s events | %s events remaining" % (len(next_ids), num_remaining)
 
-    # Load
-    api = crawl_tools.get_meetup_api()
-    alt_api = crawl_tools.get_alt_meetup_api()
 
-    countries2citygroups = load_countries()
+def refresh_groups(alt_api, mdb, refresh_all=False):
+    """
+    Incrementally refresh stored groups (see `refresh_meetup_group`), several
+    at a time.
 
-    mdb = mongo_connect()
+    Only groups whose listing has changed since they were stored are
+    refreshed (see `find_changed_groups`), unless `refresh_all`. Reports an
+    estimate of the requests saved by skipping the unchanged groups.
+    """
+    refresh_to = datetime.utcnow()
 
-    print "from", events_from
-    print "to", events_to
+    if refresh_all:
+        to_refresh = [group['_id'] for group in mdb[COLL_GROUPS].find({}, {'_id': 1})]
+        listings = {}
+    else:
+        changed, num_unchanged, num_missing, num_listing_requests = find_changed_groups(alt_api, mdb)
+        to_refresh = [listed['id'] for listed in changed]
+        listings = dict((listed['id'], listed) for listed in changed)
+        print "%d groups changed | %d unchanged | %d no longer listed | %d listing requests" % (
+            len(changed), num_unchanged, num_missing, num_listing_requests)
+
+    def refresh_group(gid):
+        if gid in listings:
+            # bring the group's own fields up to date
+            listed = listings[gid]
+            fields = dict((k, v) for k, v in listed.iteritems()
+                          if k not in FINGERPRINT_EXCLUDED_FIELDS)
+            fields['fingerprint'] = group_fingerprint(listed)
+            mdb[COLL_GROUPS].update_one({'_id': gid}, {'$set': fields})
+        group = mdb[COLL_GROUPS].find_one({'_id': gid})
+        return group, refresh_meetup_group(alt_api, mdb, group, refresh_to)
+
+    num_refresh_requests = alt_api.transport.stats()['requests']
+    for group, (num_events, num_members) in alt_api.imap_unordered(refresh_group, to_refresh):
+        print "\t%-40s +%d events, +%d members" % (group['name'], num_events, num_members)
+    num_refresh_requests = alt_api.transport.stats()['requests'] - num_refresh_requests
+
+    if not refresh_all:
+        # each refresh costs at least two requests (events and members)
+        per_group = max(2.0, num_refresh_requests / float(max(1, len(to_refresh))))
+        saved = per_group * num_unchanged - num_listing_requests
+        print "skipped %d unchanged groups | ~%d requests saved" % (num_unchanged, saved)
+
+
+def expand_groups(alt_api, mdb, countries2citygroups, events_from, events_to):
+    """
+    Expand and store each group not already crawled, several at a time.
+    """
+    def crawl_group(group):
+        # full supplementary crawl of each group
+        expand_meetup_group(alt_api, mdb, group, events_from, events_to)
+        add_group(mdb, group)
+        return group
 
-    #
-    #
-    # Crawl -- expand groups, obtain members
-    #
-    print "\nSTAGE 1: Expand groups"
     for country, city2groups in countries2citygroups.iteritems():
         print country
+        to_crawl = []
         for city_ident, groups in city2groups.iteritems():
             #if 'Swansea' not in city_ident:
             #    continue
 
             print country, "\t", city_ident
 
-            # full supplementary crawl of each group
             for group in groups:
                 gid = group['id']
 
@@ -361,14 +690,66 @@ def main():
                     # do not re-crawl
                     print "\t", group['name'], "<SKIPPING>" #~
                     continue
+                to_crawl.append(group)
+
+        # all groups in this country are expanded concurrently
+        for group in alt_api.imap_unordered(crawl_group, to_crawl):
+            print "\t", group['name'], "<CRAWLED>" #~
+
 
-                print "\t", group['name'], "<CRAWLING>" #~
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--refresh', action='store_true',
+                        help="incrementally refresh the groups already crawled")
+    parser.add_argument('--all', action='store_true',
+                        help="with --refresh, refresh groups whose listing is unchanged too")
+    args = parser.parse_args()
+
+    #
+    #
+    # Prep
+    #
+
+    # Params
+    events_from = EVENTS_FROM
+    events_to = EVENTS_TO
+
+    # Load
+    api = crawl_tools.get_meetup_api()
+    alt_api = crawl_tools.get_concurrent_alt_meetup_api()
 
-                expand_meetup_group(alt_api, mdb, group, events_from, events_to)
-                add_group(mdb, group)
+    countries2citygroups = load_countries()
+
+    mdb = mongo_connect()
 
-    print "\nSTAGE 2: Crawl attendance for each event"
-    crawl_event_attendance(alt_api, mdb)
+    metrics = telemetry_tools.get_metrics()
+    exporter = crawl_tools.start_metrics_export()
+
+    try:
+        print "from", events_from
+        print "to", events_to
+
+        #
+        #
+        # Crawl -- expand groups, obtain members
+        #
+        if args.refresh:
+            print "\nREFRESH: Fetch new events and members for crawled groups"
+            with metrics.timed('stage_refresh'):
+                refresh_groups(alt_api, mdb, refresh_all=args.all)
+        else:
+            print "\nSTAGE 1: Expand groups"
+            with metrics.timed('stage_expand_groups'):
+                expand_groups(alt_api, mdb, countries2citygroups, events_from, events_to)
+
+        print "\nSTAGE 2: Crawl attendance for each event"
+        with metrics.timed('stage_attendance'):
+            crawl_event_attendance(alt_api, mdb)
+
+        alt_api.close()
+    finally:
+        exporter.stop()
+    print "http:", alt_api.transport.stats()
 
 if __name__ == "__main__":
     main()
@@ -1,5 +1,13 @@
 """
 Obtain groups near pre-selected locations.
+
+Rather than one query per city, the cities' circles are covered by a small
+set of (possibly larger) query circles (see `coverage_tools`). A query
+circle holding more than `PAGE_BUDGET` pages of groups is split into smaller
+circles; the groups on the page already fetched for it are kept. Groups
+outside every city's circle are discarded. A group may be found by several
+circles; duplicates are dropped when the crawls are collected (see
+`collect_city_groups.py`).
 """
 
 from pprint import pprint
@@ -8,6 +16,11 @@ from collections import OrderedDict
 
 
 import crawl_tools
+import coverage_tools
+import telemetry_tools
+
+
+PAGE_BUDGET = 1  # pages of groups per query circle before it is split
 
 
 def load_extracted_geonames_top_cities():
@@ -35,6 +48,74 @@ def retrieve_groups_near(alt_api, lon, lat, radius=25, category_id=34):
     #return results
 
 
+def retrieve_groups_in_circle(alt_api, circle, category_id=34, max_pages=None):
+    """
+    Retrieve meetup groups within query circle `circle` (see
+    `coverage_tools.Circle`).
+
+    Returns tuple (groups, complete). If `max_pages` is given and the
+    circle holds more pages of groups than that, only the first page is
+    fetched, and `complete` is False.
+    """
+    params = {'category_id': category_id, 'lat': circle.lat, 'lon': circle.lon,
+              'radius': circle.radius}
+    resp = alt_api.query_get('groups', params)
+    total = resp['meta'].get('total_count', 0)
+    results = list(resp['results'])
+    if max_pages is not None and total > max_pages * crawl_tools.DEFAULT_PAGINATION_COUNT:
+        return results, False
+    while resp['meta']['next'] != "":
+        resp = alt_api.query_gateway(resp['meta']['next'])
+        results.extend(resp['results'])
+    return results, True
+
+
+def crawl_cities(alt_api, cities, radius, category_id=34):
+    """
+    Retrieve the groups within `radius` miles of any of `cities` (geonames
+    cities), with planned query circles (see module docstring).
+
+    Returns list of dicts, one per query circle: the circle, the names of
+    the cities it was chosen for, and the groups found.
+    """
+    points = [(float(city['latitude']), float(city['longitude'])) for city in cities]
+    planner = coverage_tools.CoveragePlanner(points, radius)
+
+    def crawl_circle(planned):
+        circle, pieces = planned
+        can_split = circle.radius > planner.radius
+        results, complete = retrieve_groups_in_circle(
+            alt_api, circle, category_id, max_pages=PAGE_BUDGET if can_split else None)
+        return planned, results, complete
+
+    out = []
+    num_queries = 0
+    to_query = planner.plan(coverage_tools.MAX_QUERY_RADIUS)
+    while to_query:
+        to_split = []
+        # circles are crawled concurrently; `imap` retains circle order
+        for (circle, pieces), results, complete in alt_api.imap(crawl_circle, to_query):
+            num_queries += 1
+            if not complete:
+                # the smaller circles find the rest; keep the page fetched
+                to_split.append((circle, pieces))
+            kept = [group for group in results
+                    if 'lat' not in group or planner.covers(group['lat'], group['lon'])]
+            owners = sorted(frozenset(planner.piece_owners[p] for p in pieces))
+            print "\t%5.1f, %6.1f r=%-5.1f %3d cities  %d groups (%d outside)%s" % (
+                circle.lat, circle.lon, circle.radius, len(owners), len(kept),
+                len(results) - len(kept), '' if complete else ' split')
+            out.append({'circle': circle._asdict(),
+                        'geonames_cities': [cities[indx]['city'] for indx in owners],
+                        'results': kept})
+        to_query = []
+        for circle, pieces in to_split:
+            to_query.extend(planner.split(circle, pieces))
+
+    print "%d queries (%d circles) for %d cities" % (num_queries, len(out), len(cities))
+    return out
+
+
 def main():
     #
     #
@@ -47,37 +128,35 @@ def main():
 
     # Load
     api = crawl_tools.get_meetup_api()
-    alt_api = crawl_tools.get_alt_meetup_api()
+    alt_api = crawl_tools.get_concurrent_alt_meetup_api()
 
     countries2cities = load_extracted_geonames_top_cities()
 
-    del countries2cities['ie']
-    del countries2cities['gb']
-
-    #
-    #
-    # Crawl
-    #
-    for country, top_cities in countries2cities.iteritems():
-        print "crawling:", country
-
-        out = []
+    metrics = telemetry_tools.get_metrics()
+    exporter = crawl_tools.start_metrics_export()
 
-        for geonames_city in top_cities:
-            lon = float(geonames_city['longitude'])
-            lat = float(geonames_city['latitude'])
+    try:
+        del countries2cities['ie']
+        del countries2cities['gb']
 
-            results = retrieve_groups_near(alt_api, lon=lon, lat=lat)
+        #
+        #
+        # Crawl
+        #
+        for country, top_cities in countries2cities.iteritems():
+            print "crawling:", country
 
-            print "\t%-20s  %d" % (geonames_city['city'], len(results)), len(frozenset(map(str, results)))
+            out = crawl_cities(alt_api, top_cities, radius, category_id=cat_id)
 
-            d = {'geonames_city' : geonames_city, 'results': results}
-            out.append(d)
+            # Save this city
+            fpath_out = './dat/groups_crawl/%s.json' % (country)
+            with metrics.timed('write_output'), open(fpath_out, 'w') as f:
+                json.dump(out, f)
 
-        # Save this city
-        fpath_out = './dat/groups_crawl/%s.json' % (country)
-        with open(fpath_out, 'w') as f:
-            json.dump(out, f)
+        alt_api.close()
+    finally:
+        exporter.stop()
+    print "http:", alt_api.transport.stats()
 
 
 if __name__ == "__main__":
@@ -20,17 +20,30 @@ __copyright__ = "Copyright (c) 2015 Matt J Williams"
 
 
 import re
+import copy
 import json
-import requests
 import urlparse
 import urllib
+import sys
+import time
+import threading
+from multiprocessing.pool import ThreadPool
+try:
+    from time import monotonic
+except ImportError:
+    from monotonic import monotonic  # backport, for Python 2
 
-import ratelim
+from decorator import decorator
 
 from meetup import Meetup
+import telemetry_tools
+from http_tools import Transport
+from cache_tools import ResponseCache, url_endpoint
 
 
 CONFIG_FPATH = 'config.json'
+API_BASE_URL = 'https://api.meetup.com/2'
+DEFAULT_METRICS_DIR = 'dat/metrics'
 RATELIM_DUR = 60 * 60   # window = 1 hour
 RATELIM_QUERIES = 1000  # window = meetup allows roughly 1080 per hour
 
@@ -44,33 +57,455 @@ def get_config():
         return config
 
 
+def get_transport():
+    """
+    Retrieve the HTTP client shared by all crawl scripts and API objects in
+    this process. See `http_tools.Transport`.
+    """
+    return Transport.get_singleton()
+
+
+def get_response_cache():
+    """
+    Retrieve the on-disk response cache configured in the config file, or
+    None if caching is not configured. See `cache_tools.ResponseCache`.
+
+    Config options:
+    response_cache_dir:     Cache directory. Caching is off if absent.
+    response_cache_max_mb:  Size cap for the cache (optional).
+    response_cache_replay:  If true, serve only from the cache and never
+                            touch the network (optional).
+    """
+    config = get_config()
+    if 'response_cache_dir' not in config:
+        return None
+    kwargs = {}
+    if 'response_cache_max_mb' in config:
+        kwargs['max_bytes'] = int(config['response_cache_max_mb'] * 1024 ** 2)
+    kwargs['replay_only'] = bool(config.get('response_cache_replay', False))
+    return ResponseCache(config['response_cache_dir'], **kwargs)
+
+
+def start_metrics_export():
+    """
+    Start periodically exporting the process's crawl metrics (see
+    `telemetry_tools`) to the directory given by config option `metrics_dir`
+    (default: dat/metrics). Returns the exporter; call its `stop` method at
+    the end of the crawl for a final export.
+    """
+    out_dir = get_config().get('metrics_dir', DEFAULT_METRICS_DIR)
+    exporter = telemetry_tools.MetricsExporter(telemetry_tools.get_metrics(), out_dir)
+    exporter.start()
+    return exporter
+
+
+def get_api_keys():
+    """
+    Retrieve the list of Meetup API keys. The config file may give a single
+    key, as `meetup_api_key`, or a list of keys, as `meetup_api_keys`.
+    """
+    config = get_config()
+    if 'meetup_api_keys' in config:
+        api_keys = list(config['meetup_api_keys'])
+    else:
+        api_keys = [config['meetup_api_key']]
+    if not api_keys:
+        raise ValueError("no Meetup API keys configured")
+    return api_keys
+
+
 def get_meetup_api():
     """
-    Retrieve the Meetup API object.
+    Retrieve the Meetup API object. Uses the first configured API key.
     """
-    api_key = get_config()['meetup_api_key']
+    api_key = get_api_keys()[0]
     api = Meetup(api_key)
     return api
 
 
+def get_api_base_url():
+    """
+    Base URL of the Meetup API: config option `meetup_api_url`, if given
+    (e.g., to crawl a local `meetup_simulator.py`), or else `API_BASE_URL`.
+    """
+    return get_config().get('meetup_api_url', API_BASE_URL)
+
+
 def get_alt_meetup_api():
     """
     Retrieve the alternative (custom) implementation of the Meetup API.
     Some parts of the official API are deprecated.
     """
-    api_key = get_config()['meetup_api_key']
-    api = AltMeetup(api_key)
+    api = AltMeetup(get_api_keys(), cache=get_response_cache(),
+                    base_url=get_api_base_url())
+    return api
+
+
+def get_concurrent_alt_meetup_api(num_workers=None):
+    """
+    Retrieve the concurrent variant of the alternative Meetup API. See
+    `ConcurrentAltMeetup`. `num_workers` defaults to config option
+    `num_workers`, if given, or else `DEFAULT_NUM_WORKERS`.
+    """
+    if num_workers is None:
+        num_workers = get_config().get('num_workers', DEFAULT_NUM_WORKERS)
+    api = ConcurrentAltMeetup(get_api_keys(), num_workers=num_workers,
+                              cache=get_response_cache(), base_url=get_api_base_url())
     return api
 
 
 DEFAULT_PAGINATION_COUNT = 200  # 200 is API default if `page` is missing
 
+
+class PageFetch(threading.Thread):
+    """
+    Fetch one page of results in the background. `result` waits for the
+    page, re-raising any exception from the fetch.
+    """
+
+    def __init__(self, query_gateway, url):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._query_gateway = query_gateway
+        self._url = url
+        self._resp = None
+        self._exc_info = None
+        self.start()
+
+    def run(self):
+        try:
+            self._resp = self._query_gateway(self._url)
+        except:
+            self._exc_info = sys.exc_info()
+
+    def result(self):
+        self.join()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._resp
+
+
+class HeaderRateLimiter(object):
+    """
+    Rate limiter driven by Meetup's `X-RateLimit-*` response headers, for a
+    single API key. Can be applied as a decorator, in the same way as
+    `ratelim.patient`, to a function that returns a response dict with a
+    'rate' sub-dictionary (see `AltMeetup.query_gateway`). `KeyPool` holds
+    one per API key.
+
+    Calls go through immediately while the server reports quota remaining.
+    Once the quota is spent, callers sleep only until the server's reset time.
+    Until a response reports the quota (at the start, and again once a
+    window has reset), only one call at a time is let through. Responses may
+    arrive out of order, so within a window the remaining quota is only ever
+    lowered, and a response reporting a later reset than the current window's
+    is ignored. If the quota is spent before any reset time is reported,
+    `max_calls` per `time_interval` seconds is assumed. Thread-safe: requests
+    still in flight are counted against the remaining quota.
+    """
+
+    PROBE_WAIT = 0.1  # secs; poll interval while the quota is unknown
+    RESET_SLACK = 1.0  # secs; reset times are reported in whole seconds
+
+    def __init__(self, max_calls, time_interval):
+        if max_calls <= 0:
+            raise ValueError("max_calls must be positive")
+        if time_interval <= 0:
+            raise ValueError("time_interval must be positive")
+        self._lock = threading.Lock()
+        self._limit = max_calls
+        self._time_interval = float(time_interval)  # seconds
+        self._remaining = 0
+        self._reset_at = None  # monotonic time at which the window resets
+        self._rate_known = False  # quota reported for the current window
+        self._in_flight = 0
+
+    def try_acquire(self):
+        """
+        Reserve a call if the quota allows it, without blocking. Returns None
+        if the call was reserved, or else the time (secs) until the quota is
+        reset.
+        """
+        with self._lock:
+            now = monotonic()
+            if self._reset_at is not None and now >= self._reset_at:
+                # window has rolled over; quota unknown until the next response
+                self._remaining = 0
+                self._reset_at = None
+                self._rate_known = False
+
+            if not self._rate_known:
+                if self._in_flight > 0:
+                    return self.PROBE_WAIT
+                self._in_flight += 1
+                return None
+
+            if self._remaining > 0:
+                self._remaining -= 1
+                self._in_flight += 1
+                return None
+
+            if self._reset_at is None:
+                # quota spent before any reset time was reported
+                self._reset_at = now + self._time_interval
+            return self._reset_at - now
+
+    def acquire(self):
+        """
+        Block until the quota allows another call, and reserve it.
+        """
+        while True:
+            to_sleep = self.try_acquire()
+            if to_sleep is None:
+                return
+            telemetry_tools.get_metrics().observe_ratelimit_wait(to_sleep)
+            time.sleep(to_sleep)
+
+    def remaining(self):
+        """
+        Calls left in the current window, as last reported by the server.
+        """
+        with self._lock:
+            return self._remaining
+
+    def release(self, rate=None):
+        """
+        Complete a call reserved by `acquire`. `rate` is the 'rate' dict of
+        the response, if one was received.
+        """
+        with self._lock:
+            self._in_flight -= 1
+            if rate is None:
+                return
+            remaining = max(0, int(rate['limit_remaining']) - self._in_flight)
+            reset_at = monotonic() + float(rate['reset'])
+            if self._rate_known and self._reset_at is not None:
+                if reset_at > self._reset_at + self.RESET_SLACK:
+                    return  # belongs to a later window than the current one
+                remaining = min(remaining, self._remaining)
+                reset_at = min(reset_at, self._reset_at)
+            self._limit = int(rate['limit'])
+            self._remaining = remaining
+            self._reset_at = reset_at
+            self._rate_known = True
+
+    def wrapped_f(self, f, *args, **kwargs):
+        self.acquire()
+        out = None
+        try:
+            out = f(*args, **kwargs)
+        finally:
+            rate = out.get('rate') if out is not None else None
+            self.release(rate)
+        return out
+
+    def __call__(self, f):
+        return decorator(self.wrapped_f, f)
+
+
+# Errors blamed on the API key, rather than on the request. A 401 or 403 may
+# equally be about the resource (e.g., a private group), so the error code of
+# the response body decides.
+KEY_INVALID = 'invalid'  # key rejected; rested for a whole window
+KEY_THROTTLED = 'throttled'  # key over quota; rested until its window resets
+KEY_INVALID_CODES = frozenset(['auth_fail', 'invalid_key'])
+KEY_THROTTLED_CODES = frozenset(['throttled', 'rate_limit'])
+THROTTLED_STATUS = 429
+KEY_THROTTLED_REST = 60  # secs; if the server gives no reset time
+
+_key_limiters = {}  # API key -> HeaderRateLimiter
+_key_limiters_lock = threading.Lock()
+
+
+def get_key_limiter(api_key):
+    """
+    Retrieve the rate limiter for API key `api_key`, shared by the process.
+    """
+    with _key_limiters_lock:
+        if api_key not in _key_limiters:
+            _key_limiters[api_key] = HeaderRateLimiter(RATELIM_QUERIES, RATELIM_DUR)
+        return _key_limiters[api_key]
+
+
+def response_rate(response):
+    """
+    The 'rate' dict (see `AltMeetup.query_gateway`) from the `X-RateLimit-*`
+    headers of `response`, or None if any of them is missing or malformed.
+    """
+    headers = response.headers
+    try:
+        rate = {
+            'limit': int(headers['X-RateLimit-Limit']),
+            'limit_remaining': int(headers['X-RateLimit-Remaining']),
+            'reset': float(headers['X-RateLimit-Reset']),
+        }
+    except (KeyError, ValueError):
+        return None
+    return rate
+
+
+class MeetupApiError(StandardError):
+    """
+    The Meetup API responded with an error status `status_code`. `code` and
+    `problem` are from the error body, if it had them; `rate` is the 'rate'
+    dict from the response's rate limit headers, if it had them (see
+    `response_rate`).
+    """
+
+    def __init__(self, url, status_code, code=None, problem=None, rate=None):
+        StandardError.__init__(self, "HTTP %s (%s: %s) for %s" % (status_code, code, problem, url))
+        self.status_code = status_code
+        self.code = code
+        self.problem = problem
+        self.rate = rate
+
+    def key_error(self):
+        """
+        `KEY_INVALID` or `KEY_THROTTLED` if the error is about the API key
+        used, or else None.
+        """
+        if self.code in KEY_INVALID_CODES:
+            return KEY_INVALID
+        if (self.status_code == THROTTLED_STATUS or self.code in KEY_THROTTLED_CODES or
+                (self.rate is not None and self.rate['limit_remaining'] == 0)):
+            return KEY_THROTTLED
+        return None
+
+
+def api_error(url, response):
+    """
+    The `MeetupApiError` for error response `response` to `url`.
+    """
+    try:
+        body = response.json()
+    except ValueError:
+        body = None
+    if not isinstance(body, dict):
+        body = {}
+    return MeetupApiError(url, response.status_code, body.get('code'), body.get('problem'),
+                          response_rate(response))
+
+
+def with_api_key(url, api_key):
+    """
+    `url` with the value of its `key` parameter replaced by `api_key`, or
+    added if it has none (e.g., a 'meta.next' URL from the response cache,
+    which is stored without credentials). Signed URLs are returned unchanged.
+    """
+    parts = urlparse.urlsplit(url)
+    params = urlparse.parse_qsl(parts.query, keep_blank_values=True)
+    if any(k == 'sig' for k, _ in params):
+        return url
+    params = [(k, v) for k, v in params if k != 'key'] + [('key', api_key)]
+    query = urllib.urlencode(params)
+    return urlparse.urlunsplit((parts.scheme, parts.netloc, parts.path, query, parts.fragment))
+
+
+class KeyPool(object):
+    """
+    Schedules requests over several API keys, each with its own rate limit
+    (see `HeaderRateLimiter`). The key with the most quota remaining is used
+    first, so throughput grows with the number of keys. Keys that have run
+    out of quota are avoided until their window resets, and keys that the
+    server has rejected for a whole window.
+
+    Thread-safe.
+    """
+
+    def __init__(self, api_keys):
+        self.api_keys = list(api_keys)
+        self._limiters = dict((key, get_key_limiter(key)) for key in self.api_keys)
+        self._lock = threading.Lock()
+        self._rested_until = dict.fromkeys(self.api_keys, 0.0)  # monotonic
+        self._invalid = set()  # keys rejected by the server on their last use
+
+    def __len__(self):
+        return len(self.api_keys)
+
+    def acquire(self):
+        """
+        Block until some key has quota, and reserve a call on it. Returns the
+        key.
+        """
+        while True:
+            by_remaining = sorted(self.api_keys, key=lambda key: -self._limiters[key].remaining())
+            waits = []
+            for api_key in by_remaining:
+                with self._lock:
+                    rest = self._rested_until[api_key] - monotonic()
+                if rest > 0:
+                    waits.append(rest)
+                    continue
+                wait = self._limiters[api_key].try_acquire()
+                if wait is None:
+                    return api_key
+                waits.append(wait)
+            telemetry_tools.get_metrics().observe_ratelimit_wait(min(waits))
+            time.sleep(min(waits))
+
+    def release(self, api_key, rate=None, key_error=None):
+        """
+        Complete a call reserved by `acquire`. `rate` is the 'rate' dict of
+        the response, if one was received. `key_error` is `KEY_INVALID` or
+        `KEY_THROTTLED` if the call failed because of the key (see
+        `MeetupApiError.key_error`). A throttled key is rested until the
+        reset time given in `rate`, if any.
+        """
+        self._limiters[api_key].release(rate)
+        if key_error == KEY_INVALID:
+            rest = RATELIM_DUR
+        elif key_error == KEY_THROTTLED:
+            rest = float(rate['reset']) if rate is not None else KEY_THROTTLED_REST
+        else:
+            with self._lock:
+                self._invalid.discard(api_key)
+            return
+        print "warning: resting API key ...%s for %.0fs (%s)" % (api_key[-4:], rest, key_error)
+        with self._lock:
+            self._rested_until[api_key] = monotonic() + rest
+            if key_error == KEY_INVALID:
+                self._invalid.add(api_key)
+
+    def all_invalid(self):
+        """
+        True if the server has rejected every key in the pool.
+        """
+        with self._lock:
+            return len(self._invalid) == len(self.api_keys)
+
+
 class AltMeetup(object):
-    def __init__(self, api_key):
-        self._api_key = api_key
-        self._base_url = 'https://api.meetup.com/2'
+    def __init__(self, api_key, transport=None, cache=None, base_url=API_BASE_URL):
+        """
+        `api_key`: Meetup API key, or list of keys. Requests are spread
+        across the keys (see `KeyPool`).
+        `transport`: HTTP client (see `http_tools.Transport`). Defaults to
+        the client shared by the process.
+        `cache`: Optional response cache (see `cache_tools.ResponseCache`).
+        `base_url`: Base URL of the API, without a trailing slash.
+        """
+        if isinstance(api_key, basestring):
+            api_key = [api_key]
+        self._key_pool = KeyPool(api_key)
+        self._api_key = self._key_pool.api_keys[0]
+        self._base_url = base_url
+        if transport is None:
+            transport = get_transport()
+        self.transport = transport
+        self.cache = cache
+
+    def uncached(self):
+        """
+        This API without its response cache, for queries whose answers must
+        be current (e.g., refreshing what was crawled before). It shares this
+        API's keys, transport and, for `ConcurrentAltMeetup`, worker pool.
+        """
+        if self.cache is None:
+            return self
+        api = copy.copy(self)
+        api.cache = None
+        return api
 
-    @ratelim.patient(RATELIM_QUERIES, RATELIM_DUR)
     def query_gateway(self, url):
         """
         Run query with complete url `url`. The main gateway to Meetup API.
@@ -84,18 +519,80 @@ class AltMeetup(object):
         rate.reset:              Time (secs) until window is reset.
 
         More info at: http://www.meetup.com/meetup_api/#limits
+
+        If the API has a response cache, responses are served from it where
+        possible, without using any of the rate limit. In the cache's replay
+        mode, a response missing from the cache raises
+        `cache_tools.CacheMissError`.
+        """
+        cache = self.cache
+        if cache is not None:
+            out = cache.get(url)
+            if out is not None:
+                telemetry_tools.get_metrics().observe_cache_hit(
+                    url_endpoint(url), len(out.get('results', [])))
+                return out
+
+        out = self._fetch(url)
+
+        if cache is not None:
+            cache.put(url, out)
+        return out
+
+    def _fetch(self, url):
+        """
+        Issue the HTTP request for `query_gateway`, on one of the API keys and
+        subject to that key's rate limit. If the server reports the key over
+        quota, the request is retried once a key is usable again (waiting in
+        `KeyPool.acquire`). If the server rejects the key, the request is
+        retried on another key, unless every key has been rejected. Other
+        errors, including a 401 or 403 for the resource asked for, are raised
+        without blaming the key.
         """
+        while True:
+            api_key = self._key_pool.acquire()
+            try:
+                out = self._request(with_api_key(url, api_key))
+            except MeetupApiError as ex:
+                key_error = ex.key_error()
+                self._key_pool.release(api_key, rate=ex.rate, key_error=key_error)
+                if key_error == KEY_THROTTLED or (key_error == KEY_INVALID and
+                                                  not self._key_pool.all_invalid()):
+                    telemetry_tools.get_metrics().observe_retry('http_%s' % ex.status_code)
+                    continue
+                raise
+            except:
+                self._key_pool.release(api_key)
+                raise
+            self._key_pool.release(api_key, rate=out['rate'])
+            return out
+
+    def _request(self, url):
+        """
+        Issue a single HTTP request, with no rate limiting. The request is
+        recorded in the process's metrics (see `telemetry_tools`).
+        """
+        metrics = telemetry_tools.get_metrics()
+        endpoint = url_endpoint(url)
         response = None
+        t_start = time.time()
         try:
-            response = requests.get(url=url)
+            response = self.transport.get(url=url)
+            latency = time.time() - t_start
+            num_bytes = int(response.headers.get('Content-Length', len(response.content)))
             if response.status_code != 200:
-                raise StandardError()
+                metrics.observe_request(endpoint, response.status_code, latency, num_bytes)
+                raise api_error(url, response)
         except StandardError as ex:
+            if response is None:
+                metrics.observe_request(endpoint, 'error', time.time() - t_start)
             print url
             print response
             raise ex
 
         out = response.json()
+        metrics.observe_request(endpoint, response.status_code, latency, num_bytes,
+                                len(out.get('results', [])))
         out['rate'] = {}
         out['rate']['limit'] = response.headers['X-RateLimit-Limit']
         out['rate']['limit_remaining'] = response.headers['X-RateLimit-Remaining']
@@ -125,29 +622,53 @@ class AltMeetup(object):
         out = self.query_gateway(url)
         return out
 
-    def query_get_all_results(self, path, params):
+    def query_iter_pages(self, path, params, prefetch=True):
         """
-        Obtain all results from an API query. Follows 'meta.next', concatenating
-        multiple HTTP responses as needed.
+        Generator over the pages of an API query. Follows 'meta.next'. Each
+        page is a list of results.
 
-        Returns: sequence of results.
+        While the caller processes a page, the next page is fetched in the
+        background, unless `prefetch` is False. (Turn off prefetching if the
+        caller may stop part-way, to avoid fetching a page it won't use.)
         """
-        results = []
-
         resp = self.query_get(path, params)
         while True:
-            # Extend results
-            results.extend(resp['results'])
-
             # Prepare for next iteration
             next_url = resp['meta']['next']
 
             #print "num results:", len(resp['results']), next_url, path, params#~
 
+            if next_url == "":
+                next_page = None
+            elif prefetch:
+                next_page = PageFetch(self.query_gateway, next_url)
+
+            yield resp['results']
+
             if next_url == "":
                 break
-            resp = self.query_gateway(next_url)
-        return results
+            if prefetch:
+                resp = next_page.result()
+            else:
+                resp = self.query_gateway(next_url)
+
+    def query_iter_results(self, path, params, prefetch=True):
+        """
+        Generator over all results from an API query, page by page. See
+        `query_iter_pages`.
+        """
+        for page in self.query_iter_pages(path, params, prefetch=prefetch):
+            for result in page:
+                yield result
+
+    def query_get_all_results(self, path, params):
+        """
+        Obtain all results from an API query. Follows 'meta.next', concatenating
+        multiple HTTP responses as needed.
+
+        Returns: sequence of results.
+        """
+        return list(self.query_iter_results(path, params))
 
     def cities(self, **kwargs):
         params = kwargs
@@ -178,4 +699,67 @@ class AltMeetup(object):
         ret = self.query_get_all_results('rsvps', params)
         return ret
 
+    def iter_groups(self, **kwargs):
+        """Returns generator of results (groups), streamed page by page."""
+        return self.query_iter_results('groups', kwargs)
+
+    def iter_members(self, **kwargs):
+        """Returns generator of results (members), streamed page by page."""
+        return self.query_iter_results('members', kwargs)
+
+    def iter_events(self, **kwargs):
+        """Returns generator of results (events), streamed page by page."""
+        return self.query_iter_results('events', kwargs)
+
+    def iter_rsvps(self, **kwargs):
+        """Returns generator of results (rsvps), streamed page by page."""
+        return self.query_iter_results('rsvps', kwargs)
+
 
+#
+# Concurrent crawling
+
+DEFAULT_NUM_WORKERS = 8  # requests in flight at once
+
+
+class ConcurrentAltMeetup(AltMeetup):
+    """
+    Counterpart of `AltMeetup` that keeps many requests in flight at once.
+
+    `groups`, `members`, `events` and `rsvps` are unchanged and may be called
+    from any thread. `imap` and `imap_unordered` fan a function out over a
+    pool of `num_workers` threads, e.g., to expand many groups at once. All
+    workers draw from the same per-key rate budgets (see `KeyPool`), so the
+    crawl stays inside the same window; only the network round trips
+    overlap.
+
+    Threads are used (rather than asyncio) because the crawl runs on
+    Python 2; `requests` and `pymongo` are both thread-safe.
+    """
+
+    def __init__(self, api_key, num_workers=DEFAULT_NUM_WORKERS, transport=None,
+                 cache=None, base_url=API_BASE_URL):
+        AltMeetup.__init__(self, api_key, transport=transport, cache=cache,
+                           base_url=base_url)
+        self._pool = ThreadPool(num_workers)
+
+    def imap(self, func, iterable):
+        """
+        Apply `func` to each item of `iterable` across the worker pool.
+        Results are yielded in input order. An exception raised by `func`
+        is re-raised when its result is reached.
+        """
+        return self._pool.imap(func, iterable)
+
+    def imap_unordered(self, func, iterable):
+        """
+        As `imap`, but results are yielded as soon as they are ready.
+        """
+        return self._pool.imap_unordered(func, iterable)
+
+    def close(self):
+        """
+        Shut down the worker pool once outstanding work has finished.
+        """
+        self._pool.close()
+        self._pool.join()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+#
+# Author:   Matt J Williams
+#           http://www.mattjw.net
+#           mattjw@mattjw.net
+# Date:     2015
+# License:  MIT License
+#           http://opensource.org/licenses/MIT
+
+
+"""
+Export the crawled Mongo data to columnar tables (see `columnar_tools`), one
+each for groups, events, group memberships, event attendance and users.
+Documents are streamed from Mongo, so memory use does not grow with the
+size of the crawl (beyond the string dictionaries).
+
+Tables are written to a temporary directory which then replaces the output
+directory, so readers never see a partial export.
+
+Read a table with, e.g.:
+    reader = columnar_tools.TableReader('dat/columnar/events')
+    cols = reader.columns(['group_id', 'time'])
+
+Usage:
+    python export_columnar.py [--out dat/columnar]
+"""
+
+
+__author__ = "Matt J Williams"
+__author_email__ = "mattjw@mattjw.net"
+__license__ = "MIT"
+__copyright__ = "Copyright (c) 2015 Matt J Williams"
+
+
+import os
+import shutil
+import argparse
+
+import storage_tools
+from columnar_tools import TableWriter, INT64, INT32, FLOAT64, STRING
+from storage_tools import COLL_USERS, COLL_GROUPS, COLL_ATTENDANCE
+
+
+DEFAULT_OUT_DIR = 'dat/columnar'
+CURSOR_BATCH_SIZE = 1000
+
+GROUP_COLUMNS = [
+    ('group_id', INT64), ('name', STRING), ('urlname', STRING),
+    ('city', STRING), ('state', STRING), ('country', STRING),
+    ('lat', FLOAT64), ('lon', FLOAT64), ('members', INT64),
+    ('created', INT64), ('num_events', INT32),
+]
+EVENT_COLUMNS = [
+    ('event_id', STRING), ('group_id', INT64), ('time', INT64),
+    ('yes_rsvp_count', INT64), ('status', STRING), ('name', STRING),
+]
+MEMBERSHIP_COLUMNS = [('group_id', INT64), ('member_id', INT64)]
+ATTENDANCE_COLUMNS = [('event_id', STRING), ('member_id', INT64)]
+USER_COLUMNS = [
+    ('member_id', INT64), ('name', STRING), ('city', STRING),
+    ('state', STRING), ('country', STRING), ('lat', FLOAT64),
+    ('lon', FLOAT64), ('joined', INT64), ('status', STRING),
+]
+
+
+def export_groups(mdb, out_dir):
+    """
+    Write the groups, events and memberships tables, from the groups
+    collection (with its embedded events and member IDs).
+    """
+    cursor = mdb[COLL_GROUPS].find(batch_size=CURSOR_BATCH_SIZE)
+    with TableWriter(os.path.join(out_dir, 'groups'), GROUP_COLUMNS) as groups, \
+            TableWriter(os.path.join(out_dir, 'events'), EVENT_COLUMNS) as events, \
+            TableWriter(os.path.join(out_dir, 'memberships'), MEMBERSHIP_COLUMNS) as memberships:
+        for group in cursor:
+            gid = group['_id']
+            group_events = group.get('events_in_window', [])
+            row = dict(group, group_id=gid, num_events=len(group_events))
+            groups.append(row)
+            for event in group_events:
+                events.append(dict(event, event_id=event['id'], group_id=gid))
+            for member_id in group.get('member_ids', []):
+                memberships.append({'group_id': gid, 'member_id': member_id})
+    return groups.num_rows, events.num_rows, memberships.num_rows
+
+
+def export_attendance(mdb, out_dir):
+    cursor = mdb[COLL_ATTENDANCE].find(batch_size=CURSOR_BATCH_SIZE)
+    with TableWriter(os.path.join(out_dir, 'attendance'), ATTENDANCE_COLUMNS) as attendance:
+        for doc in cursor:
+            for member_id in doc['attendee_ids']:
+                attendance.append({'event_id': doc['_id'], 'member_id': member_id})
+    return attendance.num_rows
+
+
+def export_users(mdb, out_dir):
+    cursor = mdb[COLL_USERS].find(batch_size=CURSOR_BATCH_SIZE)
+    with TableWriter(os.path.join(out_dir, 'users'), USER_COLUMNS) as users:
+        for user in cursor:
+            users.append(dict(user, member_id=user['_id']))
+    return users.num_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the crawl to columnar tables")
+    parser.add_argument('--out', default=DEFAULT_OUT_DIR)
+    args = parser.parse_args()
+
+    mdb = storage_tools.mongo_connect()
+    tmp_dir = args.out.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+
+    num_groups, num_events, num_memberships = export_groups(mdb, tmp_dir)
+    print "groups: %d | events: %d | memberships: %d" % (num_groups, num_events, num_memberships)
+    print "attendance: %d" % export_attendance(mdb, tmp_dir)
+    print "users: %d" % export_users(mdb, tmp_dir)
+
+    if os.path.exists(args.out):
+        shutil.rmtree(args.out)
+    os.rename(tmp_dir, args.out)
+    print "saved to", args.out
+
+
+if __name__ == "__main__":
+    main()
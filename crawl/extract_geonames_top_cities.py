@@ -8,8 +8,18 @@
 #           http://opensource.org/licenses/MIT
 
 
-import unicodecsv as csv
-import json
+"""
+Extract the top cities (by population) of each country from the Geonames
+gazetteer.
+
+The columns needed from `cities1000.txt` are parsed once and cached in a
+compact binary index alongside it, which is rebuilt whenever the gazetteer
+file changes. The top cities are then selected in a single pass over the
+index, keeping a bounded heap per country.
+
+Usage:
+    python extract_geonames_top_cities.py [--countries us,gb,ie | all] [--max-cities 200]
+"""
 
 
 __author__ = "Matt J Williams"
@@ -18,6 +28,173 @@ __license__ = "MIT"
 __copyright__ = "Copyright (c) 2015 Matt J Williams"
 
 
+import os
+import json
+import heapq
+import struct
+import argparse
+from array import array
+
+
+GEONAMES_FPATH = 'dat/geonames_cities/cities1000.txt'
+INDEX_FPATH = 'dat/geonames_cities/cities1000.idx'
+OUT_FPATH = 'dat/geonames_top_cities.json'
+DEFAULT_COUNTRIES = ['us', 'gb', 'ie']
+DEFAULT_MAX_CITIES = 200
+
+# columns of the Geonames dump; see http://download.geonames.org/export/dump/
+COL_NAME = 1
+COL_LATITUDE = 4
+COL_LONGITUDE = 5
+COL_COUNTRY = 8
+COL_ADMIN1 = 10
+COL_POPULATION = 14
+
+INDEX_MAGIC = 'GNIDX1'
+INDEX_HEADER = struct.Struct('<6sdqI')  # magic, source mtime, source size, rows
+
+
+class GeonamesIndex(object):
+    """
+    Columns of the Geonames gazetteer needed to pick top cities, one entry
+    per row: `names`, `admin1` (utf-8 strings), `countries` (lower-case alpha2
+    codes), `populations`, `latitudes` and `longitudes` (arrays).
+    """
+
+    def __init__(self):
+        self.names = []
+        self.admin1 = []
+        self.countries = []
+        self.populations = array('i')
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+
+    def __len__(self):
+        return len(self.populations)
+
+    def city(self, row):
+        """
+        City at `row`, in the output format of this script.
+        """
+        return {'city': self.names[row].decode('utf-8'),
+                'state': self.admin1[row].decode('utf-8'),
+                'population': self.populations[row],
+                'longitude': self.longitudes[row],
+                'latitude': self.latitudes[row]}
+
+    @classmethod
+    def parse(cls, fpath):
+        """
+        Parse the gazetteer file `fpath`, line by line.
+        """
+        index = cls()
+        names, admin1, countries = index.names, index.admin1, index.countries
+        pops, lats, lons = index.populations, index.latitudes, index.longitudes
+        with open(fpath, 'rb') as f:
+            for line in f:
+                # split no further than the last column needed
+                row = line.split('\t', COL_POPULATION + 1)
+                names.append(row[COL_NAME])
+                admin1.append(row[COL_ADMIN1])
+                countries.append(row[COL_COUNTRY].lower())
+                pops.append(int(row[COL_POPULATION]))
+                lats.append(float(row[COL_LATITUDE]))
+                lons.append(float(row[COL_LONGITUDE]))
+        return index
+
+    def save(self, fpath, source_stat):
+        """
+        Write the index to `fpath`, recording `source_stat` (the `os.stat`
+        of the gazetteer file) to detect when it is out of date.
+        """
+        tmp_fpath = fpath + '.tmp'
+        with open(tmp_fpath, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, source_stat.st_mtime,
+                                      source_stat.st_size, len(self)))
+            for arr in [self.populations, self.latitudes, self.longitudes]:
+                arr.tofile(f)
+            for strings in [self.names, self.admin1, self.countries]:
+                blob = '\0'.join(strings)
+                f.write(struct.pack('<q', len(blob)))
+                f.write(blob)
+        os.rename(tmp_fpath, fpath)
+
+    @classmethod
+    def load(cls, fpath, source_stat):
+        """
+        Read the index from `fpath`. Returns None if there is no index, or
+        if it was built from a different version of the gazetteer.
+        """
+        if not os.path.exists(fpath):
+            return None
+        index = cls()
+        with open(fpath, 'rb') as f:
+            header = f.read(INDEX_HEADER.size)
+            if len(header) != INDEX_HEADER.size:
+                return None
+            magic, mtime, size, num_rows = INDEX_HEADER.unpack(header)
+            if (magic != INDEX_MAGIC or mtime != source_stat.st_mtime or
+                    size != source_stat.st_size):
+                return None
+            try:
+                for arr in [index.populations, index.latitudes, index.longitudes]:
+                    arr.fromfile(f, num_rows)
+                for strings in [index.names, index.admin1, index.countries]:
+                    blob_len, = struct.unpack('<q', f.read(8))
+                    strings.extend(f.read(blob_len).split('\0') if num_rows else [])
+            except (EOFError, struct.error):
+                return None
+        if not (len(index.names) == len(index.admin1) == len(index.countries) == num_rows):
+            return None
+        return index
+
+
+def load_geonames_index(fpath=GEONAMES_FPATH, index_fpath=INDEX_FPATH):
+    """
+    Load the `GeonamesIndex` of gazetteer file `fpath`, from its cached index
+    `index_fpath` if that is up to date, and otherwise by parsing the
+    gazetteer (and re-caching the index).
+    """
+    source_stat = os.stat(fpath)
+    index = GeonamesIndex.load(index_fpath, source_stat)
+    if index is None:
+        index = GeonamesIndex.parse(fpath)
+        index.save(index_fpath, source_stat)
+    return index
+
+
+def top_cities(index, countries=None, max_cities=DEFAULT_MAX_CITIES):
+    """
+    Top `max_cities` cities by population for each country in `countries`
+    (lower-case alpha2 codes), or for every country if `countries` is None.
+    Cities of equal population keep their gazetteer order.
+
+    Returns dict mapping country code to list of cities, most populous first.
+    """
+    heaps = {}  # country -> min-heap of (population, -row)
+    if countries is not None:
+        for cc in countries:
+            heaps[cc] = []
+    pops = index.populations
+    for row, cc in enumerate(index.countries):
+        heap = heaps.get(cc)
+        if heap is None:
+            if countries is not None:
+                continue
+            heap = heaps[cc] = []
+        item = (pops[row], -row)
+        if len(heap) < max_cities:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+    out = {}
+    for cc, heap in heaps.iteritems():
+        heap.sort(reverse=True)
+        out[cc] = [index.city(-neg_row) for _, neg_row in heap]
+    return out
+
+
 def load_geonames_cities(countries):
     """
     Return list of cities of the world. Via geonames dump.
@@ -27,37 +204,30 @@ def load_geonames_cities(countries):
     Returns dict of mappings from a country code in `countries` to list
     of cities. Assumes countries are lower-case alpha2 codes.
     """
-    fpath = 'dat/geonames_cities/cities1000.txt'
-    fields = 'geonameid,name,asciiname,alternatenames,latitude,longitude,feature_class,feature_code,country_code,cc2,admin1_code,admin2_code,admin3_code,admin4_code,population,elevation,dem,timezone,modification_date'.split(',')
-    
+    index = load_geonames_index()
     out = {code: [] for code in countries}
-
-    with open(fpath) as fp:
-        rdr = csv.DictReader(fp, fieldnames=fields, delimiter='\t', quoting=csv.QUOTE_NONE)
-        for row in rdr:
-            cc = row['country_code'].lower()
-            if cc in countries:
-                lat = float(row['latitude'])
-                lon = float(row['longitude'])
-                name = row['name']
-                ad1 = row['admin1_code']
-                pop = int(row['population'])
-                
-                out[cc].append({'city': name, 'state': ad1, 'population': pop,
-                                'longitude': lon, 'latitude': lat})
+    for row, cc in enumerate(index.countries):
+        if cc in out:
+            out[cc].append(index.city(row))
     return out
 
 
 def main():
-    max_cities = 200
+    parser = argparse.ArgumentParser(description="Extract top cities from the Geonames gazetteer")
+    parser.add_argument('--countries', default=','.join(DEFAULT_COUNTRIES),
+                        help="comma-separated alpha2 codes, or 'all'")
+    parser.add_argument('--max-cities', type=int, default=DEFAULT_MAX_CITIES)
+    args = parser.parse_args()
+
+    if args.countries == 'all':
+        countries = None
+    else:
+        countries = [cc.strip().lower() for cc in args.countries.split(',')]
 
-    countries2cities = load_geonames_cities(['us', 'gb', 'ie'])
-    for country, cities in countries2cities.items():
-        cities.sort(key=lambda city: -city['population'])
-        cities = cities[:min([max_cities, len(cities)])]
-        countries2cities[country] = cities
+    index = load_geonames_index()
+    countries2cities = top_cities(index, countries, args.max_cities)
 
-    with open('dat/geonames_top_cities.json', 'w') as f:
+    with open(OUT_FPATH, 'w') as f:
         json.dump(countries2cities, f)
 
 
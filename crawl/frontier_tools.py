@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+#
+# Author:   Matt J Williams
+#           http://www.mattjw.net
+#           mattjw@mattjw.net
+# Date:     2015
+# License:  MIT License
+#           http://opensource.org/licenses/MIT
+
+
+"""
+Persistent crawl frontier, held in MongoDB.
+
+Each unit of crawl work is a job document in the frontier collection. A
+worker leases a job, renews the lease with a heartbeat while it works, and
+marks the job done when finished. Any number of worker processes (on any
+number of machines) may drain the frontier together. If a worker dies, its
+leases expire and the jobs are handed to other workers.
+
+Job document:
+    _id:            '<kind>:<key>'; adding a job twice has no effect.
+    kind:           Type of job, e.g., 'expand_group'.
+    payload:        Dict of job parameters.
+    state:          'pending', 'leased', 'done' or 'failed'.
+    owner:          Worker ID holding the lease.
+    lease_expires:  When the lease lapses (UTC).
+    attempts:       Number of times the job has been leased.
+    error:          Last error, if any.
+"""
+
+
+__author__ = "Matt J Williams"
+__author_email__ = "mattjw@mattjw.net"
+__license__ = "MIT"
+__copyright__ = "Copyright (c) 2015 Matt J Williams"
+
+
+import os
+import socket
+import threading
+import traceback
+from datetime import datetime, timedelta
+
+import pymongo
+from pymongo import ReturnDocument
+
+import storage_tools
+import telemetry_tools
+
+
+COLL_FRONTIER = 'crawl_frontier'
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+DEFAULT_LEASE_SECS = 5 * 60
+MAX_ATTEMPTS = 5  # a job that fails this many times is marked failed
+
+
+def default_worker_id():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class Frontier(object):
+    """
+    Crawl frontier in collection `COLL_FRONTIER` of `mdb`.
+
+    `worker_id`: Identifies this worker's leases. Defaults to host and PID.
+    `lease_secs`: How long a lease lasts without a heartbeat.
+    """
+
+    def __init__(self, mdb, worker_id=None, lease_secs=DEFAULT_LEASE_SECS):
+        self.coll = mdb[COLL_FRONTIER]
+        self.worker_id = worker_id if worker_id is not None else default_worker_id()
+        self.lease_secs = lease_secs
+        self.coll.create_index([('state', pymongo.ASCENDING),
+                                ('kind', pymongo.ASCENDING),
+                                ('created', pymongo.ASCENDING)])
+        self.coll.create_index([('lease_expires', pymongo.ASCENDING)])
+
+    def add_jobs(self, jobs):
+        """
+        Add jobs to the frontier. `jobs` is a sequence of tuples
+        (kind, key, payload). Jobs already in the frontier (in any state) are
+        left untouched.
+
+        Returns the number of jobs added.
+        """
+        now = datetime.utcnow()
+        docs = []
+        for kind, key, payload in jobs:
+            doc = {'_id': '%s:%s' % (kind, key), 'kind': kind,
+                   'payload': payload, 'state': PENDING, 'owner': None,
+                   'lease_expires': None, 'attempts': 0, 'error': None,
+                   'created': now}
+            docs.append(doc)
+        return storage_tools.insert_new(self.coll, docs)
+
+    def lease(self, kinds=None):
+        """
+        Lease the oldest job available: one that is pending, or whose lease
+        has expired. `kinds` optionally restricts the kinds of job.
+
+        Returns the job document, or None if no job is available.
+        """
+        now = datetime.utcnow()
+        query = {'$or': [{'state': PENDING},
+                         {'state': LEASED, 'lease_expires': {'$lt': now}}]}
+        if kinds is not None:
+            query['kind'] = {'$in': list(kinds)}
+        update = {'$set': {'state': LEASED, 'owner': self.worker_id,
+                           'lease_expires': now + timedelta(seconds=self.lease_secs)},
+                  '$inc': {'attempts': 1}}
+        return self.coll.find_one_and_update(
+            query, update, sort=[('created', pymongo.ASCENDING)],
+            return_document=ReturnDocument.AFTER)
+
+    def _owned(self, job):
+        return {'_id': job['_id'], 'state': LEASED, 'owner': self.worker_id}
+
+    def heartbeat(self, job):
+        """
+        Renew the lease on `job`. Returns False if the lease has been lost
+        (e.g., it lapsed and another worker took the job).
+        """
+        expires = datetime.utcnow() + timedelta(seconds=self.lease_secs)
+        ret = self.coll.update_one(self._owned(job), {'$set': {'lease_expires': expires}})
+        return ret.matched_count == 1
+
+    def complete(self, job):
+        self.coll.update_one(self._owned(job), {'$set': {
+            'state': DONE, 'owner': None, 'lease_expires': None}})
+
+    def fail(self, job, error):
+        """
+        Release `job` after an error. It is retried later, unless it has
+        already been attempted `MAX_ATTEMPTS` times.
+        """
+        state = FAILED if job['attempts'] >= MAX_ATTEMPTS else PENDING
+        self.coll.update_one(self._owned(job), {'$set': {
+            'state': state, 'owner': None, 'lease_expires': None,
+            'error': error}})
+
+    def counts(self):
+        """
+        Returns dict mapping (kind, state) to number of jobs.
+        """
+        pipeline = [{'$group': {'_id': {'kind': '$kind', 'state': '$state'},
+                                'n': {'$sum': 1}}}]
+        out = {}
+        for row in self.coll.aggregate(pipeline):
+            out[(row['_id']['kind'], row['_id']['state'])] = row['n']
+        return out
+
+    def run_job(self, job, handler):
+        """
+        Run `handler(payload)` for leased `job`, with a heartbeat renewing
+        the lease meanwhile. The job is completed if the handler returns, or
+        failed if it raises.
+
+        Returns True if the job completed.
+        """
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.lease_secs / 3.0):
+                if not self.heartbeat(job):
+                    break
+
+        beater = threading.Thread(target=beat)
+        beater.daemon = True
+        beater.start()
+        try:
+            with telemetry_tools.get_metrics().timed('job_%s' % job['kind']):
+                handler(job['payload'])
+        except Exception:
+            self.fail(job, traceback.format_exc())
+            return False
+        finally:
+            stop.set()
+            beater.join()
+        self.complete(job)
+        return True
+
+    def drain(self, handlers):
+        """
+        Lease and run jobs until none remain available. `handlers` maps
+        job kind to a function taking the job payload; only those kinds are
+        leased. Handlers may add further jobs.
+
+        Returns tuple (number completed, number failed).
+        """
+        num_done = 0
+        num_failed = 0
+        while True:
+            job = self.lease(kinds=handlers.keys())
+            if job is None:
+                break
+            if self.run_job(job, handlers[job['kind']]):
+                num_done += 1
+            else:
+                num_failed += 1
+                print "[warning | job %s failed]" % job['_id']
+        return num_done, num_failed
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#
+# Author:   Matt J Williams
+#           http://www.mattjw.net
+#           mattjw@mattjw.net
+# Date:     2015
+# License:  MIT License
+#           http://opensource.org/licenses/MIT
+
+
+"""
+HTTP transport for the crawl. A single pooled, keep-alive `requests` session
+with gzip negotiation, shared by every `AltMeetup` in the process.
+"""
+
+
+__author__ = "Matt J Williams"
+__author_email__ = "mattjw@mattjw.net"
+__license__ = "MIT"
+__copyright__ = "Copyright (c) 2015 Matt J Williams"
+
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+POOL_HOSTS = 4  # number of hosts to keep connection pools for
+POOL_MAXSIZE = 10  # max connections kept alive per host
+ACCEPT_ENCODING = 'gzip, deflate'
+
+
+class Transport(object):
+    """
+    Pooled HTTP client. Connections to each host are kept alive and re-used
+    between requests. At most `pool_maxsize` connections are open to a host
+    at once; further requests block until one is free.
+
+    `stats` reports how many requests re-used a pooled connection and how
+    many needed a new one (i.e., paid for a TCP+TLS handshake).
+    """
+
+    def __init__(self, pool_hosts=POOL_HOSTS, pool_maxsize=POOL_MAXSIZE):
+        self._adapter = HTTPAdapter(pool_connections=pool_hosts,
+                                    pool_maxsize=pool_maxsize, pool_block=True)
+        self._session = requests.Session()
+        self._session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+        self._session.mount('https://', self._adapter)
+        self._session.mount('http://', self._adapter)
+
+        self._lock = threading.Lock()
+        self._num_compressed = 0
+        self._bytes_received = 0
+
+    def get(self, url, **kwargs):
+        """
+        Issue a GET request. Returns a `requests` response, already
+        decompressed.
+        """
+        response = self._session.get(url, **kwargs)
+        encoding = response.headers.get('Content-Encoding', '')
+        length = response.headers.get('Content-Length')
+        with self._lock:
+            if encoding in ('gzip', 'deflate'):
+                self._num_compressed += 1
+            if length is not None:
+                self._bytes_received += int(length)
+        return response
+
+    def stats(self):
+        """
+        Returns dict of counters:
+
+        requests:              Requests issued through the pool.
+        new_connections:       Requests that opened a new connection.
+        reused_connections:    Requests that re-used a kept-alive connection.
+        compressed_responses:  Responses received gzip/deflate-encoded.
+        bytes_received:        Response body bytes, as sent on the wire.
+        """
+        num_requests = 0
+        num_connections = 0
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            num_requests += pool.num_requests
+            num_connections += pool.num_connections
+        with self._lock:
+            return {
+                'requests': num_requests,
+                'new_connections': num_connections,
+                'reused_connections': num_requests - num_connections,
+                'compressed_responses': self._num_compressed,
+                'bytes_received': self._bytes_received,
+            }
+
+    def close(self):
+        self._session.close()
+
+    __singleton = None
+    __singleton_lock = threading.Lock()
+    @staticmethod
+    def get_singleton():
+        with Transport.__singleton_lock:
+            if Transport.__singleton is None:
+                Transport.__singleton = Transport()
+        return Transport.__singleton
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+#
+# Author:   Matt J Williams
+#           http://www.mattjw.net
+#           mattjw@mattjw.net
+# Date:     2015
+# License:  MIT License
+#           http://opensource.org/licenses/MIT
+
+
+"""
+Compact in-memory sets of integer IDs (users, groups). Standard library
+only, so that offline steps can use them without the crawl's dependencies.
+"""
+
+
+__author__ = "Matt J Williams"
+__author_email__ = "mattjw@mattjw.net"
+__license__ = "MIT"
+__copyright__ = "Copyright (c) 2015 Matt J Williams"
+
+
+import bisect
+from array import array
+
+
+INT_SET_MERGE_SIZE = 1 << 16  # recent additions held before merging
+
+
+def _id_typecode():
+    """
+    Array typecode for IDs: an 8-byte integer type where the platform has one
+    ('l' on 64-bit Unix; Python 2 has no 'q'), or else doubles, which hold
+    integers exactly up to 2**53.
+    """
+    for typecode in ['l', 'q']:
+        try:
+            if array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+    return 'd'
+
+
+ID_TYPECODE = _id_typecode()
+
+
+class IntIdSet(object):
+    """
+    Compact set of integers: a sorted array of 8-byte numbers (see
+    `ID_TYPECODE`), plus a small set of recent additions that is merged in
+    once it grows large.
+    """
+
+    def __init__(self, ids=()):
+        self._sorted = array(ID_TYPECODE, sorted(frozenset(ids)))
+        self._recent = set()
+
+    def __contains__(self, i):
+        if i in self._recent:
+            return True
+        arr = self._sorted
+        pos = bisect.bisect_left(arr, i)
+        return pos < len(arr) and arr[pos] == i
+
+    def __len__(self):
+        return len(self._sorted) + len(self._recent)
+
+    def add(self, i):
+        if i in self:
+            return
+        self._recent.add(i)
+        if len(self._recent) >= INT_SET_MERGE_SIZE:
+            merged = sorted(self._recent)
+            merged.extend(self._sorted)
+            merged.sort()
+            self._sorted = array(ID_TYPECODE, merged)
+            self._recent = set()
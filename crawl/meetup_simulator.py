@@ -0,0 +1,577 @@
+# -*- coding: utf-8 -*-
+#
+# Author:   Matt J Williams
+#           http://www.mattjw.net
+#           mattjw@mattjw.net
+# Date:     2015
+# License:  MIT License
+#           http://opensource.org/licenses/MIT
+
+
+"""
+Local stand-in for the Meetup API, backed by a synthetic corpus, so that the
+crawl can be run (and its performance measured) without the live API.
+
+Serves the `/2/groups`, `/2/members`, `/2/events`, `/2/rsvps` and `/2/cities`
+queries made by the crawl scripts, with the API's pagination (`page`,
+`offset` and `meta.next`) and `X-RateLimit-*` headers. Each API key has its
+own fixed rate window; requests beyond it get HTTP 429. Response latency and
+a rate of error responses can be configured. Responses are gzipped if the
+client accepts it.
+
+To crawl the simulator, add `"meetup_api_url": "http://localhost:8080/2"` to
+`config.json`. Any API key is accepted.
+
+Usage:
+    python meetup_simulator.py [--port 8080] [--num-cities 20] [--latency 0.05] ...
+"""
+
+
+__author__ = "Matt J Williams"
+__author_email__ = "mattjw@mattjw.net"
+__license__ = "MIT"
+__copyright__ = "Copyright (c) 2015 Matt J Williams"
+
+
+import math
+import json
+import gzip
+import time
+import random
+import string
+import urllib
+import urlparse
+import argparse
+import threading
+from StringIO import StringIO
+from datetime import datetime
+from collections import defaultdict
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+
+DEFAULT_PORT = 8080
+DEFAULT_NUM_CITIES = 20
+DEFAULT_GROUPS_PER_CITY = 10
+DEFAULT_RATE_LIMIT = 30  # requests per window per key, as the live API
+DEFAULT_RATE_WINDOW = 10  # secs
+DEFAULT_LATENCY = 0.05  # secs
+
+MAX_PAGE = 200
+DEFAULT_RADIUS = 25.0  # miles
+EARTH_RADIUS = 3959.0  # miles
+GZIP_MIN_BYTES = 1024
+
+CATEGORY_TECH = 34
+SIM_NOW = datetime(2016, 1, 1)  # all simulated events are before this
+
+
+def epoch_ms(dt):
+    return int((dt - datetime.utcfromtimestamp(0)).total_seconds() * 1000)
+
+
+def distance_miles(lat1, lon1, lat2, lon2):
+    """
+    Great-circle (haversine) distance between two points.
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+#
+# Synthetic corpus
+
+class SyntheticCorpus(object):
+    """
+    Randomly generated, but reproducible (for a given `seed`), Meetup data:
+    `num_cities` cities with `groups_per_city` tech groups around each. Group
+    sizes are heavy-tailed, and members are shared between groups. Each group
+    has past events, with RSVPs from its members. A small share of users have
+    deleted their accounts: they appear in RSVPs, but not from `members`.
+    """
+
+    def __init__(self, num_cities=DEFAULT_NUM_CITIES, groups_per_city=DEFAULT_GROUPS_PER_CITY,
+                 max_members=2000, max_events=60, deleted_fraction=0.01, seed=0):
+        rng = random.Random(seed)
+        self.cities = []
+        self.groups = []
+        self.users = {}  # user ID -> user
+        self.group_members = {}  # group ID -> user IDs
+        self.events = []
+        self.event_rsvps = {}  # event ID -> list of (user ID, response)
+        self.group_events = defaultdict(list)  # group ID -> events, by time
+
+        joined_from = epoch_ms(datetime(2008, 1, 1))
+        joined_to = epoch_ms(datetime(2015, 12, 1))
+        events_from = epoch_ms(datetime(2011, 6, 1))
+        events_to = epoch_ms(SIM_NOW) - 1
+
+        for indx in xrange(num_cities):
+            self.cities.append({
+                'id': 90000 + indx,
+                'city': 'City %d' % indx,
+                'state': rng.choice(['CA', 'NY', 'TX', 'WA', 'IL', 'MA']),
+                'country': 'us',
+                'lat': rng.uniform(30.0, 47.0),
+                'lon': rng.uniform(-120.0, -75.0),
+                'population': int(rng.paretovariate(1.0) * 20000),
+            })
+        self.cities.sort(key=lambda city: -city['population'])
+        for ranking, city in enumerate(self.cities):
+            city['ranking'] = ranking
+
+        # users are drawn from one pool, so that groups share members
+        sizes = [min(max_members, int(rng.paretovariate(1.1) * 15))
+                 for _ in xrange(num_cities * groups_per_city)]
+        num_users = max(1, int(sum(sizes) * 0.6))
+        user_ids = range(100000, 100000 + num_users)
+        for uid in user_ids:
+            city = rng.choice(self.cities)
+            self.users[uid] = {
+                'id': uid,
+                'name': 'Member %d' % uid,
+                'link': 'http://www.meetup.com/members/%d' % uid,
+                'city': city['city'], 'state': city['state'], 'country': 'us',
+                'lat': city['lat'], 'lon': city['lon'],
+                'joined': rng.randint(joined_from, joined_to),
+                'visited': joined_to,
+                'status': 'active',
+            }
+        self.deleted_user_ids = frozenset(rng.sample(user_ids, int(num_users * deleted_fraction)))
+
+        gid = 1000
+        for city in self.cities:
+            for _ in xrange(groups_per_city):
+                size = min(sizes[len(self.groups)], num_users)
+                gid += 1
+                group = {
+                    'id': gid,
+                    'name': 'Tech Group %d' % gid,
+                    'urlname': 'tech-group-%d' % gid,
+                    'link': 'http://www.meetup.com/tech-group-%d/' % gid,
+                    'city': city['city'], 'state': city['state'], 'country': 'US',
+                    'lat': city['lat'] + rng.uniform(-0.15, 0.15),
+                    'lon': city['lon'] + rng.uniform(-0.15, 0.15),
+                    'members': size,
+                    'category': {'id': CATEGORY_TECH, 'name': 'tech', 'shortname': 'tech'},
+                    'created': rng.randint(joined_from, joined_to),
+                    'updated': joined_to,
+                    'join_mode': 'open',
+                    'visibility': 'public',
+                    'who': 'Members',
+                    'rating': round(rng.uniform(3.5, 5.0), 2),
+                }
+                self.groups.append(group)
+                members = rng.sample(user_ids, size)
+                self.group_members[gid] = members
+
+                for _ in xrange(rng.randint(0, max_events)):
+                    event = self._make_event(rng, group, events_from, events_to)
+                    num_yes = min(size, int(rng.expovariate(1.0 / 15)))
+                    attendees = rng.sample(members, num_yes)
+                    rsvps = [(uid, 'yes') for uid in attendees]
+                    # a few declined RSVPs, filtered out by `rsvp=yes`
+                    rsvps.extend((uid, 'no') for uid in rng.sample(members, min(size, 2)))
+                    event['yes_rsvp_count'] = num_yes
+                    self.events.append(event)
+                    self.event_rsvps[event['id']] = rsvps
+                    self.group_events[gid].append(event)
+                self.group_events[gid].sort(key=lambda event: event['time'])
+
+        self.id2group = dict((group['id'], group) for group in self.groups)
+        self.id2event = dict((event['id'], event) for event in self.events)
+
+    @staticmethod
+    def _make_event(rng, group, events_from, events_to):
+        if rng.random() < 0.5:
+            event_id = ''.join(rng.choice(string.ascii_lowercase) for _ in xrange(12))
+        else:
+            event_id = str(rng.randint(10 ** 8, 10 ** 9))
+        t = rng.randint(events_from, events_to)
+        return {
+            'id': event_id,
+            'name': 'Meetup %s' % event_id,
+            'time': t,
+            'created': t - 14 * 24 * 3600 * 1000,
+            'updated': t,
+            'utc_offset': -18000000,
+            'duration': 3 * 3600 * 1000,
+            'status': 'past',
+            'visibility': 'public',
+            'group': {'id': group['id'], 'name': group['name'], 'urlname': group['urlname']},
+        }
+
+    def geonames_cities(self):
+        """
+        The cities, in the format output by `extract_geonames_top_cities.py`.
+        """
+        return [{'city': city['city'], 'state': city['state'],
+                 'population': city['population'],
+                 'latitude': city['lat'], 'longitude': city['lon']}
+                for city in self.cities]
+
+
+#
+# API
+
+class ApiError(Exception):
+    def __init__(self, status, problem, code=None):
+        Exception.__init__(self, problem)
+        self.status = status
+        self.problem = problem
+        self.code = code if code is not None else str(status)
+
+
+def _id_list(value, cast=int):
+    try:
+        return [cast(v) for v in value.split(',') if v]
+    except ValueError:
+        raise ApiError(400, "invalid ID list: %s" % value)
+
+
+class MeetupSimulator(object):
+    """
+    Answers API queries from `corpus` (a `SyntheticCorpus`), with per-key
+    rate limiting, latency and error injection.
+
+    `rate_limit`: Requests allowed per key in each window of `rate_window`
+    seconds.
+    `latency`: Mean response latency (secs); normally distributed with
+    standard deviation `latency * latency_jitter`.
+    `error_rate`: Share of requests answered with HTTP `error_status`.
+    """
+
+    def __init__(self, corpus, rate_limit=DEFAULT_RATE_LIMIT, rate_window=DEFAULT_RATE_WINDOW,
+                 latency=DEFAULT_LATENCY, latency_jitter=0.5, error_rate=0.0,
+                 error_status=500, seed=0):
+        self.corpus = corpus
+        self.rate_limit = rate_limit
+        self.rate_window = float(rate_window)
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._windows = {}  # API key -> [window start, requests in window]
+        self._requests = defaultdict(int)  # (endpoint, status) -> count
+        self._records = defaultdict(int)  # endpoint -> count
+        self._handlers = {
+            'groups': self.query_groups,
+            'members': self.query_members,
+            'events': self.query_events,
+            'rsvps': self.query_rsvps,
+            'cities': self.query_cities,
+        }
+
+    def stats(self):
+        """
+        Requests served, by (endpoint, status), and records served, by
+        endpoint.
+        """
+        with self._lock:
+            return {'requests': dict(self._requests), 'records': dict(self._records)}
+
+    def num_requests(self):
+        with self._lock:
+            return sum(self._requests.itervalues())
+
+    def _rate(self, api_key):
+        """
+        Count a request against `api_key`. Returns tuple (allowed, headers).
+        """
+        with self._lock:
+            now = time.time()
+            window = self._windows.get(api_key)
+            if window is None or now - window[0] >= self.rate_window:
+                window = self._windows[api_key] = [now, 0]
+            window[1] += 1
+            allowed = window[1] <= self.rate_limit
+            headers = {
+                'X-RateLimit-Limit': str(self.rate_limit),
+                'X-RateLimit-Remaining': str(max(0, self.rate_limit - window[1])),
+                'X-RateLimit-Reset': str(int(math.ceil(window[0] + self.rate_window - now))),
+            }
+            return allowed, headers
+
+    def handle(self, path, params, base_url):
+        """
+        Answer the query `path` (e.g., '/2/groups') with GET parameters
+        `params` (dict). `base_url` is the server's URL, for `meta.next`.
+
+        Returns tuple (HTTP status, headers, response dict).
+        """
+        endpoint = path.strip('/').split('/')[-1]
+        with self._lock:
+            if self.latency > 0:
+                delay = self._rng.gauss(self.latency, self.latency * self.latency_jitter)
+            else:
+                delay = 0
+            inject_error = self._rng.random() < self.error_rate
+        if delay > 0:
+            time.sleep(delay)
+
+        headers = {}
+        try:
+            api_key = params.get('key')
+            if not api_key and 'sig' not in params:
+                raise ApiError(401, "missing API key", 'auth_fail')
+            allowed, headers = self._rate(api_key or params.get('sig_id'))
+            if not allowed:
+                raise ApiError(429, "rate limit exceeded", 'throttled')
+            if inject_error:
+                raise ApiError(self.error_status, "injected error")
+            if endpoint not in self._handlers or not path.startswith('/2/'):
+                raise ApiError(404, "unknown method: %s" % path)
+            results = self._handlers[endpoint](params)
+            status, out = 200, self._paginate(results, path, params, base_url)
+        except ApiError as ex:
+            status, out = ex.status, {'problem': ex.problem, 'code': ex.code}
+
+        with self._lock:
+            self._requests[(endpoint, status)] += 1
+            self._records[endpoint] += len(out.get('results', []))
+        return status, headers, out
+
+    @staticmethod
+    def _paginate(results, path, params, base_url):
+        try:
+            page = min(MAX_PAGE, int(params.get('page', MAX_PAGE)))
+            offset = int(params.get('offset', 0))
+        except ValueError:
+            raise ApiError(400, "invalid page or offset")
+        if page <= 0 or offset < 0:
+            raise ApiError(400, "invalid page or offset")
+        start = page * offset
+        page_results = results[start:start + page]
+
+        def page_url(page_offset):
+            d = dict(params)
+            d['offset'] = page_offset
+            return base_url + path + '?' + urllib.urlencode(sorted(d.items()))
+
+        more = start + page < len(results)
+        return {
+            'results': page_results,
+            'meta': {
+                'count': len(page_results),
+                'total_count': len(results),
+                'next': page_url(offset + 1) if more else '',
+                'prev': page_url(offset - 1) if offset > 0 else '',
+                'url': page_url(offset),
+                'method': path.strip('/').split('/')[-1],
+            },
+        }
+
+    #
+    # Queries
+
+    def query_groups(self, params):
+        corpus = self.corpus
+        if 'group_id' in params:
+            gids = _id_list(params['group_id'])
+            return [corpus.id2group[gid] for gid in gids if gid in corpus.id2group]
+        if 'lat' not in params or 'lon' not in params:
+            raise ApiError(400, "groups requires group_id, or lat and lon")
+        try:
+            lat, lon = float(params['lat']), float(params['lon'])
+            radius = float(params.get('radius', DEFAULT_RADIUS))
+        except ValueError:
+            raise ApiError(400, "invalid lat, lon or radius")
+        category_id = params.get('category_id')
+        near = []
+        for group in corpus.groups:
+            if category_id is not None and str(group['category']['id']) != category_id:
+                continue
+            dist = distance_miles(lat, lon, group['lat'], group['lon'])
+            if dist <= radius:
+                near.append((dist, group))
+        near.sort(key=lambda item: item[0])
+        return [group for _, group in near]
+
+    def query_members(self, params):
+        corpus = self.corpus
+        if 'member_id' in params:
+            uids = _id_list(params['member_id'])
+        elif 'group_id' in params:
+            gid = _id_list(params['group_id'])[0]
+            uids = corpus.group_members.get(gid, [])
+        else:
+            raise ApiError(400, "members requires member_id or group_id")
+        users = [corpus.users[uid] for uid in uids
+                 if uid in corpus.users and uid not in corpus.deleted_user_ids]
+        order = params.get('order', 'name')
+        if order == 'joined':
+            users.sort(key=lambda user: user['joined'])
+        else:
+            users.sort(key=lambda user: user['name'])
+        if params.get('desc') == 'true':
+            users.reverse()
+        return users
+
+    def query_events(self, params):
+        corpus = self.corpus
+        if 'group_id' in params:
+            events = []
+            for gid in _id_list(params['group_id']):
+                events.extend(corpus.group_events.get(gid, []))
+        elif 'event_id' in params:
+            eids = _id_list(params['event_id'], cast=str)
+            events = [corpus.id2event[eid] for eid in eids if eid in corpus.id2event]
+        else:
+            raise ApiError(400, "events requires group_id or event_id")
+        statuses = params.get('status', 'upcoming').split(',')
+        events = [event for event in events if event['status'] in statuses]
+        if 'time' in params:
+            try:
+                t_from, t_to = [int(t) for t in params['time'].split(',')]
+            except ValueError:
+                raise ApiError(400, "time must be two epoch ms values")
+            events = [event for event in events if t_from <= event['time'] < t_to]
+        events.sort(key=lambda event: event['time'], reverse=params.get('desc') == 'true')
+        return events
+
+    def query_rsvps(self, params):
+        corpus = self.corpus
+        if 'event_id' not in params:
+            raise ApiError(400, "rsvps requires event_id")
+        responses = params.get('rsvp', 'yes,no').split(',')
+        results = []
+        for eid in _id_list(params['event_id'], cast=str):
+            event = corpus.id2event.get(eid)
+            if event is None:
+                continue
+            for indx, (uid, response) in enumerate(corpus.event_rsvps[eid]):
+                if response not in responses:
+                    continue
+                user = corpus.users[uid]
+                results.append({
+                    'rsvp_id': hash((eid, uid)) & 0x7fffffff,
+                    'response': response,
+                    'created': event['created'] + indx,
+                    'mtime': event['created'] + indx,
+                    'event': {'id': eid, 'name': event['name'], 'time': event['time']},
+                    'group': {'id': event['group']['id'], 'urlname': event['group']['urlname']},
+                    'member': {'member_id': uid, 'name': user['name']},
+                })
+        return results
+
+    def query_cities(self, params):
+        country = params.get('country', 'us').lower()
+        cities = [city for city in self.corpus.cities if city['country'] == country]
+        return [dict(city, member_count=city['population'] // 100) for city in cities]
+
+
+#
+# HTTP server
+
+class SimulatorRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, as the live API
+
+    def do_GET(self):
+        parts = urlparse.urlsplit(self.path)
+        params = dict(urlparse.parse_qsl(parts.query, keep_blank_values=True))
+        base_url = 'http://%s' % self.headers.get('Host', '%s:%d' % self.server.server_address)
+        status, headers, out = self.server.simulator.handle(parts.path, params, base_url)
+
+        body = json.dumps(out, separators=(',', ':'))
+        if 'gzip' in self.headers.get('Accept-Encoding', '') and len(body) >= GZIP_MIN_BYTES:
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6) as f:
+                f.write(body)
+            body = buf.getvalue()
+            headers['Content-Encoding'] = 'gzip'
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json;charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # too many requests to log
+
+
+class SimulatorServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, simulator, host='localhost', port=DEFAULT_PORT):
+        HTTPServer.__init__(self, (host, port), SimulatorRequestHandler)
+        self.simulator = simulator
+
+    @property
+    def base_url(self):
+        """
+        API base URL, as for config option `meetup_api_url`.
+        """
+        host, port = self.server_address[:2]
+        return 'http://%s:%d/2' % (host, port)
+
+
+def start_server(simulator, host='localhost', port=DEFAULT_PORT):
+    """
+    Serve `simulator` from a background thread. `port` 0 picks a free port.
+    Returns the server; call its `shutdown` method to stop it.
+    """
+    server = SimulatorServer(simulator, host, port)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def add_simulator_arguments(parser):
+    """
+    Add the options for the corpus and `MeetupSimulator` to argparse
+    `parser`. See `simulator_from_args`.
+    """
+    parser.add_argument('--num-cities', type=int, default=DEFAULT_NUM_CITIES)
+    parser.add_argument('--groups-per-city', type=int, default=DEFAULT_GROUPS_PER_CITY)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rate-limit', type=int, default=DEFAULT_RATE_LIMIT,
+                        help="requests per key per window")
+    parser.add_argument('--rate-window', type=float, default=DEFAULT_RATE_WINDOW,
+                        help="rate window (secs)")
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY,
+                        help="mean response latency (secs)")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="share of requests answered with --error-status")
+    parser.add_argument('--error-status', type=int, default=500)
+
+
+def simulator_from_args(args):
+    corpus = SyntheticCorpus(num_cities=args.num_cities, groups_per_city=args.groups_per_city,
+                             seed=args.seed)
+    return MeetupSimulator(corpus, rate_limit=args.rate_limit, rate_window=args.rate_window,
+                           latency=args.latency, error_rate=args.error_rate,
+                           error_status=args.error_status, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Meetup API simulator")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    add_simulator_arguments(parser)
+    args = parser.parse_args()
+
+    simulator = simulator_from_args(args)
+    corpus = simulator.corpus
+    server = SimulatorServer(simulator, args.host, args.port)
+    print "%d cities | %d groups | %d users | %d events" % (
+        len(corpus.cities), len(corpus.groups), len(corpus.users), len(corpus.events))
+    print "serving on %s" % server.base_url
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print "requests:", simulator.stats()['requests']
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+#
+# Author:   Matt J Williams
+#           http://www.mattjw.net
+#           mattjw@mattjw.net
+# Date:     2015
+# License:  MIT License
+#           http://opensource.org/licenses/MIT
+
+
+"""
+MongoDB storage for the crawl.
+
+One pooled `MongoClient` is shared by everything in the process. Documents
+are written in batches that skip any `_id` already stored, rather than
+checking for each document before inserting it.
+"""
+
+
+__author__ = "Matt J Williams"
+__author_email__ = "mattjw@mattjw.net"
+__license__ = "MIT"
+__copyright__ = "Copyright (c) 2015 Matt J Williams"
+
+
+import math
+import hashlib
+import threading
+from collections import OrderedDict
+
+import pymongo
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+import crawl_tools
+import telemetry_tools
+from idset_tools import IntIdSet
+
+
+MONGO_DBNAME = "meetupdotcom"
+COLL_USERS = "users"
+COLL_GROUPS = "groups"
+COLL_ATTENDANCE = 'event_attendance'
+
+MONGO_POOL_SIZE = 50  # max connections held by the shared client
+DEFAULT_BATCH_SIZE = 500  # documents per bulk write
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+_mclient = None
+_mclient_lock = threading.Lock()
+
+
+def get_mongo_client():
+    """
+    Retrieve the pooled MongoClient shared by the process. Host and port are
+    taken from the config file.
+    """
+    global _mclient
+    with _mclient_lock:
+        if _mclient is None:
+            config = crawl_tools.get_config()
+            _mclient = pymongo.mongo_client.MongoClient(
+                config['mongo_host'], config['mongo_port'],
+                maxPoolSize=MONGO_POOL_SIZE)
+    return _mclient
+
+
+def mongo_connect():
+    """
+    The crawl's database: config option `mongo_dbname`, if given, or else
+    `MONGO_DBNAME`.
+    """
+    mclient = get_mongo_client()
+    #mclient[MONGO_DBNAME].authenticate(MONGO_USER, MONGO_PW)
+    dbname = crawl_tools.get_config().get('mongo_dbname', MONGO_DBNAME)
+    mdb = mclient[dbname]
+    return mdb
+
+
+def as_document(item, _id):
+    """
+    Copy of the API item `item`, keyed by `_id` for storage.
+    """
+    out = OrderedDict(item)
+    out['_id'] = _id
+    return out
+
+
+def _num_duplicates(ex):
+    """
+    Number of write errors in BulkWriteError `ex` that are duplicate keys.
+    Re-raises `ex` if there were any other errors.
+    """
+    errors = ex.details.get('writeErrors', [])
+    if any(err['code'] != DUPLICATE_KEY_ERROR for err in errors):
+        raise ex
+    if ex.details.get('writeConcernErrors'):
+        raise ex
+    return len(errors)
+
+
+def _written_ids(ids, ex):
+    """
+    Those of `ids` (of the documents, in order, of the bulk write that raised
+    BulkWriteError `ex`) that are known to be stored: those written, or that
+    failed only as duplicate keys. None are known if there were write concern
+    errors.
+    """
+    if ex.details.get('writeConcernErrors'):
+        return []
+    failed = set(err['index'] for err in ex.details.get('writeErrors', [])
+                 if err['code'] != DUPLICATE_KEY_ERROR)
+    return [_id for indx, _id in enumerate(ids) if indx not in failed]
+
+
+def insert_new(coll, docs):
+    """
+    Insert the documents `docs` into collection `coll` in one unordered
+    bulk write. Documents whose `_id` is already stored are skipped, so the
+    stored copy is left untouched.
+
+    Returns the number of documents inserted.
+    """
+    docs = list(docs)
+    if not docs:
+        return 0
+    ids = [doc['_id'] for doc in docs]
+    with telemetry_tools.get_metrics().timed('mongo_write'):
+        try:
+            ret = coll.insert_many(docs, ordered=False)
+        except BulkWriteError as ex:
+            _notify_known_ids(coll, _written_ids(ids, ex))
+            num_dups = _num_duplicates(ex)
+            return len(docs) - num_dups
+    _notify_known_ids(coll, ids)
+    return len(ret.inserted_ids)
+
+
+def upsert_many(coll, docs):
+    """
+    Insert or replace the documents `docs` in collection `coll`, by `_id`,
+    in one unordered bulk write.
+
+    Returns the number of documents inserted or modified.
+    """
+    docs = list(docs)
+    if not docs:
+        return 0
+    ids = [doc['_id'] for doc in docs]
+    ops = [UpdateOne({'_id': _id}, {'$set': doc}, upsert=True) for _id, doc in zip(ids, docs)]
+    with telemetry_tools.get_metrics().timed('mongo_write'):
+        try:
+            ret = coll.bulk_write(ops, ordered=False)
+        except BulkWriteError as ex:
+            # concurrent upserts of the same _id may race; the other write wins
+            _notify_known_ids(coll, _written_ids(ids, ex))
+            _num_duplicates(ex)
+            return ex.details['nUpserted'] + ex.details['nModified']
+    _notify_known_ids(coll, ids)
+    return ret.upserted_count + ret.modified_count
+
+
+class BatchInserter(object):
+    """
+    Buffer documents for `insert_new`, writing them `batch_size` at a time.
+    Use as a context manager to write any remainder on exit. Not thread-safe;
+    use one per thread.
+    """
+
+    def __init__(self, coll, batch_size=DEFAULT_BATCH_SIZE):
+        self.coll = coll
+        self.batch_size = batch_size
+        self.num_inserted = 0
+        self._buf = []
+
+    def add(self, doc):
+        self._buf.append(doc)
+        if len(self._buf) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._buf:
+            self.num_inserted += insert_new(self.coll, self._buf)
+            self._buf = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.flush()
+        return False
+
+
+#
+# Known-ID cache
+
+BLOOM_CAPACITY = 1 << 20  # expected number of non-integer IDs
+BLOOM_ERROR_RATE = 0.01
+
+
+class BloomFilter(object):
+    """
+    Bloom filter over arbitrary (string) keys. Sized for `capacity` keys at
+    false positive rate `error_rate`; beyond that the rate degrades.
+    """
+
+    def __init__(self, capacity=BLOOM_CAPACITY, error_rate=BLOOM_ERROR_RATE):
+        num_bits = -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        self._num_bits = int(math.ceil(num_bits))
+        self._num_hashes = max(1, int(round(self._num_bits / float(capacity) * math.log(2))))
+        self._bits = bytearray((self._num_bits + 7) // 8)
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        digest = hashlib.md5(str(key)).hexdigest()
+        h1 = int(digest[:16], 16)
+        h2 = int(digest[16:], 16) | 1
+        for k in xrange(self._num_hashes):
+            yield (h1 + k * h2) % self._num_bits
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        bits = self._bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class KnownIds(object):
+    """
+    In-process record of the `_id`s stored in collection `coll`, so existence
+    checks need not query Mongo. Seeded once from the collection; after that,
+    only this process's own writes are seen. So a hit is certain, but a miss
+    means only that the ID was not stored when the record was seeded, nor by
+    this process since: another process may have stored it in the meantime.
+    Writes must therefore still tolerate existing documents, as `insert_new`
+    and `upsert_many` do.
+
+    Integer IDs (users, groups) are held exactly in an `IntIdSet`. Other IDs
+    (e.g., alphanumeric event IDs) go in a Bloom filter; a possible hit is
+    confirmed against Mongo.
+
+    Kept up to date by `insert_new` and `upsert_many`, after their writes
+    succeed. Thread-safe.
+    """
+
+    def __init__(self, coll):
+        self.coll = coll
+        self._lock = threading.Lock()
+        self._others = BloomFilter()
+
+        int_ids = []
+        for doc in coll.find({}, {'_id': 1}):
+            _id = doc['_id']
+            if isinstance(_id, (int, long)):
+                int_ids.append(_id)
+            else:
+                self._others.add(_id)
+        self._ints = IntIdSet(int_ids)
+
+    def __contains__(self, _id):
+        if isinstance(_id, (int, long)):
+            with self._lock:
+                return _id in self._ints
+        with self._lock:
+            possible = _id in self._others
+        if not possible:
+            return False
+        return self.coll.find_one({'_id': _id}, {'_id': 1}) is not None
+
+    def update(self, ids):
+        with self._lock:
+            for _id in ids:
+                if isinstance(_id, (int, long)):
+                    self._ints.add(_id)
+                else:
+                    self._others.add(_id)
+
+
+_known_ids = {}  # (db name, collection name) -> KnownIds
+_known_ids_lock = threading.Lock()
+
+
+def _coll_key(coll):
+    return (coll.database.name, coll.name)
+
+
+def get_known_ids(coll):
+    """
+    Retrieve the `KnownIds` for collection `coll`, seeding it from Mongo on
+    first use.
+    """
+    key = _coll_key(coll)
+    with _known_ids_lock:
+        if key not in _known_ids:
+            _known_ids[key] = KnownIds(coll)
+        return _known_ids[key]
+
+
+def _notify_known_ids(coll, ids):
+    """
+    Record `ids` as stored in `coll`, if its IDs are being tracked. Only
+    called once a write has succeeded, so a failed write is never taken as
+    stored (a concurrent check may miss an ID mid-write, costing at most a
+    duplicate fetch).
+    """
+    with _known_ids_lock:
+        known = _known_ids.get(_coll_key(coll))
+    if known is not None:
+        known.update(ids)
+
+
+def has_id(coll, _id):
+    """
+    Returns True if a document with `_id` is stored in `coll`. See
+    `KnownIds`.
+    """
+    return _id in get_known_ids(coll)
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+#
+# Author:   Matt J Williams
+#           http://www.mattjw.net
+#           mattjw@mattjw.net
+# Date:     2015
+# License:  MIT License
+#           http://opensource.org/licenses/MIT
+
+
+"""
+Crawl telemetry. Records, per API endpoint, request latency (as a
+histogram), requests, records and bytes received; plus time spent waiting
+on the rate limit, retries, cache hits and named timings (e.g., Mongo
+writes, crawl stages).
+
+`MetricsExporter` periodically writes the metrics as a Prometheus text file
+(for the node exporter's textfile collector) and as a JSON summary. Together
+they show whether a crawl is bound by quota (rate limit waits), latency, or
+Mongo.
+"""
+
+
+__author__ = "Matt J Williams"
+__author_email__ = "mattjw@mattjw.net"
+__license__ = "MIT"
+__copyright__ = "Copyright (c) 2015 Matt J Williams"
+
+
+import os
+import json
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))  # secs
+DEFAULT_EXPORT_INTERVAL = 30  # secs
+
+PROM_FNAME = 'crawl_metrics.prom'
+JSON_FNAME = 'crawl_metrics.json'
+
+
+class Histogram(object):
+    """
+    Cumulative histogram over fixed `buckets` (upper bounds), as in
+    Prometheus.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for indx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[indx] += 1
+                break
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Estimate of quantile `q`: the upper bound of the bucket it falls in.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, n in zip(self.buckets, self.counts):
+            cumulative += n
+            if cumulative >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+class Metrics(object):
+    """
+    Thread-safe store of crawl metrics. See module docstring.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.latency = defaultdict(Histogram)  # endpoint -> Histogram
+        self.requests = defaultdict(int)  # (endpoint, status) -> count
+        self.records = defaultdict(int)  # endpoint -> count
+        self.bytes_received = defaultdict(int)  # endpoint -> bytes
+        self.cache_hits = defaultdict(int)  # endpoint -> count
+        self.retries = defaultdict(int)  # reason -> count
+        self.ratelimit_wait = 0.0  # secs
+        self.timers = defaultdict(lambda: [0, 0.0])  # name -> [count, secs]
+
+    def observe_request(self, endpoint, status, latency, num_bytes=0, num_records=0):
+        with self._lock:
+            self.latency[endpoint].observe(latency)
+            self.requests[(endpoint, str(status))] += 1
+            self.bytes_received[endpoint] += num_bytes
+            self.records[endpoint] += num_records
+
+    def observe_cache_hit(self, endpoint, num_records=0):
+        with self._lock:
+            self.cache_hits[endpoint] += 1
+            self.records[endpoint] += num_records
+
+    def observe_ratelimit_wait(self, secs):
+        with self._lock:
+            self.ratelimit_wait += secs
+
+    def observe_retry(self, reason):
+        with self._lock:
+            self.retries[reason] += 1
+
+    def observe_time(self, name, secs):
+        with self._lock:
+            timer = self.timers[name]
+            timer[0] += 1
+            timer[1] += secs
+
+    @contextmanager
+    def timed(self, name):
+        """
+        Context manager that records the time spent in its block under
+        timer `name`.
+        """
+        t_start = time.time()
+        try:
+            yield
+        finally:
+            self.observe_time(name, time.time() - t_start)
+
+    def summary(self):
+        """
+        JSON-serialisable summary of the metrics, including rates.
+        """
+        with self._lock:
+            elapsed = max(time.time() - self.started, 1e-9)
+            num_requests = sum(self.requests.itervalues())
+            num_records = sum(self.records.itervalues())
+            endpoints = {}
+            for endpoint, hist in self.latency.iteritems():
+                endpoints[endpoint] = {
+                    'requests': hist.count,
+                    'records': self.records[endpoint],
+                    'bytes_received': self.bytes_received[endpoint],
+                    'cache_hits': self.cache_hits[endpoint],
+                    'latency_mean': hist.total / hist.count if hist.count else None,
+                    'latency_p50': hist.quantile(0.5),
+                    'latency_p95': hist.quantile(0.95),
+                }
+            for endpoint, n in self.cache_hits.iteritems():
+                if endpoint not in endpoints:
+                    endpoints[endpoint] = {'requests': 0, 'cache_hits': n,
+                                           'records': self.records[endpoint]}
+            return {
+                'elapsed_secs': elapsed,
+                'requests': num_requests,
+                'requests_per_sec': num_requests / elapsed,
+                'records': num_records,
+                'records_per_sec': num_records / elapsed,
+                'bytes_received': sum(self.bytes_received.itervalues()),
+                'ratelimit_wait_secs': self.ratelimit_wait,
+                'retries': dict(self.retries),
+                'timers': dict((name, {'count': count, 'secs': secs})
+                               for name, (count, secs) in self.timers.iteritems()),
+                'endpoints': endpoints,
+            }
+
+    def prometheus_text(self):
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        def add(name, kind, help_text, samples):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for suffix, labels, value in samples:
+                label_str = ','.join('%s="%s"' % (k, v) for k, v in labels)
+                if label_str:
+                    label_str = '{%s}' % label_str
+                lines.append('%s%s%s %s' % (name, suffix, label_str, repr(float(value))))
+
+        with self._lock:
+            samples = []
+            for endpoint, hist in sorted(self.latency.iteritems()):
+                cumulative = 0
+                for bound, n in zip(hist.buckets, hist.counts):
+                    cumulative += n
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    samples.append(('_bucket', [('endpoint', endpoint), ('le', le)], cumulative))
+                samples.append(('_sum', [('endpoint', endpoint)], hist.total))
+                samples.append(('_count', [('endpoint', endpoint)], hist.count))
+            add('meetup_request_latency_seconds', 'histogram',
+                'Meetup API request latency.', samples)
+
+            add('meetup_requests_total', 'counter', 'Meetup API requests.',
+                [('', [('endpoint', e), ('status', s)], n)
+                 for (e, s), n in sorted(self.requests.iteritems())])
+            add('meetup_records_total', 'counter', 'Records received.',
+                [('', [('endpoint', e)], n) for e, n in sorted(self.records.iteritems())])
+            add('meetup_bytes_received_total', 'counter', 'Response bytes received.',
+                [('', [('endpoint', e)], n) for e, n in sorted(self.bytes_received.iteritems())])
+            add('meetup_cache_hits_total', 'counter', 'Responses served from the cache.',
+                [('', [('endpoint', e)], n) for e, n in sorted(self.cache_hits.iteritems())])
+            add('meetup_retries_total', 'counter', 'Requests retried.',
+                [('', [('reason', r)], n) for r, n in sorted(self.retries.iteritems())])
+            add('meetup_ratelimit_wait_seconds_total', 'counter',
+                'Time spent waiting on the rate limit.', [('', [], self.ratelimit_wait)])
+            add('crawl_timer_seconds_total', 'counter', 'Time spent, by activity.',
+                [('', [('name', name)], secs) for name, (_, secs) in sorted(self.timers.iteritems())])
+            add('crawl_timer_count_total', 'counter', 'Timed activities, by activity.',
+                [('', [('name', name)], count) for name, (count, _) in sorted(self.timers.iteritems())])
+        return '\n'.join(lines) + '\n'
+
+
+def _write_atomic(fpath, data):
+    tmp_fpath = fpath + '.tmp'
+    with open(tmp_fpath, 'w') as f:
+        f.write(data)
+    os.rename(tmp_fpath, fpath)
+
+
+class MetricsExporter(threading.Thread):
+    """
+    Background thread that writes `metrics` to `out_dir` every `interval`
+    seconds, as `PROM_FNAME` and `JSON_FNAME`. `stop` writes a final export.
+    """
+
+    def __init__(self, metrics, out_dir, interval=DEFAULT_EXPORT_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.metrics = metrics
+        self.out_dir = out_dir
+        self.interval = interval
+        self._stop_event = threading.Event()
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+
+    def export(self):
+        _write_atomic(os.path.join(self.out_dir, PROM_FNAME), self.metrics.prometheus_text())
+        summary = json.dumps(self.metrics.summary(), indent=2, sort_keys=True)
+        _write_atomic(os.path.join(self.out_dir, JSON_FNAME), summary)
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.export()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.export()
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    """
+    Retrieve the metrics shared by the process.
+    """
+    return _metrics
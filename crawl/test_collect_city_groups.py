@@ -0,0 +1,45 @@
+"""
+Unit tests for collect_city_groups. Run with:
+    python -m unittest discover -p 'test_*.py'
+"""
+
+
+import json
+import unittest
+from StringIO import StringIO
+
+from collect_city_groups import iter_json_array
+
+
+class IterJsonArrayTest(unittest.TestCase):
+
+    def parse(self, text, chunk_size=4):
+        return list(iter_json_array(StringIO(text), chunk_size=chunk_size))
+
+    def test_items_across_chunks(self):
+        items = [{'results': [{'id': i, 'name': u'Gr\xfcppe %d' % i}]} for i in xrange(50)]
+        text = json.dumps(items, indent=2)
+        for chunk_size in [1, 3, 7, 1 << 16]:
+            self.assertEqual(self.parse(text, chunk_size), items)
+
+    def test_empty_array(self):
+        self.assertEqual(self.parse('  [ ]  '), [])
+
+    def test_item_larger_than_chunk(self):
+        items = [{'results': range(1000)}, ['x' * 5000]]
+        self.assertEqual(self.parse(json.dumps(items), chunk_size=16), items)
+
+    def test_not_an_array(self):
+        with self.assertRaises(ValueError):
+            self.parse('{"results": []}')
+
+    def test_truncated(self):
+        text = json.dumps([{'a': 1}, {'b': 2}])
+        with self.assertRaises(ValueError):
+            self.parse(text[:-5])
+        with self.assertRaises(ValueError):
+            self.parse(text[:-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
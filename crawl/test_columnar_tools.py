@@ -0,0 +1,49 @@
+"""
+Unit tests for columnar_tools. Run with:
+    python -m unittest discover -p 'test_*.py'
+"""
+
+
+import shutil
+import tempfile
+import unittest
+
+from columnar_tools import TableWriter, TableReader, STRING, INT64, FLOAT64
+
+
+class TableRoundTripTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def write(self, columns, rows, flush_rows=2):
+        writer = TableWriter(self.dirpath, columns, flush_rows=flush_rows)
+        for row in rows:
+            writer.append(row)
+        writer.close()
+        return TableReader(self.dirpath)
+
+    def test_round_trip(self):
+        columns = [('id', INT64), ('lat', FLOAT64), ('city', STRING)]
+        rows = [{'id': 1, 'lat': 51.5, 'city': u'London'},
+                {'id': 2, 'lat': None, 'city': 'M\xc3\xbcnchen'},
+                {'id': 3, 'lat': 40.7},
+                {'id': 4, 'lat': 51.4, 'city': u'London'}]
+        reader = self.write(columns, rows)
+        out = list(reader.iter_rows())
+        self.assertEqual([row['id'] for row in out], [1, 2, 3, 4])
+        self.assertEqual([row['city'] for row in out], [u'London', u'M\xfcnchen', None, u'London'])
+        self.assertIsNone(out[1]['lat'])
+        self.assertEqual(reader.column('city').values, [u'London', u'M\xfcnchen'])
+
+    def test_non_string_in_string_column(self):
+        reader = self.write([('urlname', STRING)], [{'urlname': 1234}, {'urlname': u'1234'},
+                                                    {'urlname': True}])
+        self.assertEqual(list(reader.column('urlname')), [u'1234', u'1234', u'True'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+"""
+Unit tests for coverage_tools. Run with:
+    python -m unittest discover -p 'test_*.py'
+"""
+
+
+import unittest
+
+from coverage_tools import CoveragePlanner
+
+
+class CoveragePlannerTest(unittest.TestCase):
+
+    def assertCovers(self, planner, plan):
+        all_pieces = set(planner.all_pieces())
+        planned = set()
+        for circle, pieces in plan:
+            self.assertTrue(pieces <= planner._covered_by(circle, all_pieces))
+            planned |= pieces
+        self.assertEqual(planned, all_pieces)
+
+    def test_clustered_points_merged(self):
+        # ten points within a few miles of each other
+        points = [(40.0 + 0.01 * i, -75.0 + 0.01 * i) for i in xrange(10)]
+        planner = CoveragePlanner(points, radius=10)
+        plan = planner.plan(query_radius=50)
+        self.assertEqual(len(plan), 1)
+        self.assertCovers(planner, plan)
+
+    def test_isolated_points_use_own_circles(self):
+        # too far apart for any larger circle to cover two of them
+        points = [(30.0, -120.0), (40.0, -100.0), (45.0, -80.0)]
+        planner = CoveragePlanner(points, radius=10)
+        plan = planner.plan(query_radius=50)
+        self.assertEqual(sorted((c.lat, c.lon) for c, _ in plan), sorted(points))
+        self.assertTrue(all(c.radius == 10 for c, _ in plan))
+        self.assertCovers(planner, plan)
+
+    def test_single_point_keeps_own_radius(self):
+        planner = CoveragePlanner([(51.5, -0.1)], radius=10)
+        plan = planner.plan(query_radius=100)
+        self.assertEqual(len(plan), 1)
+        self.assertEqual(plan[0][0].radius, 10)
+
+    def test_split_halves_radius(self):
+        points = [(40.0 + 0.05 * i, -75.0) for i in xrange(20)]
+        planner = CoveragePlanner(points, radius=5)
+        (circle, pieces), = planner.plan(query_radius=80)
+        subplan = planner.split(circle, pieces)
+        self.assertTrue(all(c.radius <= 40 for c, _ in subplan))
+        self.assertEqual(set().union(*[p for _, p in subplan]), pieces)
+
+    def test_split_at_min_radius(self):
+        planner = CoveragePlanner([(40.0, -75.0)], radius=10)
+        (circle, pieces), = planner.plan()
+        self.assertIsNone(planner.split(circle, pieces))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""
+Unit tests for crawl_group_activity. Run with:
+    python -m unittest discover -p 'test_*.py'
+"""
+
+
+import math
+import random
+import unittest
+
+from crawl_group_activity import plan_rsvp_batches, UNKNOWN_RSVP_COUNT
+
+
+def num_pages(batch, event2count, page_size):
+    count = sum(event2count[eid] or UNKNOWN_RSVP_COUNT for eid in batch)
+    return int(math.ceil(count / float(page_size)))
+
+
+class PlanRsvpBatchesTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(0)
+        self.event2count = dict(('ev%05d' % i, int(rng.paretovariate(1.2) * 5))
+                                for i in xrange(500))
+        self.event2count['unknown1'] = None
+
+    def test_each_event_planned_once(self):
+        batches, empty = plan_rsvp_batches(self.event2count, page_size=200)
+        planned = [eid for batch in batches for eid in batch]
+        self.assertEqual(len(planned), len(set(planned)))
+        self.assertEqual(sorted(planned + empty), sorted(self.event2count))
+        self.assertEqual(sorted(empty),
+                         sorted(eid for eid, n in self.event2count.iteritems() if n == 0))
+        self.assertIn('unknown1', planned)
+
+    def test_limits(self):
+        batches, _ = plan_rsvp_batches(self.event2count, page_size=200, max_events=10,
+                                       max_id_chars=60)
+        for batch in batches:
+            self.assertLessEqual(len(batch), 10)
+            self.assertLessEqual(len('%2C'.join(batch)), 60)
+
+    def test_pages_close_to_minimum(self):
+        page_size = 200
+        batches, _ = plan_rsvp_batches(self.event2count, page_size=page_size)
+        total = sum(n or UNKNOWN_RSVP_COUNT for n in self.event2count.itervalues())
+        min_pages = int(math.ceil(total / float(page_size)))
+        pages = sum(num_pages(batch, self.event2count, page_size) for batch in batches)
+        self.assertLessEqual(pages, min_pages + len(batches))
+        # far fewer requests than one per event
+        self.assertLess(pages, len(self.event2count) / 5)
+
+    def test_large_event_shares_its_pages(self):
+        event2count = {'big': 450, 'a': 100, 'b': 60}
+        batches, _ = plan_rsvp_batches(event2count, page_size=200)
+        self.assertEqual(sorted(sorted(batch) for batch in batches), [['a', 'b', 'big']])
+        batches, _ = plan_rsvp_batches({'big': 400, 'a': 100}, page_size=200, max_events=1)
+        self.assertEqual(sorted(batches), [['a'], ['big']])
+
+    def test_nothing_to_plan(self):
+        self.assertEqual(plan_rsvp_batches({'a': 0}), ([], ['a']))
+        self.assertEqual(plan_rsvp_batches({}), ([], []))
+
+
+if __name__ == '__main__':
+    unittest.main()
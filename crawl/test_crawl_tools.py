@@ -0,0 +1,255 @@
+"""
+Unit tests for crawl_tools. Run with:
+    python -m unittest discover -p 'test_*.py'
+"""
+
+
+import json
+import unittest
+import itertools
+import urlparse
+
+import crawl_tools
+from crawl_tools import HeaderRateLimiter
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def rate(remaining, reset, limit=30):
+    return {'limit': limit, 'limit_remaining': remaining, 'reset': reset}
+
+
+class HeaderRateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self._monotonic = crawl_tools.monotonic
+        crawl_tools.monotonic = self.clock
+
+    def tearDown(self):
+        crawl_tools.monotonic = self._monotonic
+
+    def test_single_probe_until_rate_known(self):
+        limiter = HeaderRateLimiter(30, 10)
+        self.assertIsNone(limiter.try_acquire())
+        self.assertEqual(limiter.try_acquire(), HeaderRateLimiter.PROBE_WAIT)
+        limiter.release(rate(29, 10))
+        self.assertEqual(limiter.remaining(), 29)
+        self.assertIsNone(limiter.try_acquire())
+        self.assertIsNone(limiter.try_acquire())
+
+    def test_failed_probe_allows_another(self):
+        limiter = HeaderRateLimiter(30, 10)
+        self.assertIsNone(limiter.try_acquire())
+        limiter.release(None)
+        self.assertIsNone(limiter.try_acquire())
+
+    def test_out_of_order_responses_only_lower_remaining(self):
+        limiter = HeaderRateLimiter(30, 10)
+        limiter.try_acquire()
+        limiter.release(rate(20, 10))
+        for _ in xrange(3):
+            limiter.try_acquire()
+        # the newest response arrives first; 17 left, less two in flight
+        limiter.release(rate(17, 9))
+        self.assertEqual(limiter.remaining(), 15)
+        limiter.release(rate(19, 10))
+        limiter.release(rate(18, 10))
+        self.assertEqual(limiter.remaining(), 15)
+
+    def test_later_reset_ignored(self):
+        limiter = HeaderRateLimiter(30, 10)
+        limiter.try_acquire()
+        limiter.release(rate(5, 4))
+        limiter.try_acquire()
+        limiter.release(rate(25, 10))
+        self.assertEqual(limiter.remaining(), 4)
+
+    def test_waits_until_reset_then_probes(self):
+        limiter = HeaderRateLimiter(30, 10)
+        limiter.try_acquire()
+        limiter.release(rate(1, 4))
+        self.assertIsNone(limiter.try_acquire())
+        self.assertAlmostEqual(limiter.try_acquire(), 4.0)
+        limiter.release(rate(0, 4))
+        self.clock.now += 4
+        self.assertIsNone(limiter.try_acquire())
+        self.assertEqual(limiter.try_acquire(), HeaderRateLimiter.PROBE_WAIT)
+
+    def test_in_flight_counted_against_reported_quota(self):
+        limiter = HeaderRateLimiter(30, 10)
+        limiter.try_acquire()
+        limiter.release(rate(10, 10))
+        for _ in xrange(4):
+            limiter.try_acquire()
+        limiter.release(rate(9, 10))  # three calls still in flight
+        self.assertEqual(limiter.remaining(), 6)
+
+
+_key_ids = itertools.count()
+
+
+def new_keys(num_keys):
+    """
+    Fresh API keys: rate limiters are shared by all pools in the process.
+    """
+    return ['testkey%04d' % next(_key_ids) for _ in xrange(num_keys)]
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, body, remaining=10, reset=5):
+        self.status_code = status_code
+        self.content = json.dumps(body)
+        self.headers = {'X-RateLimit-Limit': '30', 'X-RateLimit-Remaining': str(remaining),
+                        'X-RateLimit-Reset': str(reset)}
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class FakeTransport(object):
+    """
+    Answers each request with the next of `responses`, a list of functions
+    of the request's API key.
+    """
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.keys = []
+
+    def get(self, url):
+        api_key = dict(urlparse.parse_qsl(urlparse.urlsplit(url).query))['key']
+        self.keys.append(api_key)
+        return self.responses.pop(0)(api_key)
+
+
+def ok(api_key):
+    return FakeResponse(200, {'results': [], 'meta': {}})
+
+
+def throttled(api_key):
+    return FakeResponse(429, {'code': 'throttled', 'problem': 'slow down'}, remaining=0, reset=0)
+
+
+def auth_fail(api_key):
+    return FakeResponse(401, {'code': 'auth_fail', 'problem': 'bad key'})
+
+
+def not_authorized(api_key):
+    return FakeResponse(401, {'code': 'not_authorized', 'problem': 'members only'})
+
+
+class WithApiKeyTest(unittest.TestCase):
+
+    def params(self, url):
+        return urlparse.parse_qsl(urlparse.urlsplit(url).query)
+
+    def test_replaces_key(self):
+        url = crawl_tools.with_api_key('http://api/2/groups?key=old&page=20', 'new')
+        self.assertEqual(sorted(self.params(url)), [('key', 'new'), ('page', '20')])
+
+    def test_adds_missing_key(self):
+        url = crawl_tools.with_api_key('http://api/2/groups?offset=1', 'new')
+        self.assertEqual(sorted(self.params(url)), [('key', 'new'), ('offset', '1')])
+
+    def test_signed_url_unchanged(self):
+        url = 'http://api/2/groups?offset=1&sig_id=7&sig=abc'
+        self.assertEqual(crawl_tools.with_api_key(url, 'new'), url)
+
+
+class KeyPoolTest(unittest.TestCase):
+
+    def prime(self, pool, api_key, remaining):
+        limiter = crawl_tools.get_key_limiter(api_key)
+        self.assertIsNone(limiter.try_acquire())
+        limiter.release({'limit': 30, 'limit_remaining': remaining, 'reset': 10})
+
+    def test_prefers_key_with_most_quota(self):
+        keys = new_keys(2)
+        pool = crawl_tools.KeyPool(keys)
+        self.prime(pool, keys[0], 3)
+        self.prime(pool, keys[1], 20)
+        self.assertEqual(pool.acquire(), keys[1])
+
+    def test_throttled_key_rested_until_reset(self):
+        keys = new_keys(2)
+        pool = crawl_tools.KeyPool(keys)
+        self.prime(pool, keys[0], 20)
+        self.prime(pool, keys[1], 10)
+        self.assertEqual(pool.acquire(), keys[0])
+        pool.release(keys[0], rate={'limit': 30, 'limit_remaining': 0, 'reset': 1000},
+                     key_error=crawl_tools.KEY_THROTTLED)
+        self.assertEqual(pool.acquire(), keys[1])
+        self.assertGreater(pool._rested_until[keys[0]] - crawl_tools.monotonic(), 900)
+
+    def test_all_invalid(self):
+        keys = new_keys(2)
+        pool = crawl_tools.KeyPool(keys)
+        for api_key in keys:
+            self.assertFalse(pool.all_invalid())
+            pool.acquire()
+            pool.release(api_key, key_error=crawl_tools.KEY_INVALID)
+        self.assertTrue(pool.all_invalid())
+
+
+class FetchTest(unittest.TestCase):
+
+    def api(self, keys, responses):
+        transport = FakeTransport(responses)
+        return crawl_tools.AltMeetup(keys, transport=transport, base_url='http://api/2'), transport
+
+    def test_throttled_retried_on_same_key(self):
+        keys = new_keys(1)
+        api, transport = self.api(keys, [throttled, ok])
+        api.query_get('groups', {})
+        self.assertEqual(transport.keys, keys * 2)
+
+    def test_invalid_key_retried_on_another(self):
+        keys = new_keys(2)
+        api, transport = self.api(keys, [auth_fail, ok])
+        api.query_get('groups', {})
+        self.assertEqual(len(set(transport.keys)), 2)
+
+    def test_fatal_when_every_key_invalid(self):
+        keys = new_keys(2)
+        api, transport = self.api(keys, [auth_fail, auth_fail])
+        with self.assertRaises(crawl_tools.MeetupApiError) as cm:
+            api.query_get('groups', {})
+        self.assertEqual(cm.exception.key_error(), crawl_tools.KEY_INVALID)
+        self.assertEqual(len(transport.keys), 2)
+
+    def test_resource_error_not_blamed_on_key(self):
+        keys = new_keys(2)
+        api, transport = self.api(keys, [not_authorized])
+        with self.assertRaises(crawl_tools.MeetupApiError):
+            api.query_get('groups', {})
+        self.assertEqual(len(transport.keys), 1)
+
+
+class DictCache(dict):
+    def put(self, url, out):
+        self[url] = out
+
+
+class UncachedTest(unittest.TestCase):
+
+    def test_uncached_bypasses_cache(self):
+        transport = FakeTransport([ok, ok, ok])
+        api = crawl_tools.AltMeetup(new_keys(1), transport=transport, cache=DictCache(),
+                                    base_url='http://api/2')
+        api.query_get('groups', {})
+        api.query_get('groups', {})
+        self.assertEqual(len(transport.keys), 1)
+        api.uncached().query_get('groups', {})
+        self.assertEqual(len(transport.keys), 2)
+        self.assertIsNotNone(api.cache)
+
+
+if __name__ == '__main__':
+    unittest.main()
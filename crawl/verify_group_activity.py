@@ -24,14 +24,9 @@ from collections import OrderedDict
 import os
 from datetime import datetime
 
-import pymongo
-
 import crawl_tools
-
-
-MONGO_DBNAME = "meetupdotcom"
-COLL_USERS = "users"
-COLL_GROUPS = "groups"
+import storage_tools
+from storage_tools import COLL_USERS, COLL_GROUPS
 
 
 #
@@ -48,12 +43,7 @@ def has_group(mdb, group_id):
 
 
 def mongo_connect():
-    config = crawl_tools.get_config()
-
-    mclient = pymongo.mongo_client.MongoClient(config['mongo_host'], config['mongo_port'])
-    #mclient[MONGO_DBNAME].authenticate(MONGO_USER, MONGO_PW)
-    mdb = mclient[MONGO_DBNAME]
-    return mdb
+    return storage_tools.mongo_connect()
 
 
 #